@@ -0,0 +1,129 @@
+import datetime
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from config import ACCESS_CACHE_SIZE, ACCESS_CACHE_TTL
+
+
+def as_utc(value: datetime.datetime | None) -> datetime.datetime | None:
+    # SQLite hands back naive datetimes even for DateTime(timezone=True)
+    if value is None or value.tzinfo is not None:
+        return value
+    return value.replace(tzinfo=datetime.timezone.utc)
+
+
+@dataclass(frozen=True)
+class UserSnapshot:
+    id: int
+    telegram_id: int
+    telegram_username: str | None
+    email: str
+    referral_link_override: str | None
+    referral_status_override: bool | None
+    is_active: bool
+
+    @classmethod
+    def from_user(cls, user) -> "UserSnapshot":
+        return cls(
+            id=user.id,
+            telegram_id=user.telegram_id,
+            telegram_username=user.telegram_username,
+            email=user.email,
+            referral_link_override=user.referral_link_override,
+            referral_status_override=user.referral_status_override,
+            is_active=bool(user.is_active),
+        )
+
+
+@dataclass(frozen=True)
+class AccessEntry:
+    user: UserSnapshot
+    is_whitelisted: bool
+    subscription_end: datetime.datetime | None
+    expires_at: float
+
+    @property
+    def has_subscription(self) -> bool:
+        return self.subscription_end is not None and self.subscription_end.timestamp() > time.time()
+
+    @property
+    def has_access(self) -> bool:
+        return self.is_whitelisted or self.has_subscription
+
+
+class AccessCache:
+    def __init__(self, maxsize: int = ACCESS_CACHE_SIZE, ttl: float = ACCESS_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict[int, AccessEntry] = OrderedDict()
+        self._lock = threading.Lock()
+        self.listeners = []
+
+    def get(self, telegram_id: int) -> AccessEntry | None:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(telegram_id)
+            if entry is None or entry.expires_at <= now:
+                if entry is not None:
+                    del self._entries[telegram_id]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(telegram_id)
+            self.hits += 1
+            return entry
+
+    def put(self, user) -> AccessEntry:
+        is_whitelisted = bool(user.is_whitelisted)
+        subscription_end = as_utc(user.access_until)
+        now = time.time()
+        expires_at = now + self.ttl
+        if subscription_end is not None and subscription_end.timestamp() > now:
+            # The access decision flips exactly at end_date, so the entry must not outlive it;
+            # a subscription that already ended flips nothing and gets the full TTL
+            expires_at = min(expires_at, subscription_end.timestamp())
+        snapshot = UserSnapshot.from_user(user)
+        entry = AccessEntry(
+            user=snapshot,
+            is_whitelisted=is_whitelisted,
+            subscription_end=subscription_end,
+            expires_at=expires_at,
+        )
+        with self._lock:
+            self._entries[snapshot.telegram_id] = entry
+            self._entries.move_to_end(snapshot.telegram_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return entry
+
+    def invalidate(self, telegram_id: int | None) -> None:
+        if telegram_id is None:
+            return
+        with self._lock:
+            self._entries.pop(telegram_id, None)
+        for listener in self.listeners:
+            listener(telegram_id)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+        for listener in self.listeners:
+            listener(None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+access_cache = AccessCache()
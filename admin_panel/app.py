@@ -1,20 +1,33 @@
+import io
 import os
 import sys
 import logging
+import threading
+import time
+from collections import OrderedDict
 from functools import wraps
 # Ensure the project root is in the path *before* other imports
 project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 sys.path.insert(0, project_root)
 
-from flask import Flask, render_template, request, redirect, url_for, flash, session
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, g
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
-import asyncio
-from config import DATABASE_URL, ADMIN_USERNAME, ADMIN_PASSWORD, BOT_TOKEN
-from models import User, Subscription, Whitelist, SessionLocal, init_db, PromoCode, Referral, Admin
-from aiogram import Bot
+from config import DATABASE_URL, ADMIN_USERNAME, ADMIN_PASSWORD, MEDIA_UPLOAD_CHAT_ID, USERS_PAGE_SIZE, USERS_COUNT_TTL, USER_SEARCH_LIMIT, USER_SEARCH_BUDGET_MS, REFERRAL_LEADERBOARD_SIZE, SUBSCRIPTION_PRICE, SQL_PROFILE_PATH
+from models import User, Subscription, Whitelist, SessionLocal, engine, init_db, PromoCode, Referral, Admin, BroadcastJob, SubscriptionDailyStats, CatalogMessage, CatalogState, utc_today
+from access_cache import access_cache
+from bulk_import import ImportFormatError, import_users, import_whitelist
+from promo import promo_cache
+from metrics import DBTally, db_tally, instrument_engine, observe_request
+from sqlprofile import read_reports, sql_profiler, summarize
+from catalog import DEFAULT_MESSAGES, PARSE_MODES, dump_keyboard, parse_keyboard, render, variables
+import queries
+from media import MAX_CAPTION_LENGTH, store_upload
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import func, text, update
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import joinedload
 
 # Настройка логирования
 logging.basicConfig(level=logging.DEBUG)
@@ -34,22 +47,50 @@ app = Flask(__name__)
 app.config['SECRET_KEY'] = os.urandom(24)
 app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQL_PROFILE'] = sql_profiler is not None
 
 db = SQLAlchemy(app)
 
-# Initialize bot instance
-try:
-    bot = Bot(token=BOT_TOKEN)
-    logger.info("Бот успешно инициализирован")
-except Exception as e:
-    logger.error(f"Ошибка при инициализации бота: {e}")
-    bot = None
-
+# Метрики по маршрутам: время ответа, статус и SQL-запросы за запрос
+instrument_engine(engine)
+if sql_profiler is not None:
+    sql_profiler.instrument(engine)
+
+@app.before_request
+def start_request_metrics():
+    g.metrics_tally = DBTally()
+    g.metrics_started = time.perf_counter()
+    db_tally.set(g.metrics_tally)
+
+@app.after_request
+def remember_response_status(response):
+    g.metrics_status = response.status_code
+    return response
+
+@app.teardown_request
+def record_request_metrics(exc):
+    tally = g.pop('metrics_tally', None)
+    if tally is None:
+        return
+    db_tally.set(None)
+    status = 500 if exc is not None else g.get('metrics_status', 500)
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    observe_request(route, request.method, status, time.perf_counter() - g.metrics_started, tally)
+    if sql_profiler is not None and request.endpoint != 'sql_profile':
+        sql_profiler.report("route", f"{request.method} {route}", tally)
+
+# Одна сессия на запрос, закрывается в teardown_request. Закрывать её в самом
+# генераторе нельзя: next(get_db()) выбрасывает генератор сразу, а сессия
+# открывает соединение заново и держит его до сборки мусора
 def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
+    if 'db_session' not in g:
+        g.db_session = SessionLocal()
+    yield g.db_session
+
+@app.teardown_request
+def close_db_session(exc):
+    db = g.pop('db_session', None)
+    if db is not None:
         db.close()
 
 def login_required(f):
@@ -87,22 +128,135 @@ def logout():
     session.pop('logged_in', None)
     return redirect(url_for('login'))
 
+# Оценки количества пользователей по набору фильтров: {ключ: (истекает, количество)};
+# не больше USER_COUNT_CACHE_SIZE наборов, давно не запрашиваемые вытесняются первыми
+USER_COUNT_CACHE_SIZE = 256
+user_count_cache = OrderedDict()
+user_count_lock = threading.Lock()
+
+def parse_flag(value):
+    return {'1': True, '0': False}.get(value)
+
+def parse_date(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date() if value else None
+    except ValueError:
+        return None
+
+def estimate_row_count(db, model):
+    # Оценка планировщика (PostgreSQL) или max(id) (SQLite) вместо COUNT(*) по всей таблице
+    if db.bind.dialect.name == 'postgresql':
+        estimate = db.execute(text("SELECT reltuples::bigint FROM pg_class WHERE relname = :name"),
+                              {'name': model.__tablename__}).scalar()
+        if estimate and estimate > 0:
+            return estimate
+        return None
+    return db.query(func.max(model.id)).scalar() or 0
+
+def estimate_user_count(db, key, conditions):
+    # Без фильтров берём оценку по таблице; с фильтрами считаем COUNT(*)
+    # не чаще раза в USERS_COUNT_TTL секунд
+    if not conditions:
+        estimate = estimate_row_count(db, User)
+        if estimate is not None:
+            return estimate
+    now = time.monotonic()
+    with user_count_lock:
+        cached = user_count_cache.get(key)
+        if cached and cached[0] > now:
+            user_count_cache.move_to_end(key)
+            return cached[1]
+    count = db.query(func.count(User.id)).filter(*conditions).scalar()
+    with user_count_lock:
+        user_count_cache[key] = (now + USERS_COUNT_TTL, count)
+        user_count_cache.move_to_end(key)
+        for stale in [stale for stale, (expires, _) in user_count_cache.items() if expires <= now]:
+            del user_count_cache[stale]
+        while len(user_count_cache) > USER_COUNT_CACHE_SIZE:
+            user_count_cache.popitem(last=False)
+    return count
+
 @app.route('/users')
 @login_required
 def users():
     logger.debug("Запрос к /users")
     try:
         db = next(get_db())
-        logger.debug("Получен доступ к БД для /users")
-        users = db.query(User).all()
-        logger.debug(f"Найдено {len(users)} пользователей")
-        return render_template('users.html', users=users)
+        args = request.args
+        sort = args.get('sort') if args.get('sort') in queries.USER_SORT_COLUMNS else 'id'
+        descending = args.get('order') != 'asc'
+        per_page = min(max(args.get('per_page', USERS_PAGE_SIZE, type=int), 1), 500)
+        cursor_id = args.get('cursor', type=int)
+        backwards = args.get('dir') == 'prev' and cursor_id is not None
+        filters = {
+            'active': parse_flag(args.get('active')),
+            'has_email': parse_flag(args.get('has_email')),
+            'registered_from': parse_date(args.get('registered_from')),
+            'registered_to': parse_date(args.get('registered_to')),
+        }
+        conditions = queries.user_filters(**filters)
+
+        rows = db.execute(queries.users_page(conditions, sort, descending, cursor_id, backwards, per_page + 1)).all()
+        has_more = len(rows) > per_page
+        rows = rows[:per_page]
+        if backwards:
+            rows.reverse()
+        has_next = has_more if not backwards else True
+        has_prev = has_more if backwards else cursor_id is not None
+        total = estimate_user_count(db, tuple(sorted(filters.items())), conditions)
+        logger.debug(f"Страница /users: {len(rows)} строк, сортировка {sort}, курсор {cursor_id}")
+
+        # Параметры фильтров и сортировки, которые переносятся в ссылки пагинации
+        params = {key: value for key, value in args.items() if key not in ('cursor', 'dir') and value}
+        return render_template('users.html', users=rows, params=params, total=total,
+                               sort=sort, descending=descending, per_page=per_page,
+                               next_cursor=rows[-1].id if rows and has_next else None,
+                               prev_cursor=rows[0].id if rows and has_prev else None)
     except Exception as e:
         logger.exception("Ошибка при получении списка пользователей:")
         flash(f'Ошибка при получении списка пользователей: {str(e)}', 'error')
         logger.debug("Перенаправление с /users на / из-за ошибки")
         return redirect(url_for('index'))
 
+@app.route('/api/users/search')
+@login_required
+def search_users():
+    term = (request.args.get('q') or '').strip()
+    limit = min(max(request.args.get('limit', USER_SEARCH_LIMIT, type=int), 1), 50)
+    started = time.monotonic()
+    deadline = started + USER_SEARCH_BUDGET_MS / 1000
+    db = next(get_db())
+    dialect = db.bind.dialect.name
+    results, seen, partial = [], set(), False
+    try:
+        if dialect == 'postgresql':
+            db.execute(text(f"SET LOCAL statement_timeout = {USER_SEARCH_BUDGET_MS}"))
+        # Запросы идут от точного совпадения к префиксным; по исчерпании бюджета отдаём то, что успели найти
+        for statement in queries.user_search(term, limit, dialect):
+            if len(results) >= limit:
+                break
+            if time.monotonic() > deadline:
+                partial = True
+                break
+            for row in db.execute(statement):
+                if row.id not in seen and len(results) < limit:
+                    seen.add(row.id)
+                    results.append({
+                        'id': row.id,
+                        'telegram_id': row.telegram_id,
+                        'username': row.telegram_username,
+                        'email': row.email,
+                        'is_whitelisted': row.is_whitelisted,
+                    })
+    except OperationalError:
+        db.rollback()
+        logger.warning(f"Поиск пользователей '{term}' прерван по таймауту")
+        partial = True
+    finally:
+        db.rollback()
+    return jsonify({'results': results, 'partial': partial,
+                    'took_ms': round((time.monotonic() - started) * 1000, 1)})
+
 @app.route('/edit_user/<int:user_id>', methods=['GET', 'POST'])
 @login_required
 def edit_user(user_id):
@@ -118,6 +272,7 @@ def edit_user(user_id):
             user.referral_status_override = request.form.get('referral_status') == 'true'
             user.is_active = request.form.get('is_active') == 'true'
             db.commit()
+            access_cache.invalidate(user.telegram_id)
             flash('Пользователь успешно обновлен', 'success')
             return redirect(url_for('users'))
         
@@ -139,18 +294,78 @@ def whitelist():
                     whitelist_entry = Whitelist(telegram_id=telegram_id)
                     db.add(whitelist_entry)
                     db.commit()
+                    access_cache.invalidate(telegram_id)
                     flash('Telegram ID успешно добавлен в белый список', 'success')
                 except ValueError:
                     flash('Telegram ID должен быть числом', 'error')
                 except Exception as e:
+                    db.rollback()
                     flash(f'Ошибка при добавлении в белый список: {str(e)}', 'error')
         
-        whitelist_entries = db.query(Whitelist).all()
-        return render_template('whitelist.html', whitelist_entries=whitelist_entries)
+        args = request.args
+        per_page = min(max(args.get('per_page', USERS_PAGE_SIZE, type=int), 1), 500)
+        cursor_id = args.get('cursor', type=int)
+        backwards = args.get('dir') == 'prev' and cursor_id is not None
+        # Поиск по точному Telegram ID идёт по уникальному индексу
+        search = args.get('q', '').strip()
+        search_id = int(search) if search.isascii() and search.isdigit() else None
+        if search_id is not None and not 0 < search_id <= queries.MAX_TELEGRAM_ID:
+            search_id = None
+        if search and search_id is None:
+            flash('Telegram ID должен быть положительным числом не длиннее 19 цифр', 'error')
+
+        rows = db.execute(queries.whitelist_page(cursor_id, backwards, per_page + 1, search_id)).all()
+        has_more = len(rows) > per_page
+        rows = rows[:per_page]
+        if backwards:
+            rows.reverse()
+        has_next = has_more if not backwards else True
+        has_prev = has_more if backwards else cursor_id is not None
+        total = len(rows) if search_id is not None else estimate_row_count(db, Whitelist)
+
+        params = {key: value for key, value in args.items() if key not in ('cursor', 'dir') and value}
+        return render_template('whitelist.html', whitelist_entries=rows, params=params, total=total,
+                               search=search, per_page=per_page,
+                               next_cursor=rows[-1].id if rows and has_next else None,
+                               prev_cursor=rows[0].id if rows and has_prev else None)
     except Exception as e:
         flash(f'Ошибка при работе с белым списком: {str(e)}', 'error')
         return redirect(url_for('index'))
 
+def import_upload(importer, endpoint):
+    upload = request.files.get('file')
+    if not upload or not upload.filename:
+        flash('Выберите файл для импорта', 'error')
+        return redirect(url_for(endpoint))
+    # Файл разбирается потоком: в памяти только текущая пачка строк
+    stream = io.TextIOWrapper(upload.stream, encoding='utf-8-sig', errors='replace', newline='')
+    try:
+        report = importer(stream)
+    except ImportFormatError as e:
+        flash(f'Неверный формат файла: {str(e)}', 'error')
+        return redirect(url_for(endpoint))
+    except Exception as e:
+        logger.exception("Ошибка при импорте файла")
+        flash(f'Ошибка при импорте (уже записанные пачки сохранены): {str(e)}', 'error')
+        return redirect(url_for(endpoint))
+    flash(f'Импорт завершен: строк {report.rows}, добавлено {report.inserted}, '
+          f'пропущено {report.skipped} (уже есть или повторяются), с ошибками {report.invalid}',
+          'warning' if report.invalid else 'success')
+    if report.errors:
+        flash('Строки с ошибками: ' + '; '.join(f'{line}: {reason}' for line, reason in report.errors)
+              + (' …' if report.invalid > len(report.errors) else ''), 'warning')
+    return redirect(url_for(endpoint))
+
+@app.route('/whitelist/import', methods=['POST'])
+@login_required
+def import_whitelist_file():
+    return import_upload(import_whitelist, 'whitelist')
+
+@app.route('/users/import', methods=['POST'])
+@login_required
+def import_users_file():
+    return import_upload(import_users, 'users')
+
 @app.route('/delete_whitelist/<int:entry_id>')
 @login_required
 def delete_whitelist(entry_id):
@@ -160,6 +375,7 @@ def delete_whitelist(entry_id):
         if entry:
             db.delete(entry)
             db.commit()
+            access_cache.invalidate(entry.telegram_id)
             flash('Запись успешно удалена из белого списка', 'success')
         else:
             flash('Запись не найдена', 'error')
@@ -172,22 +388,34 @@ def delete_whitelist(entry_id):
 def subscriptions():
     try:
         db = next(get_db())
-        today = datetime.now().date()
-        tomorrow = today + timedelta(days=1)
-        
-        payments_today = db.query(Subscription).filter(
-            Subscription.start_date >= today,
-            Subscription.start_date < tomorrow
-        ).all()
-        
-        ending_today = db.query(Subscription).filter(
-            Subscription.end_date >= today,
-            Subscription.end_date < tomorrow
-        ).all()
-        
-        return render_template('subscriptions.html', 
-                             payments_today=payments_today,
-                             ending_today=ending_today)
+        today = utc_today()
+        day = parse_date(request.args.get('day')) or today
+        date_to = parse_date(request.args.get('to')) or today
+        date_from = parse_date(request.args.get('from')) or date_to - timedelta(days=29)
+
+        # Сводка за период читается из subscription_daily_stats: одна строка на день
+        stats = db.query(SubscriptionDailyStats).filter(
+            SubscriptionDailyStats.day >= date_from,
+            SubscriptionDailyStats.day <= date_to
+        ).order_by(SubscriptionDailyStats.day.desc()).all()
+        totals = {column: sum(getattr(row, column) for row in stats)
+                  for column in ('new_payments', 'payment_total', 'expirations', 'auto_renewal_disabled', 'promo_uses')}
+
+        # Детализация за выбранный день; пользователи подгружаются тем же запросом
+        next_day = day + timedelta(days=1)
+        paid_today = db.scalars(queries.subscriptions_started_between(day, next_day)
+                                .options(joinedload(Subscription.user))).all()
+        ending_today = db.scalars(queries.subscriptions_ending_between(day, next_day)
+                                  .options(joinedload(Subscription.user))).all()
+
+        return render_template('subscriptions.html',
+                             paid_today=paid_today,
+                             ending_today=ending_today,
+                             day=day,
+                             stats=stats,
+                             totals=totals,
+                             date_from=date_from,
+                             date_to=date_to)
     except Exception as e:
         flash(f'Ошибка при получении информации о подписках: {str(e)}', 'error')
         return redirect(url_for('index'))
@@ -197,90 +425,107 @@ def subscriptions():
 def broadcast_page():
     try:
         db = next(get_db())
-        users = db.query(User).filter(User.telegram_id.isnot(None)).all()
-        return render_template('broadcast.html', users=users)
+        jobs = db.query(BroadcastJob).order_by(BroadcastJob.id.desc()).limit(20).all()
+        return render_template('broadcast.html', jobs=jobs)
     except Exception as e:
         flash(f'Ошибка при загрузке страницы рассылки: {str(e)}', 'error')
         return redirect(url_for('index'))
 
-async def send_message_async(user_id, text):
-    try:
-        logger.debug(f"Попытка отправить сообщение пользователю {user_id}")
-        await bot.send_message(user_id, text)
-        logger.info(f"Сообщение успешно отправлено пользователю {user_id}")
-        return True, None
-    except Exception as e:
-        logger.error(f"Ошибка при отправке сообщения пользователю {user_id}: {e}")
-        return False, str(e)
+def broadcast_job_status(job):
+    return {
+        'id': job.id,
+        'status': job.status,
+        'target': job.target,
+        'total': job.total_count,
+        'sent': job.sent_count,
+        'failed': job.failed_count,
+        'enumeration_done': job.enumeration_done,
+        'created_at': job.created_at.isoformat() if job.created_at else None,
+        'started_at': job.started_at.isoformat() if job.started_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+    }
 
 @app.route('/send_broadcast', methods=['POST'])
 @login_required
 def send_broadcast():
-    if bot is None:
-        logger.error("Бот не инициализирован. Рассылка невозможна.")
-        flash('Ошибка: Бот не инициализирован.', 'error')
-        return redirect(url_for('broadcast_page'))
-
     try:
-        message = request.form.get('message_text')
+        message = (request.form.get('message_text') or '').strip()
+        media_file = request.files.get('media_file')
         broadcast_type = request.form.get('broadcast_type')
         selected_user_form_id = request.form.get('selected_user_id')
 
         message_log = f"{message[:20]}..." if message else "[пустое сообщение]"
         logger.debug(f"Получен запрос на рассылку: тип={broadcast_type}, выбранный пользователь ID={selected_user_form_id}, сообщение='{message_log}'")
 
-        if not message:
-            flash('Введите текст сообщения', 'error')
+        has_media = bool(media_file and media_file.filename)
+        if not message and not has_media:
+            flash('Введите текст сообщения или прикрепите файл', 'error')
+            return redirect(url_for('broadcast_page'))
+        if has_media and not MEDIA_UPLOAD_CHAT_ID:
+            flash('Для рассылки файлов задайте MEDIA_UPLOAD_CHAT_ID', 'error')
+            return redirect(url_for('broadcast_page'))
+        if has_media and len(message) > MAX_CAPTION_LENGTH:
+            flash(f'Подпись к файлу не может быть длиннее {MAX_CAPTION_LENGTH} символов', 'error')
             return redirect(url_for('broadcast_page'))
 
         db = next(get_db())
-        target_users = []
-        logger.debug("Начинаем поиск целевых пользователей...")
-
-        if broadcast_type == 'selected' and selected_user_form_id:
+        selected_user_id = None
+        if broadcast_type == 'selected':
             try:
                 user = db.get(User, int(selected_user_form_id))
-                if user and user.telegram_id:
-                    target_users.append(user)
-                    logger.debug(f"Выбран один пользователь: id={user.id}, telegram_id={user.telegram_id}")
-                elif user:
-                    logger.warning(f"Выбранный пользователь {user.id} не имеет telegram_id.")
-                else:
-                    logger.warning(f"Выбранный пользователь с ID {selected_user_form_id} не найден.")
-            except ValueError:
+            except (TypeError, ValueError):
                 logger.warning(f"Некорректный ID пользователя: {selected_user_form_id}")
-        else:
-            target_users = db.query(User).filter(User.telegram_id.isnot(None)).all()
-            logger.debug(f"Выбраны все пользователи с telegram_id, найдено {len(target_users)}")
-
-        if not target_users:
-            flash('Нет пользователей для рассылки', 'error')
-            return redirect(url_for('broadcast_page'))
-
-        success_count = 0
-        error_count = 0
-        error_messages = []
-
-        for user in target_users:
-            success, error = asyncio.run(send_message_async(user.telegram_id, message))
-            if success:
-                success_count += 1
-            else:
-                error_count += 1
-                error_messages.append(f"Пользователь {user.id}: {error}")
-
-        if error_count > 0:
-            flash(f'Рассылка завершена. Успешно: {success_count}, Ошибок: {error_count}. Подробности: {", ".join(error_messages)}', 'warning')
-        else:
-            flash(f'Рассылка успешно завершена. Отправлено сообщений: {success_count}', 'success')
-
+                user = None
+            if not user or not user.telegram_id:
+                flash('Выбранный пользователь не найден или не имеет telegram_id', 'error')
+                return redirect(url_for('broadcast_page'))
+            selected_user_id = user.id
+        elif broadcast_type not in ('all', 'students'):
+            broadcast_type = 'all'
+
+        media_id = None
+        if has_media:
+            # Файл сохраняется один раз по хешу содержимого; в Telegram он загрузится единожды
+            media_id = store_upload(db, media_file.stream, media_file.filename, media_file.mimetype).id
+
+        # Рассылку выполняет BroadcastRunner в процессе бота; здесь только ставим задачу в очередь
+        job = BroadcastJob(message_text=message, target=broadcast_type,
+                           selected_user_id=selected_user_id, media_id=media_id)
+        db.add(job)
+        db.commit()
+        logger.info(f"Создана задача рассылки #{job.id} (тип={broadcast_type})")
+        flash(f'Рассылка #{job.id} поставлена в очередь', 'success')
         return redirect(url_for('broadcast_page'))
 
     except Exception as e:
-        logger.exception("Ошибка при выполнении рассылки:")
-        flash(f'Ошибка при выполнении рассылки: {str(e)}', 'error')
+        logger.exception("Ошибка при создании рассылки:")
+        flash(f'Ошибка при создании рассылки: {str(e)}', 'error')
         return redirect(url_for('broadcast_page'))
 
+@app.route('/broadcast/jobs/<int:job_id>')
+@login_required
+def broadcast_job(job_id):
+    db = next(get_db())
+    job = db.get(BroadcastJob, job_id)
+    if not job:
+        return jsonify({'error': 'not found'}), 404
+    return jsonify(broadcast_job_status(job))
+
+@app.route('/broadcast/jobs/<int:job_id>/cancel', methods=['POST'])
+@login_required
+def cancel_broadcast_job(job_id):
+    db = next(get_db())
+    updated = db.query(BroadcastJob).filter(
+        BroadcastJob.id == job_id,
+        BroadcastJob.status.in_(('pending', 'running'))
+    ).update({BroadcastJob.status: 'cancelled', BroadcastJob.finished_at: datetime.utcnow()}, synchronize_session=False)
+    db.commit()
+    if updated:
+        flash(f'Рассылка #{job_id} отменена', 'success')
+    else:
+        flash(f'Рассылку #{job_id} нельзя отменить', 'error')
+    return redirect(url_for('broadcast_page'))
+
 # Новый маршрут для активации/деактивации пользователя
 @app.route('/toggle_user_active/<int:user_id>', methods=['POST'])
 @login_required
@@ -292,6 +537,7 @@ def toggle_user_active(user_id):
         if user:
             user.is_active = not user.is_active
             db.commit()
+            access_cache.invalidate(user.telegram_id)
             status = "активирован" if user.is_active else "деактивирован"
             flash(f'Пользователь {user.telegram_id or user.email} успешно {status}.', 'success')
             logger.info(f"Статус активности пользователя {user_id} изменен на {user.is_active}")
@@ -327,6 +573,8 @@ def add_promocode():
         )
         db.add(promo)
         db.commit()
+        # Бот кэширует коды в верхнем регистре, в том числе отсутствующие
+        promo_cache.invalidate(code.upper())
         flash('Промокод успешно добавлен', 'success')
     except Exception as e:
         db.rollback()
@@ -345,6 +593,7 @@ def toggle_promocode(promo_id):
         if promo:
             promo.is_active = not promo.is_active
             db.commit()
+            promo_cache.invalidate(promo.code.upper())
             flash('Статус промокода успешно изменен', 'success')
         else:
             flash('Промокод не найден', 'danger')
@@ -357,11 +606,142 @@ def toggle_promocode(promo_id):
     return redirect(url_for('promocodes'))
 
 @app.route('/referrals')
+@login_required
 def referrals():
-    if 'admin_id' not in session:
-        return redirect(url_for('login'))
-    referrals = Referral.query.all()
-    return render_template('referrals.html', referrals=referrals)
+    db = SessionLocal()
+    try:
+        # Счетчики поддерживает бот при записи рефералов, поэтому рейтинг не агрегирует таблицу referrals
+        leaders = db.execute(queries.referral_leaderboard(REFERRAL_LEADERBOARD_SIZE)).all()
+        recent = (db.query(Referral)
+                  .options(joinedload(Referral.referrer), joinedload(Referral.referred_user))
+                  .order_by(Referral.id.desc())
+                  .limit(REFERRAL_LEADERBOARD_SIZE)
+                  .all())
+    finally:
+        db.close()
+    return render_template('referrals.html', leaders=leaders, recent=recent)
+
+def bump_catalog_version(db):
+    # Бот перечитывает каталог, только когда меняется версия
+    db.execute(update(CatalogState).where(CatalogState.id == 1).values(version=CatalogState.version + 1))
+
+@app.route('/messages')
+@login_required
+def messages():
+    db = SessionLocal()
+    try:
+        state = db.get(CatalogState, 1)
+        overrides = {row.key: row for row in db.query(CatalogMessage).all()}
+    finally:
+        db.close()
+    entries = []
+    for key, default in DEFAULT_MESSAGES.items():
+        row = overrides.get(key)
+        entries.append({
+            "key": key,
+            "title": default.title,
+            "fields": default.fields,
+            "overridden": row is not None,
+            "text": row.text if row else default.text,
+            "parse_mode": row.parse_mode if row else default.parse_mode,
+            "disable_web_page_preview": row.disable_web_page_preview if row else default.disable_web_page_preview,
+            "keyboard": row.keyboard if row else dump_keyboard(default.keyboard),
+        })
+    return render_template('messages.html', entries=entries, state=state, parse_modes=PARSE_MODES,
+                           placeholders=sorted(variables(0)) + ["tariff"], default_price=SUBSCRIPTION_PRICE)
+
+@app.route('/messages/price', methods=['POST'])
+@login_required
+def update_price():
+    raw = request.form.get('price', '').strip()
+    if raw and (not raw.isdigit() or int(raw) <= 0):
+        flash('Цена должна быть положительным целым числом', 'danger')
+        return redirect(url_for('messages'))
+    db = SessionLocal()
+    try:
+        db.execute(update(CatalogState).where(CatalogState.id == 1).values(price=int(raw) if raw else None))
+        bump_catalog_version(db)
+        db.commit()
+        logger.info(f"Цена подписки изменена на {raw or 'значение по умолчанию'}")
+        flash('Цена обновлена', 'success')
+    except Exception as e:
+        db.rollback()
+        flash(f'Ошибка при обновлении цены: {str(e)}', 'danger')
+    finally:
+        db.close()
+    return redirect(url_for('messages'))
+
+@app.route('/messages/<key>', methods=['POST'])
+@login_required
+def update_message(key):
+    default = DEFAULT_MESSAGES.get(key)
+    if default is None:
+        flash('Сообщение не найдено', 'danger')
+        return redirect(url_for('messages'))
+    message_text = request.form.get('text', '').replace('\r\n', '\n')
+    parse_mode = request.form.get('parse_mode') or None
+    disable_web_page_preview = bool(request.form.get('disable_web_page_preview'))
+    keyboard = request.form.get('keyboard', '').strip()
+    try:
+        # Проверяем так же, как бот будет собирать сообщение
+        render(message_text, parse_mode, disable_web_page_preview, parse_keyboard(keyboard), default.fields,
+               {**variables(SUBSCRIPTION_PRICE), "tariff": ""})
+    except KeyError as e:
+        flash(f'Неизвестная подстановка {e} в сообщении "{default.title}"', 'danger')
+        return redirect(url_for('messages'))
+    except (ValueError, IndexError, TypeError) as e:
+        flash(f'Ошибка в сообщении "{default.title}": {str(e)}', 'danger')
+        return redirect(url_for('messages'))
+
+    db = SessionLocal()
+    try:
+        row = db.get(CatalogMessage, key) or CatalogMessage(key=key)
+        row.text = message_text
+        row.parse_mode = parse_mode
+        row.disable_web_page_preview = disable_web_page_preview
+        row.keyboard = keyboard or None
+        row.updated_at = datetime.utcnow()
+        db.add(row)
+        bump_catalog_version(db)
+        db.commit()
+        logger.info(f"Сообщение {key} изменено")
+        flash(f'Сообщение "{default.title}" сохранено', 'success')
+    except Exception as e:
+        db.rollback()
+        flash(f'Ошибка при сохранении сообщения: {str(e)}', 'danger')
+    finally:
+        db.close()
+    return redirect(url_for('messages'))
+
+@app.route('/messages/<key>/reset', methods=['POST'])
+@login_required
+def reset_message(key):
+    db = SessionLocal()
+    try:
+        row = db.get(CatalogMessage, key)
+        if row:
+            db.delete(row)
+            bump_catalog_version(db)
+            db.commit()
+            logger.info(f"Сообщение {key} сброшено к стандартному тексту")
+        flash('Восстановлен стандартный текст', 'success')
+    except Exception as e:
+        db.rollback()
+        flash(f'Ошибка при сбросе сообщения: {str(e)}', 'danger')
+    finally:
+        db.close()
+    return redirect(url_for('messages'))
+
+@app.route('/sql-profile')
+@login_required
+def sql_profile():
+    # Сводка отчетов SQL_PROFILE: повторяющиеся запросы (N+1), медленные запросы и полные сканы
+    kind = request.args.get('type', '')
+    rows = summarize(read_reports(SQL_PROFILE_PATH))
+    if kind:
+        rows = [row for row in rows if row['type'] == kind]
+    return render_template('sql_profile.html', rows=rows[:200], total=len(rows), kind=kind,
+                           enabled=sql_profiler is not None, path=SQL_PROFILE_PATH)
 
 @app.route('/create_promo_code', methods=['POST'])
 def create_promo_code():
@@ -0,0 +1,91 @@
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from hypercorn.middleware import AsyncioWSGIMiddleware
+
+MAX_BODY_SIZE = 2 ** 20
+WSGI_MAX_BODY_SIZE = 16 * 2 ** 20
+
+
+async def read_body(receive, limit: int = MAX_BODY_SIZE) -> bytes | None:
+    body = bytearray()
+    while True:
+        message = await receive()
+        body.extend(message.get("body", b""))
+        if len(body) > limit:
+            return None
+        if not message.get("more_body"):
+            return bytes(body)
+
+
+async def send_response(send, status: int, body: bytes = b"", content_type: str = "text/plain; charset=utf-8"):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", content_type.encode()), (b"content-length", str(len(body)).encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def send_json(send, status: int, payload) -> None:
+    await send_response(send, status, json.dumps(payload).encode(), "application/json")
+
+
+def get_header(scope, name: bytes) -> bytes | None:
+    for key, value in scope.get("headers", []):
+        if key == name:
+            return value
+    return None
+
+
+class Router:
+    def __init__(self, fallback):
+        self.fallback = fallback
+        self.routes = []
+
+    def mount(self, prefix: str, app) -> None:
+        self.routes.append((prefix.rstrip("/"), app))
+        self.routes.sort(key=lambda route: len(route[0]), reverse=True)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    await send({"type": "lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+
+        path = scope.get("path", "")
+        for prefix, app in self.routes:
+            if path == prefix or path.startswith(prefix + "/"):
+                return await app(scope, receive, send)
+        return await self.fallback(scope, receive, send)
+
+
+async def not_found(scope, receive, send):
+    if scope["type"] == "http":
+        await send_response(send, 404)
+
+
+# Same as hypercorn's middleware, but requests run on a pool of their own
+# instead of the loop's default executor shared with everything else
+class ThreadPoolWSGIMiddleware(AsyncioWSGIMiddleware):
+    def __init__(self, app, threads: int, max_body_size: int = WSGI_MAX_BODY_SIZE):
+        super().__init__(app, max_body_size=max_body_size)
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="wsgi")
+
+    async def __call__(self, scope, receive, send):
+        loop = asyncio.get_running_loop()
+
+        def _call_soon(func, *args):
+            return asyncio.run_coroutine_threadsafe(func(*args), loop).result()
+
+        await self.wsgi_app(scope, receive, send, partial(loop.run_in_executor, self.executor), _call_soon)
+
+
+def wsgi(app, threads: int):
+    return ThreadPoolWSGIMiddleware(app, threads)
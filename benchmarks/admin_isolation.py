@@ -0,0 +1,233 @@
+"""Bot latency while the admin panel renders /users over a large table.
+
+Feeds updates through bot.dp at a fixed rate and records how long each one
+takes, first with no admin traffic, then while other processes keep
+requesting /users from the admin panel served in a thread pool (ADMIN_MODE=
+thread) and from a child process (ADMIN_MODE=process).
+
+    python benchmarks/admin_isolation.py --users 20000 --duration 15
+"""
+import argparse
+import asyncio
+import datetime
+import http.cookiejar
+import logging
+import multiprocessing
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def quiet():
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.disable(logging.INFO)
+
+
+def serve_admin(bind: str, invalidations) -> None:
+    import run
+    quiet()
+    run.admin_process_main(bind, invalidations)
+
+
+def request_users(base_url: str, stop_at: float, results) -> None:
+    from config import ADMIN_USERNAME, ADMIN_PASSWORD
+
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+    login = urllib.parse.urlencode({"username": ADMIN_USERNAME, "password": ADMIN_PASSWORD}).encode()
+    done, timings = 0, []
+    try:
+        opener.open(base_url + "/login", login).read()
+        while time.time() < stop_at:
+            started = time.perf_counter()
+            opener.open(base_url + "/users").read()
+            timings.append(time.perf_counter() - started)
+            done += 1
+    finally:
+        results.put((done, timings))
+
+
+def admin_load(base_url: str, clients: int, stop_at: float, results) -> None:
+    threads = [threading.Thread(target=request_users, args=(base_url, stop_at, results)) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def wait_for_port(port: int, timeout: float = 30) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Admin panel did not start on port {port}")
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def seed(users: int) -> None:
+    from sqlalchemy import insert
+    from models import SessionLocal, User, Subscription, Whitelist, init_db
+
+    init_db()
+    now = datetime.datetime.now(datetime.timezone.utc)
+    db = SessionLocal()
+    if db.query(User).count() >= users:
+        return
+    batch = 5000
+    for start in range(1, users + 1, batch):
+        ids = range(start, min(start + batch, users + 1))
+        db.execute(insert(User), [{"telegram_id": 10_000 + i, "email": f"user{i}@example.com",
+                                   "telegram_username": f"user{i}", "is_active": True} for i in ids])
+    db.execute(insert(Subscription), [{"user_id": i, "start_date": now, "end_date": now + datetime.timedelta(days=30),
+                                       "auto_renewal": True} for i in range(1, users + 1, 3)])
+    db.add(Whitelist(telegram_id=10_001))
+    db.commit()
+    db.close()
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+async def probe(dispatcher, bot, rate: float, duration: float) -> list[float]:
+    from aiogram import types
+
+    latencies = []
+    interval = 1 / rate
+    deadline = time.perf_counter() + duration
+    update_id = 0
+    while time.perf_counter() < deadline:
+        update_id += 1
+        update = types.Update(update_id=update_id, message=types.Message(
+            message_id=update_id, date=datetime.datetime.now(),
+            chat=types.Chat(id=10_001, type="private"),
+            from_user=types.User(id=10_001, is_bot=False, first_name="bench"),
+            text="👤 Мой аккаунт"))
+        started = time.perf_counter()
+        await dispatcher.feed_update(bot, update)
+        elapsed = time.perf_counter() - started
+        latencies.append(elapsed)
+        await asyncio.sleep(max(0.0, interval - elapsed))
+    return latencies
+
+
+async def run_phase(name: str, args, dispatcher, bot) -> dict:
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config
+
+    context = multiprocessing.get_context("spawn")
+    port = free_port()
+    server, shutdown, admin_process = None, asyncio.Event(), None
+    if name == "thread":
+        from admin_panel.app import app
+        from asgi import Router, wsgi
+
+        config = Config()
+        config.bind = [f"127.0.0.1:{port}"]
+        server = asyncio.create_task(serve(Router(wsgi(app, args.threads)), config, shutdown_trigger=shutdown.wait))
+    elif name == "process":
+        invalidations = context.Queue()
+        admin_process = context.Process(target=serve_admin, args=(f"127.0.0.1:{port}", invalidations), daemon=True)
+        admin_process.start()
+
+    results, loaders = context.Queue(), []
+    if server is not None or admin_process is not None:
+        await asyncio.get_running_loop().run_in_executor(None, wait_for_port, port)
+        stop_at = time.time() + args.duration
+        for _ in range(args.loaders):
+            loader = context.Process(target=admin_load, args=(f"http://127.0.0.1:{port}", args.clients, stop_at, results))
+            loader.start()
+            loaders.append(loader)
+
+    latencies = await probe(dispatcher, bot, args.rate, args.duration)
+
+    # In the thread phase the admin panel is served by this loop, so wait off-loop
+    loop = asyncio.get_running_loop()
+    pages, page_times = 0, []
+    for _ in range(len(loaders) * args.clients):
+        done, timings = await loop.run_in_executor(None, results.get)
+        pages += done
+        page_times.extend(timings)
+    for loader in loaders:
+        await loop.run_in_executor(None, loader.join)
+    if server is not None:
+        shutdown.set()
+        await server
+    if admin_process is not None:
+        admin_process.terminate()
+        admin_process.join()
+
+    return {
+        "phase": name,
+        "updates": len(latencies),
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "max_ms": max(latencies) * 1000,
+        "admin_pages": pages,
+        "admin_page_ms": statistics.median(page_times) * 1000 if page_times else 0.0,
+    }
+
+
+async def main(args) -> None:
+    from aiogram import Bot
+    from aiogram.client.session.base import BaseSession
+    from aiogram.types import Chat, Message
+
+    class NullSession(BaseSession):
+        async def make_request(self, bot, method, timeout=None):
+            if "Message" in str(method.__returning__):
+                return Message(message_id=1, date=datetime.datetime.now(), chat=Chat(id=1, type="private"))
+            return True
+
+        async def stream_content(self, *args, **kwargs):
+            yield b""
+
+        async def close(self):
+            pass
+
+    seed(args.users)
+    import bot as bot_module
+    quiet()
+
+    bot = Bot(token="1:benchmark", session=NullSession())
+    rows = [await run_phase(name, args, bot_module.dp, bot) for name in args.phases]
+    print(f"{'phase':<10}{'updates':>9}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}{'/users':>9}{'page ms':>10}")
+    for row in rows:
+        print(f"{row['phase']:<10}{row['updates']:>9}{row['p50_ms']:>10.2f}{row['p99_ms']:>10.2f}"
+              f"{row['max_ms']:>10.2f}{row['admin_pages']:>9}{row['admin_page_ms']:>10.0f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--duration", type=float, default=15)
+    parser.add_argument("--rate", type=float, default=100, help="bot updates per second")
+    parser.add_argument("--loaders", type=int, default=1, help="processes requesting /users")
+    parser.add_argument("--clients", type=int, default=2, help="concurrent requests per loader")
+    parser.add_argument("--threads", type=int, default=8, help="admin thread pool size")
+    parser.add_argument("--phases", nargs="+", default=["idle", "thread", "process"],
+                        choices=["idle", "thread", "process"])
+    parser.add_argument("--database-url", help="defaults to a throwaway SQLite file")
+    args = parser.parse_args()
+    if args.database_url:
+        os.environ["DATABASE_URL"] = args.database_url
+    else:
+        os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db")
+    asyncio.run(main(args))
@@ -0,0 +1,258 @@
+"""Admin panel routes under concurrent load as the tables grow.
+
+Seeds users (with subscriptions, whitelist entries and broadcast jobs in
+proportion) to each of --sizes in turn, and at every size drives the Flask
+app through its test client from --concurrency threads, each logged in with
+its own session. Per route, size and concurrency it reports latency
+percentiles, SQL statements and DB time per request (from the panel's own
+request metrics) and the peak RSS of the process while the route was under
+load. Finally each route's cost is fitted as fixed + per-row * size; routes
+where the per-row part makes up most of the cost at the largest size do
+work proportional to the table and are flagged.
+
+    python benchmarks/admin_load.py --sizes 10000 100000 1000000 --concurrency 1 8
+    python benchmarks/admin_load.py --routes /whitelist "/users?sort=email" --sizes 20000 200000
+"""
+import argparse
+import datetime
+import os
+import statistics
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import harness
+
+DEFAULT_ROUTES = ("/users", "/users?sort=registration_date&order=asc&active=1", "/subscriptions",
+                  "/whitelist", "/broadcast")
+BROADCAST_JOBS = 40
+SCALING_METRICS = ("p50_ms", "db_ms_per_request", "statements_per_request")
+
+
+def seed(size: int, args) -> dict:
+    from sqlalchemy import func, insert, select
+    from models import BroadcastJob, SessionLocal
+
+    seeded = harness.seed(size, int(size * args.subscribed), int(size * args.whitelisted), promos=20)
+    db = SessionLocal()
+    try:
+        if not db.scalar(select(func.count()).select_from(BroadcastJob)):
+            now = datetime.datetime.utcnow()
+            db.execute(insert(BroadcastJob), [
+                {"message_text": f"Рассылка {n}", "target": "all", "status": "completed", "enumeration_done": True,
+                 "total_count": size, "sent_count": size - n, "failed_count": n, "created_at": now,
+                 "started_at": now, "finished_at": now} for n in range(BROADCAST_JOBS)])
+            db.commit()
+    finally:
+        db.close()
+    return seeded
+
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except OSError:
+        import resource
+        # Peak, not current, outside Linux (kilobytes on Linux, bytes on macOS)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+class RSSSampler:
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.peak = 0.0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self.peak = max(self.peak, rss_mb())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = rss_mb()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def route_rule(app, path: str) -> str:
+    # The url rule the panel's metrics are labelled with
+    rule, _ = app.url_map.bind("localhost").match(path.split("?", 1)[0], return_rule=True)
+    return rule.rule
+
+
+def db_totals(rule: str) -> tuple[int, float, float]:
+    # (requests, statements, seconds) so far for a route, from the admin request metrics
+    from metrics import request_db_seconds, request_db_statements
+
+    statements = request_db_statements.values.get((rule,))
+    seconds = request_db_seconds.values.get((rule,))
+    if statements is None or seconds is None:
+        return 0, 0.0, 0.0
+    return sum(statements[:-1]), statements[-1], seconds[-1]
+
+
+def logged_in_client(app):
+    from config import ADMIN_USERNAME, ADMIN_PASSWORD
+
+    client = app.test_client()
+    response = client.post("/login", data={"username": ADMIN_USERNAME, "password": ADMIN_PASSWORD})
+    if response.status_code != 302:
+        raise RuntimeError("Could not log in to the admin panel with ADMIN_USERNAME/ADMIN_PASSWORD")
+    return client
+
+
+def load(app, path: str, concurrency: int, requests: int) -> dict:
+    local = threading.local()
+    statuses = Counter()
+    latencies = []
+
+    def one(_) -> None:
+        client = getattr(local, "client", None)
+        if client is None:
+            client = local.client = logged_in_client(app)
+        started = time.perf_counter()
+        response = client.get(path)
+        response.get_data()
+        latencies.append(time.perf_counter() - started)
+        statuses[response.status_code] += 1
+
+    rule = route_rule(app, path)
+    before = db_totals(rule)
+    with RSSSampler() as sampler, ThreadPoolExecutor(concurrency) as pool:
+        baseline = sampler.peak
+        started = time.perf_counter()
+        list(pool.map(one, range(requests)))
+        elapsed = time.perf_counter() - started
+    after = db_totals(rule)
+    counted = max(1, after[0] - before[0])
+    return {"requests": requests, "seconds": round(elapsed, 3), "per_second": round(requests / elapsed, 1),
+            **harness.latency_summary(latencies),
+            # Error pages redirect with a flash message, so anything but 200 counts
+            "errors": requests - statuses.get(200, 0),
+            "statements_per_request": round((after[1] - before[1]) / counted, 2),
+            "db_ms_per_request": round((after[2] - before[2]) / counted * 1000, 3),
+            "rss_peak_mb": round(sampler.peak, 1), "rss_growth_mb": round(sampler.peak - baseline, 1)}
+
+
+def size_share(points: list[tuple[int, float]]) -> float | None:
+    # Fits cost = fixed + per_row * size and returns the part of the cost at
+    # the largest size that is per_row * size: ~0 for routes whose cost does
+    # not depend on the table, towards 1 when it is all proportional to it
+    if len(points) < 2:
+        return None
+    mean_size = statistics.fmean(size for size, _ in points)
+    mean_cost = statistics.fmean(cost for _, cost in points)
+    spread = sum((size - mean_size) ** 2 for size, _ in points)
+    largest, cost = max(points)
+    if not spread or cost <= 0:
+        return None
+    per_row = sum((size - mean_size) * (cost - mean_cost) for size, cost in points) / spread
+    return per_row * largest / cost
+
+
+def scaling(rows: list[dict], threshold: float) -> list[dict]:
+    verdicts = []
+    keys = sorted({(row["route"], row["concurrency"]) for row in rows})
+    for route, concurrency in keys:
+        series = [row for row in rows if row["route"] == route and row["concurrency"] == concurrency]
+        shares = {metric: size_share([(row["size"], row[metric]) for row in series]) for metric in SCALING_METRICS}
+        worst = max((value for value in shares.values() if value is not None), default=None)
+        if worst is None:
+            verdict = "n/a"
+        elif worst >= threshold:
+            verdict = "LINEAR"
+        elif worst >= threshold / 2:
+            verdict = "grows"
+        else:
+            verdict = "flat"
+        verdicts.append({"route": route, "concurrency": concurrency, "verdict": verdict,
+                         **{f"share_{metric}": None if value is None else round(value, 2)
+                            for metric, value in shares.items()}})
+    return verdicts
+
+
+def main(args) -> None:
+    from admin_panel import app as app_module
+    harness.quiet()
+    app = app_module.app
+    for path in args.routes:
+        route_rule(app, path)
+
+    rows, seeds = [], []
+    header = (f"{'route':<52}{'users':>9}{'conc':>5}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'sql':>8}"
+              f"{'db ms':>9}{'rss MB':>9}{'err':>6}")
+    for size in sorted(args.sizes):
+        print(f"seeding {size} users...", flush=True)
+        seeds.append(seed(size, args))
+        # Counts are cached per filter set; start every size from a cold cache
+        app_module.user_count_cache.clear()
+        print(header)
+        for path in args.routes:
+            for concurrency in args.concurrency:
+                if args.warmup:
+                    load(app, path, 1, args.warmup)
+                row = {"route": path, "size": size, "concurrency": concurrency,
+                       **load(app, path, concurrency, args.requests)}
+                rows.append(row)
+                print(f"{path:<52}{size:>9}{concurrency:>5}{row['p50_ms']:>10.2f}{row['p95_ms']:>10.2f}"
+                      f"{row['p99_ms']:>10.2f}{row['statements_per_request']:>8.1f}{row['db_ms_per_request']:>9.2f}"
+                      f"{row['rss_peak_mb']:>9.1f}{row['errors']:>6}", flush=True)
+
+    verdicts = scaling(rows, args.linear_threshold)
+    print(f"\nshare of the cost at {max(args.sizes)} users that grows with the table")
+    print(f"{'route':<52}{'conc':>5}{'p50':>8}{'db ms':>8}{'sql':>8}  verdict")
+    for verdict in verdicts:
+        shares = [verdict[f"share_{metric}"] for metric in SCALING_METRICS]
+        print(f"{verdict['route']:<52}{verdict['concurrency']:>5}"
+              + "".join(f"{'-' if share is None else f'{share:.2f}':>8}" for share in shares) + f"  {verdict['verdict']}")
+
+    largest = max(args.sizes)
+    results = {
+        "benchmark": "admin_load",
+        "at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "revision": harness.revision(),
+        "environment": harness.environment(),
+        "args": {key: value for key, value in vars(args).items() if key not in ("compare", "output", "database_url")},
+        "seed": seeds,
+        "rows": rows,
+        "scaling": verdicts,
+        # The largest size by route and concurrency, in the shape --compare expects
+        "handlers": {f"{row['route']} x{row['concurrency']}": row for row in rows if row["size"] == largest},
+    }
+    path = harness.save_results("admin_load", results, args.output)
+    print(f"\nresults: {path}")
+    if args.compare:
+        harness.print_comparison(harness.load_results(args.compare), results,
+                                 ("p50_ms", "p99_ms", "statements_per_request", "db_ms_per_request"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000], help="user counts to grow the tables to")
+    parser.add_argument("--routes", nargs="+", default=list(DEFAULT_ROUTES), help="admin panel paths, query strings allowed")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8], help="client threads")
+    parser.add_argument("--requests", type=int, default=100, help="requests per route, size and concurrency")
+    parser.add_argument("--warmup", type=int, default=3, help="requests per route discarded before measuring")
+    parser.add_argument("--subscribed", type=float, default=0.5, help="subscriptions per user")
+    parser.add_argument("--whitelisted", type=float, default=0.01, help="whitelist entries per user")
+    parser.add_argument("--linear-threshold", type=float, default=0.5,
+                        help="share of the cost growing with table size from which a route is flagged")
+    parser.add_argument("--output", help="results file, defaults to benchmarks/results/admin_load-<time>-<commit>.json")
+    parser.add_argument("--compare", help="earlier results file to compare the largest size against")
+    parser.add_argument("--database-url", help="defaults to a throwaway SQLite file")
+    args = parser.parse_args()
+    harness.use_database(args.database_url)
+    main(args)
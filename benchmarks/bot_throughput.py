@@ -0,0 +1,199 @@
+"""Offline bot throughput: synthetic update streams through dp against a stub Telegram API.
+
+Seeds users, subscriptions, whitelist entries and promo codes, then feeds a
+weighted mix of scenarios through bot.dp with feed_update: main_keyboard
+button presses, inline button callbacks, /start from known users,
+registrations arriving through /start deep links, and promo code entry.
+Updates of one user are fed in order on one lane; lanes run concurrently.
+Outgoing API calls are recorded by a stub session, nothing touches the
+network. Reports updates/s, p50/p95/p99 and SQL statements per handler, and
+writes the results as JSON so runs on different commits can be compared.
+
+    python benchmarks/bot_throughput.py --users 100000 --updates 50000
+    python benchmarks/bot_throughput.py --compare benchmarks/results/bot_throughput-....json
+"""
+import argparse
+import asyncio
+import datetime
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import harness
+
+SCENARIOS = ("button", "callback", "start", "register", "promo")
+DEFAULT_MIX = "button=60,callback=10,start=10,register=10,promo=10"
+CALLBACKS = ("show_subscription", "buy_access", "show_offer", "show_requisites", "process_payment")
+# Telegram ids of users registering during the run, clear of the seeded ones
+NEW_USERS_FROM = 5_000_000_000
+
+
+def parse_mix(mix: str) -> dict[str, int]:
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f"unknown scenario {name.strip()!r}, expected one of {', '.join(SCENARIOS)}")
+        weights[name.strip()] = int(weight or 1)
+    return weights
+
+
+class Traffic:
+    # Sessions are (telegram_id, updates of that user in order); update ids
+    # keep increasing across sessions as they would from Telegram
+    def __init__(self, rng: random.Random, users: int, promos: int, buttons: list[str]):
+        self.rng = rng
+        self.users = users
+        self.promos = promos
+        self.buttons = buttons
+        self.update_id = 0
+        self.registered = 0
+
+    def next_id(self) -> int:
+        self.update_id += 1
+        return self.update_id
+
+    def known_user(self) -> int:
+        return 10_000 + self.rng.randint(1, self.users)
+
+    def session(self, scenario: str) -> tuple[int, list]:
+        if scenario == "button":
+            telegram_id = self.known_user()
+            return telegram_id, [harness.message_update(self.next_id(), telegram_id, self.rng.choice(self.buttons))]
+        if scenario == "callback":
+            telegram_id = self.known_user()
+            return telegram_id, [harness.callback_update(self.next_id(), telegram_id, self.rng.choice(CALLBACKS))]
+        if scenario == "start":
+            telegram_id = self.known_user()
+            return telegram_id, [harness.message_update(self.next_id(), telegram_id, "/start")]
+        if scenario == "register":
+            self.registered += 1
+            telegram_id = NEW_USERS_FROM + self.registered
+            # Half of the newcomers arrive through a referral deep link
+            start = f"/start {self.known_user()}" if self.rng.random() < 0.5 else "/start"
+            return telegram_id, [harness.message_update(self.next_id(), telegram_id, start),
+                                 harness.message_update(self.next_id(), telegram_id, f"new{telegram_id}@example.com")]
+        telegram_id = self.known_user()
+        # One in ten codes is mistyped
+        code = f"BENCH{self.rng.randint(1, self.promos)}" if self.promos and self.rng.random() >= 0.1 else "NOSUCHCODE"
+        return telegram_id, [harness.callback_update(self.next_id(), telegram_id, "enter_promo"),
+                             harness.message_update(self.next_id(), telegram_id, code.lower())]
+
+    def sessions(self, updates: int, mix: dict[str, int]) -> list[tuple[int, list]]:
+        names, weights = list(mix), list(mix.values())
+        sessions, total = [], 0
+        while total < updates:
+            session = self.session(self.rng.choices(names, weights)[0])
+            sessions.append(session)
+            total += len(session[1])
+        return sessions
+
+
+async def feed(samples: harness.UpdateSamples, dispatcher, bot, sessions: list[tuple[int, list]],
+               concurrency: int) -> float:
+    # One lane per telegram_id bucket keeps each user's updates in order
+    lanes: list[list[list]] = [[] for _ in range(concurrency)]
+    for telegram_id, updates in sessions:
+        lanes[telegram_id % concurrency].append(updates)
+
+    async def lane(queue: list[list]) -> None:
+        for updates in queue:
+            for update in updates:
+                await samples.feed(dispatcher, bot, update)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(lane(queue) for queue in lanes if queue))
+    return time.perf_counter() - started
+
+
+async def main(args) -> None:
+    subscriptions = args.users // 2 if args.subscriptions is None else args.subscriptions
+    whitelist = args.users // 100 if args.whitelist is None else args.whitelist
+    seeded = harness.seed(args.users, subscriptions, whitelist, args.promos)
+
+    import bot as bot_module
+    from catalog import message_catalog
+    from models import async_engine
+    harness.quiet()
+
+    await message_catalog.refresh()
+    samples = harness.UpdateSamples(async_engine.sync_engine)
+    bot_module.dp.update.outer_middleware(samples)
+    bot = harness.stub_bot(args.api_latency)
+    buttons = [button.text for row in bot_module.main_keyboard.keyboard for button in row]
+    traffic = Traffic(random.Random(args.seed), args.users, args.promos, buttons)
+
+    if args.warmup:
+        await feed(samples, bot_module.dp, bot, traffic.sessions(args.warmup, args.mix), args.concurrency)
+        await bot_module.storage.flush()
+        await bot_module.referral_recorder.flush()
+        samples.reset()
+        bot.session.calls.clear()
+
+    sessions = traffic.sessions(args.updates, args.mix)
+    elapsed = await feed(samples, bot_module.dp, bot, sessions, args.concurrency)
+    # Write-behind state and referrals are part of the cost, just not of any one update
+    await bot_module.storage.flush()
+    await bot_module.referral_recorder.flush()
+
+    updates = len(samples.samples)
+    charged = sum(sample.statements for sample in samples.samples)
+    api_calls = dict(sorted(bot.session.calls.items()))
+    results = {
+        "benchmark": "bot_throughput",
+        "at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "revision": harness.revision(),
+        "environment": harness.environment(),
+        "args": {key: value for key, value in vars(args).items() if key not in ("compare", "output", "database_url")},
+        "seed": seeded,
+        "updates": updates,
+        "seconds": round(elapsed, 3),
+        "updates_per_second": round(updates / elapsed, 1) if elapsed else 0.0,
+        **harness.latency_summary([sample.seconds for sample in samples.samples]),
+        "errors": sum(1 for sample in samples.samples if sample.failed),
+        "statements_per_update": round(charged / updates, 2) if updates else 0.0,
+        "background_statements": samples.statements - charged,
+        "api_calls": api_calls,
+        "api_calls_per_update": round(sum(api_calls.values()) / updates, 2) if updates else 0.0,
+        "handlers": harness.summarize_samples(samples.samples),
+    }
+
+    await bot_module.referral_recorder.close()
+    await bot_module.storage.close()
+    await async_engine.dispose()
+
+    print(f"{updates} updates in {elapsed:.2f}s: {results['updates_per_second']:.0f} updates/s, "
+          f"p50 {results['p50_ms']:.2f} ms, p99 {results['p99_ms']:.2f} ms, "
+          f"{results['statements_per_update']:.2f} statements/update "
+          f"(+{results['background_statements']} written behind), {results['errors']} errors\n")
+    harness.print_handlers(results["handlers"])
+    print("\napi calls: " + ", ".join(f"{name} {count}" for name, count in api_calls.items()))
+    path = harness.save_results("bot_throughput", results, args.output)
+    print(f"results: {path}")
+    if args.compare:
+        harness.print_comparison(harness.load_results(args.compare), results)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--subscriptions", type=int, help="defaults to half of the users")
+    parser.add_argument("--whitelist", type=int, help="defaults to 1%% of the users")
+    parser.add_argument("--promos", type=int, default=50)
+    parser.add_argument("--updates", type=int, default=20000, help="updates fed in the measured run")
+    parser.add_argument("--warmup", type=int, default=1000, help="updates fed (and discarded) before it")
+    parser.add_argument("--concurrency", type=int, default=32, help="lanes feeding updates at once")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f"scenario weights, default {DEFAULT_MIX}")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="seconds per stubbed Telegram API call")
+    parser.add_argument("--seed", type=int, default=1, help="random seed of the update stream")
+    parser.add_argument("--output", help="results file, defaults to benchmarks/results/bot_throughput-<time>-<commit>.json")
+    parser.add_argument("--compare", help="earlier results file to compare this run against")
+    parser.add_argument("--database-url", help="defaults to a throwaway SQLite file")
+    args = parser.parse_args()
+    harness.use_database(args.database_url)
+    asyncio.run(main(args))
@@ -0,0 +1,298 @@
+"""Shared pieces of the offline benchmarks: seeding, a stub Telegram API and reports.
+
+Import after sys.path holds the project root and DATABASE_URL is set; the
+project modules are imported lazily so the caller picks the database first.
+"""
+import asyncio
+import contextvars
+import datetime
+import json
+import os
+import platform
+import subprocess
+import time
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+SEED_BATCH = 5000
+
+
+def use_database(url: str | None) -> None:
+    import tempfile
+
+    os.environ["DATABASE_URL"] = url or "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db")
+
+
+def quiet() -> None:
+    import logging
+
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.disable(logging.WARNING)
+
+
+def seed(users: int, subscriptions: int, whitelist: int, promos: int) -> dict:
+    # Users get id i and telegram_id 10_000 + i, registered a minute apart.
+    # Subscriptions and whitelist entries are spread evenly over them; a
+    # subscription started up to 30 days ago and every ninth has expired.
+    # Promo codes are BENCH1..BENCHn without a usage limit. An existing
+    # database is grown to `users`, keeping the same spread
+    from sqlalchemy import insert
+    from models import PromoCode, SessionLocal, Subscription, User, Whitelist, engine, init_db, refresh_user_access
+
+    init_db()
+    now = datetime.datetime.now(datetime.timezone.utc)
+    db = SessionLocal()
+    try:
+        existing = db.query(User).count()
+        if existing >= users:
+            return {"users": existing, "seeded": False}
+        started = time.perf_counter()
+        every = max(1, users // subscriptions) if subscriptions else 0
+        step = max(1, users // whitelist) if whitelist else 0
+        for start in range(existing + 1, users + 1, SEED_BATCH):
+            ids = range(start, min(start + SEED_BATCH, users + 1))
+            db.execute(insert(User), [{"telegram_id": 10_000 + i, "email": f"user{i}@example.com",
+                                       "telegram_username": f"user{i}", "is_active": True,
+                                       "registration_date": now - datetime.timedelta(minutes=users - i)} for i in ids])
+            subscribed = [i for i in ids if every and i % every == 0]
+            if subscribed:
+                db.execute(insert(Subscription), [
+                    {"user_id": i, "start_date": now - datetime.timedelta(days=i // every % 31),
+                     "end_date": (now - datetime.timedelta(days=3) if i // every % 9 == 0
+                                  else now + datetime.timedelta(days=30 - i // every % 31)),
+                     "payment_amount": 1500, "auto_renewal": i % 2 == 0} for i in subscribed])
+            listed = [i for i in ids if step and i % step == 1 % step]
+            if listed:
+                db.execute(insert(Whitelist), [{"telegram_id": 10_000 + i} for i in listed])
+        if not existing:
+            db.execute(insert(PromoCode), [{"code": f"BENCH{n}", "discount_percent": 10 + n % 40, "is_active": True,
+                                            "used_count": 0, "max_uses": None} for n in range(1, promos + 1)])
+        db.commit()
+    finally:
+        db.close()
+    with engine.begin() as connection:
+        refresh_user_access(connection)
+    return {"users": users, "seeded": True, "seconds": round(time.perf_counter() - started, 2)}
+
+
+def stub_session(latency: float = 0.0):
+    from aiogram.client.session.base import BaseSession
+    from aiogram.types import Chat, Message
+
+    # Records every outgoing API call by method name instead of sending it;
+    # `latency` seconds per call stand in for the round trip to Telegram
+    class RecordingSession(BaseSession):
+        def __init__(self):
+            super().__init__()
+            self.calls = Counter()
+
+        async def make_request(self, bot, method, timeout=None):
+            self.calls[type(method).__name__] += 1
+            if latency:
+                await asyncio.sleep(latency)
+            if "Message" in str(method.__returning__):
+                chat_id = getattr(method, "chat_id", 1)
+                return Message(message_id=1, date=datetime.datetime.now(),
+                               chat=Chat(id=chat_id if isinstance(chat_id, int) else 1, type="private"))
+            return True
+
+        async def stream_content(self, *args, **kwargs):
+            yield b""
+
+        async def close(self):
+            pass
+
+    return RecordingSession()
+
+
+def stub_bot(latency: float = 0.0):
+    from aiogram import Bot
+
+    return Bot(token="1:benchmark", session=stub_session(latency))
+
+
+def message_update(update_id: int, telegram_id: int, text: str):
+    from aiogram import types
+
+    return types.Update(update_id=update_id, message=types.Message(
+        message_id=update_id, date=datetime.datetime.now(),
+        chat=types.Chat(id=telegram_id, type="private"),
+        from_user=types.User(id=telegram_id, is_bot=False, first_name="bench", username=f"user{telegram_id}"),
+        text=text))
+
+
+def callback_update(update_id: int, telegram_id: int, data: str):
+    from aiogram import types
+
+    user = types.User(id=telegram_id, is_bot=False, first_name="bench", username=f"user{telegram_id}")
+    return types.Update(update_id=update_id, callback_query=types.CallbackQuery(
+        id=str(update_id), from_user=user, chat_instance=str(telegram_id), data=data,
+        message=types.Message(message_id=update_id, date=datetime.datetime.now(),
+                              chat=types.Chat(id=telegram_id, type="private"), text="bench")))
+
+
+class Sample:
+    __slots__ = ("label", "seconds", "waited", "statements", "db_seconds", "failed")
+
+    def __init__(self):
+        self.label = None
+        self.seconds = 0.0
+        self.waited = 0.0
+        self.statements = 0
+        self.db_seconds = 0.0
+        self.failed = False
+
+
+# Times each update fed through feed() and counts every statement it runs,
+# including the FSM state load aiogram does before any project middleware.
+# Added as an outer middleware on dp.update after the metrics one, it picks
+# up the handler name the metrics middleware resolved for that update
+class UpdateSamples:
+    def __init__(self, engine):
+        from sqlalchemy import event
+
+        self.samples: list[Sample] = []
+        # All statements, including write-behind flushes no update is charged for
+        self.statements = 0
+        self._current: contextvars.ContextVar[Sample | None] = contextvars.ContextVar("bench_sample", default=None)
+        event.listen(engine, "before_cursor_execute", self._before)
+        event.listen(engine, "after_cursor_execute", self._after)
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        if self._current.get() is not None:
+            conn.info.setdefault("bench_started", []).append(time.perf_counter())
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements += 1
+        sample = self._current.get()
+        started = conn.info.get("bench_started")
+        if sample is not None and started:
+            sample.statements += 1
+            sample.db_seconds += time.perf_counter() - started.pop()
+
+    async def feed(self, dispatcher, bot, update, arrived: float | None = None) -> None:
+        # With `arrived` (a perf_counter time) latency includes the time the
+        # update waited for its turn, as it would in the webhook queue
+        sample = Sample()
+        token = self._current.set(sample)
+        started = time.perf_counter()
+        if arrived is not None:
+            sample.waited = started - arrived
+        try:
+            await dispatcher.feed_update(bot, update)
+        except Exception:
+            sample.failed = True
+        finally:
+            sample.seconds = time.perf_counter() - (started if arrived is None else arrived)
+            self._current.reset(token)
+            sample.label = sample.label or update.event_type
+            self.samples.append(sample)
+
+    async def __call__(self, handler, event, data):
+        from metrics import db_tally
+
+        try:
+            return await handler(event, data)
+        finally:
+            tally, sample = db_tally.get(), self._current.get()
+            if tally is not None and sample is not None:
+                sample.label = tally.label
+
+    def reset(self) -> None:
+        self.samples.clear()
+        self.statements = 0
+
+
+def latency_summary(values: list[float]) -> dict:
+    if not values:
+        return {"p50_ms": 0.0, "p95_ms": 0.0, "p99_ms": 0.0, "max_ms": 0.0}
+    ordered = sorted(values)
+
+    def ms(fraction: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] * 1000, 3)
+    return {"p50_ms": ms(0.50), "p95_ms": ms(0.95), "p99_ms": ms(0.99), "max_ms": ms(1.0)}
+
+
+def summarize_samples(samples: list[Sample]) -> dict:
+    by_label: dict[str, list[Sample]] = {}
+    for sample in samples:
+        by_label.setdefault(sample.label, []).append(sample)
+    handlers = {}
+    for label, rows in sorted(by_label.items()):
+        handlers[label] = {"updates": len(rows), "errors": sum(1 for row in rows if row.failed),
+                           **latency_summary([row.seconds for row in rows]),
+                           "statements_per_update": round(sum(row.statements for row in rows) / len(rows), 2),
+                           "db_ms_per_update": round(sum(row.db_seconds for row in rows) / len(rows) * 1000, 3)}
+    return handlers
+
+
+def revision() -> dict:
+    def git(*args):
+        try:
+            return subprocess.run(["git", *args], cwd=ROOT, capture_output=True, text=True, timeout=10).stdout.strip()
+        except (OSError, subprocess.SubprocessError):
+            return ""
+    return {"commit": git("rev-parse", "HEAD"), "subject": git("log", "-1", "--format=%s"),
+            "dirty": bool(git("status", "--porcelain", "--untracked-files=no"))}
+
+
+def environment() -> dict:
+    from sqlalchemy import make_url
+
+    url = make_url(os.environ["DATABASE_URL"])
+    return {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count(),
+            "database": url.get_backend_name()}
+
+
+def save_results(name: str, results: dict, path: str | None = None) -> str:
+    if path is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        commit = (results.get("revision") or {}).get("commit", "")[:10] or "unknown"
+        stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        path = os.path.join(RESULTS_DIR, f"{name}-{stamp}-{commit}.json")
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump(results, file, ensure_ascii=False, indent=2)
+    return path
+
+
+def load_results(path: str) -> dict:
+    with open(path, encoding="utf-8") as file:
+        return json.load(file)
+
+
+def print_handlers(handlers: dict) -> None:
+    print(f"{'handler':<34}{'updates':>9}{'err':>6}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}"
+          f"{'sql/upd':>9}{'db ms':>8}")
+    for label, row in handlers.items():
+        print(f"{label:<34}{row['updates']:>9}{row['errors']:>6}{row['p50_ms']:>9.2f}{row['p95_ms']:>9.2f}"
+              f"{row['p99_ms']:>9.2f}{row['max_ms']:>9.2f}{row['statements_per_update']:>9.2f}"
+              f"{row['db_ms_per_update']:>8.2f}")
+
+
+def print_comparison(previous: dict, current: dict, keys: tuple[str, ...] = ("p50_ms", "p99_ms", "statements_per_update")) -> None:
+    # Relative change per handler against an earlier results file; handlers
+    # present in only one of the runs are listed with a dash
+    before = previous.get("revision", {}).get("commit", "")[:10] or "previous"
+    after = current.get("revision", {}).get("commit", "")[:10] or "current"
+    labels = sorted(set(previous.get("handlers", {})) | set(current.get("handlers", {})))
+    width = max([34] + [len(label) + 2 for label in labels])
+    print(f"\n{before} -> {after}")
+    if "updates_per_second" in previous and "updates_per_second" in current:
+        print(f"{'updates/s':<{width}}{previous['updates_per_second']:>12.1f}{current['updates_per_second']:>12.1f}"
+              f"{change(previous['updates_per_second'], current['updates_per_second']):>10}")
+    for key in keys:
+        print(f"\n{key:<{width}}{before:>12}{after:>12}{'change':>10}")
+        for label in labels:
+            old = previous.get("handlers", {}).get(label, {}).get(key)
+            new = current.get("handlers", {}).get(label, {}).get(key)
+            print(f"{label:<{width}}{'-' if old is None else f'{old:.2f}':>12}{'-' if new is None else f'{new:.2f}':>12}"
+                  f"{change(old, new):>10}")
+
+
+def change(old, new) -> str:
+    if old is None or new is None:
+        return "-"
+    if not old:
+        return "0%" if not new else "new"
+    return f"{(new - old) / old * 100:+.1f}%"
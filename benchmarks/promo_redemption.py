@@ -0,0 +1,114 @@
+"""Redeem one hot promo code from many users at once.
+
+Several processes, each with its own PromoRedeemer (as with sharded
+workers), redeem the same code for distinct users, and some users enter it
+twice. Afterwards used_count must equal the number of redemption rows and
+never exceed max_uses.
+
+    python benchmarks/promo_redemption.py --users 20000 --max-uses 15000 --processes 4
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+CODE = "BLAST"
+
+
+def seed(users: int, max_uses: int) -> None:
+    from sqlalchemy import insert
+    from models import PromoCode, SessionLocal, User, init_db
+
+    init_db()
+    db = SessionLocal()
+    for start in range(1, users + 1, 5000):
+        db.execute(insert(User), [{"telegram_id": 10_000 + i, "email": f"user{i}@example.com", "is_active": True}
+                                  for i in range(start, min(start + 5000, users + 1))])
+    db.add(PromoCode(code=CODE, discount_percent=20, max_uses=max_uses, used_count=0))
+    db.commit()
+    db.close()
+
+
+async def redeem_all(user_ids: list[int], concurrency: int) -> tuple[dict, float]:
+    from promo import PromoRedeemer, active_promo
+
+    logging.disable(logging.WARNING)
+    redeemer = PromoRedeemer()
+    semaphore = asyncio.Semaphore(concurrency)
+    outcomes: dict[str, int] = {}
+
+    async def one(user_id: int) -> None:
+        async with semaphore:
+            promo = await active_promo(CODE)
+            outcome = await redeemer.redeem(promo, user_id)
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(user_id) for user_id in user_ids))
+    return outcomes, time.perf_counter() - started
+
+
+def worker(user_ids: list[int], concurrency: int, results) -> None:
+    results.put(asyncio.run(redeem_all(user_ids, concurrency)))
+
+
+def main(args) -> None:
+    from sqlalchemy import func, select
+    from models import PromoCode, PromoRedemption, SessionLocal
+
+    seed(args.users, args.max_uses)
+    user_ids = list(range(1, args.users + 1))
+    # Every tenth user enters the code twice
+    user_ids += user_ids[::10]
+
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    processes = [context.Process(target=worker, args=(user_ids[index::args.processes], args.concurrency, results))
+                 for index in range(args.processes)]
+    started = time.perf_counter()
+    for process in processes:
+        process.start()
+    collected = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    elapsed = time.perf_counter() - started
+
+    totals: dict[str, int] = {}
+    for outcomes, _ in collected:
+        for outcome, count in outcomes.items():
+            totals[outcome] = totals.get(outcome, 0) + count
+    db = SessionLocal()
+    used = db.scalar(select(PromoCode.used_count).where(PromoCode.code == CODE))
+    rows = db.scalar(select(func.count()).select_from(PromoRedemption))
+    db.close()
+
+    print(f"{len(user_ids)} attempts from {args.processes} processes in {elapsed:.2f}s "
+          f"({len(user_ids) / elapsed:.0f} attempts/s)")
+    print("outcomes: " + ", ".join(f"{outcome} {count}" for outcome, count in sorted(totals.items())))
+    print(f"used_count {used}, redemption rows {rows}, max_uses {args.max_uses}")
+    if used != rows or used > args.max_uses or totals.get("redeemed", 0) != used:
+        print("MISMATCH: the code was oversold or lost uses")
+        sys.exit(1)
+    print("ok: no overselling")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--max-uses", type=int, default=15000)
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--concurrency", type=int, default=500, help="redemptions in flight per process")
+    parser.add_argument("--database-url", help="defaults to a throwaway SQLite file")
+    args = parser.parse_args()
+    if args.database_url:
+        os.environ["DATABASE_URL"] = args.database_url
+    else:
+        os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db")
+    main(args)
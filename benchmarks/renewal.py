@@ -0,0 +1,113 @@
+"""Renew a large batch of due subscriptions against the fake payment provider.
+
+Seeds users whose subscriptions all fall due in one renewal window, then runs
+several RenewalRunner passes concurrently against one FakeProvider. Some
+charges fail before reaching the provider and some lose their response after
+the money was taken, so retries have to reuse the first charge. Afterwards
+every due subscription must have exactly one renewal row and exactly one
+charge.
+
+    python benchmarks/renewal.py --subscriptions 100000 --runners 2
+"""
+import argparse
+import asyncio
+import datetime
+import logging
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def seed(count: int, now: datetime.datetime) -> None:
+    from sqlalchemy import insert
+    from models import SessionLocal, Subscription, User, engine, init_db, refresh_user_access
+
+    init_db()
+    db = SessionLocal()
+    if db.query(User).count() >= count:
+        return
+    batch = 5000
+    for start in range(1, count + 1, batch):
+        ids = range(start, min(start + batch, count + 1))
+        db.execute(insert(User), [{"telegram_id": 10_000 + i, "email": f"user{i}@example.com", "is_active": True}
+                                  for i in ids])
+        # Spread over the window: some ended an hour ago, the rest end within the next 20 hours
+        db.execute(insert(Subscription), [{"user_id": i, "start_date": now - datetime.timedelta(days=30),
+                                           "end_date": now + datetime.timedelta(seconds=(i * 7919) % 75600 - 3600),
+                                           "payment_amount": 1500, "auto_renewal": i % 10 != 0} for i in ids])
+    db.commit()
+    db.close()
+    with engine.begin() as connection:
+        refresh_user_access(connection)
+
+
+async def renewal_pass(runners, now) -> list[dict]:
+    return await asyncio.gather(*(runner.renew_due(now) for runner in runners))
+
+
+async def main(args) -> None:
+    from sqlalchemy import func, select
+    from database import get_async_db
+    from models import Subscription
+    from payments import FakeProvider
+    from renewal import RenewalRunner
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    seed(args.subscriptions, now)
+    logging.disable(logging.WARNING)
+
+    provider = FakeProvider(latency=args.latency, decline_rate=args.decline_rate,
+                            error_rate=args.error_rate, lost_rate=args.lost_rate)
+    runners = [RenewalRunner(provider, chunk_size=args.chunk_size, concurrency=args.concurrency)
+               for _ in range(args.runners)]
+
+    print(f"{'pass':<6}{'seconds':>9}{'renewed':>10}{'declined':>10}{'retry':>8}{'renewals/s':>12}")
+    for number in range(1, args.passes + 1):
+        started = time.perf_counter()
+        results = await renewal_pass(runners, now)
+        elapsed = time.perf_counter() - started
+        renewed = sum(result["renewed"] for result in results)
+        declined = sum(result["declined"] for result in results)
+        failed = sum(result["failed"] for result in results)
+        print(f"{number:<6}{elapsed:>9.2f}{renewed:>10}{declined:>10}{failed:>8}{renewed / elapsed:>12.0f}")
+        if not renewed and not failed:
+            break
+        provider.error_rate = provider.lost_rate = 0.0
+
+    async with get_async_db() as db:
+        rows = await db.scalar(select(func.count()).select_from(Subscription)
+                               .where(Subscription.payment_id.like("renewal-%")))
+        distinct = await db.scalar(select(func.count(func.distinct(Subscription.user_id)))
+                                   .where(Subscription.payment_id.like("renewal-%")))
+    charged = len(provider.charges)
+    print(f"\nprovider calls {provider.calls}, replayed {provider.replayed}, charges {charged}, "
+          f"declined {provider.declined}, errors {provider.errors}")
+    print(f"renewal rows {rows} for {distinct} users")
+    if rows != charged or distinct != rows:
+        print("MISMATCH: renewals and charges differ")
+        sys.exit(1)
+    print("ok: one charge and one renewal row per renewed subscription")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--subscriptions", type=int, default=100000)
+    parser.add_argument("--runners", type=int, default=2, help="renewal runners sharing the provider")
+    parser.add_argument("--passes", type=int, default=3)
+    parser.add_argument("--chunk-size", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=50, help="provider calls in flight per runner")
+    parser.add_argument("--latency", type=float, default=0.05, help="mean provider latency, seconds")
+    parser.add_argument("--decline-rate", type=float, default=0.02)
+    parser.add_argument("--error-rate", type=float, default=0.01, help="failures before the charge (first pass)")
+    parser.add_argument("--lost-rate", type=float, default=0.01, help="charges whose response is lost (first pass)")
+    parser.add_argument("--database-url", help="defaults to a throwaway SQLite file")
+    args = parser.parse_args()
+    if args.database_url:
+        os.environ["DATABASE_URL"] = args.database_url
+    else:
+        os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db")
+    asyncio.run(main(args))
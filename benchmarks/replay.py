@@ -0,0 +1,248 @@
+"""Replay recorded production updates through dp against a stub Telegram API.
+
+Reads the files the bot writes with UPDATE_RECORD=true (see recorder.py),
+seeds a database with the users in them, and feeds the updates back through
+bot.dp at the recorded pace (--speed 1), N times faster (--speed N) or as
+fast as possible (--speed 0). Each user's updates are handled in order, at
+most --concurrency at once as in the webhook queue. Latency runs from an
+update's scheduled arrival, so bursts show up as queueing; at --speed 0 it
+is handling time only. Results are written as JSON; --compare diffs them
+against a run of the same recording on another release.
+
+Users who send an email address in the recording register during it and are
+not seeded; a share of the others get a subscription (--subscribed) or a
+whitelist entry (--whitelisted). Codes typed after "enter_promo" are seeded
+as active promo codes.
+
+    python benchmarks/replay.py recordings/ --speed 1
+    python benchmarks/replay.py recordings/updates-20261017-*.jsonl.gz --speed 10 \\
+        --compare benchmarks/results/replay-....json
+"""
+import argparse
+import asyncio
+import datetime
+import itertools
+import os
+import sys
+import time
+from collections import Counter, deque
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import harness
+
+REPLAYED = ("message", "callback_query")
+
+
+def load(paths: list[str], limit: int | None) -> list[dict]:
+    from recorder import read_recording
+
+    entries = (entry for entry in read_recording(paths) if entry.get("type") in REPLAYED and "user" in entry)
+    return list(itertools.islice(entries, limit))
+
+
+def analyse(entries: list[dict]) -> dict:
+    users, registering, promo_codes = set(), set(), set()
+    awaiting_code = set()
+    for entry in entries:
+        user = entry["user"]
+        users.add(user)
+        text = entry.get("text")
+        if entry["type"] == "callback_query":
+            if entry.get("data") == "enter_promo":
+                awaiting_code.add(user)
+            continue
+        if text and "@" in text:
+            registering.add(user)
+        if user in awaiting_code:
+            awaiting_code.discard(user)
+            if text and not text.startswith("/"):
+                promo_codes.add(text.strip().upper())
+    span = entries[-1]["ts"] - entries[0]["ts"] if entries else 0.0
+    per_second = Counter(int(entry["ts"]) for entry in entries)
+    return {"users": users, "registering": registering, "promo_codes": promo_codes,
+            "span_seconds": round(span, 1), "peak_per_second": max(per_second.values(), default=0)}
+
+
+def seed(telegram_ids: set[int], promo_codes: set[str], subscribed: float, whitelisted: float) -> dict:
+    from sqlalchemy import insert
+    from models import PromoCode, SessionLocal, Subscription, User, Whitelist, engine, init_db, refresh_user_access
+
+    init_db()
+    now = datetime.datetime.now(datetime.timezone.utc)
+    db = SessionLocal()
+    try:
+        if db.query(User).count():
+            return {"users": len(telegram_ids), "seeded": False}
+        ordered = sorted(telegram_ids)
+        for start in range(0, len(ordered), harness.SEED_BATCH):
+            chunk = ordered[start:start + harness.SEED_BATCH]
+            db.execute(insert(User), [{"telegram_id": telegram_id, "email": f"user{telegram_id}@example.com",
+                                       "telegram_username": f"user{telegram_id}", "is_active": True}
+                                      for telegram_id in chunk])
+        # Remapped ids are uniformly spread, so their last digits pick a stable share
+        subscriptions = [telegram_id for telegram_id in ordered if telegram_id % 1000 < subscribed * 1000]
+        listed = [telegram_id for telegram_id in ordered if telegram_id % 1000 >= 1000 - whitelisted * 1000]
+        user_ids = dict(db.query(User.telegram_id, User.id).all())
+        for start in range(0, len(subscriptions), harness.SEED_BATCH):
+            db.execute(insert(Subscription), [
+                {"user_id": user_ids[telegram_id], "start_date": now - datetime.timedelta(days=15),
+                 "end_date": now + datetime.timedelta(days=15), "payment_amount": 1500, "auto_renewal": True}
+                for telegram_id in subscriptions[start:start + harness.SEED_BATCH]])
+        for start in range(0, len(listed), harness.SEED_BATCH):
+            db.execute(insert(Whitelist), [{"telegram_id": telegram_id}
+                                           for telegram_id in listed[start:start + harness.SEED_BATCH]])
+        if promo_codes:
+            db.execute(insert(PromoCode), [{"code": code, "discount_percent": 20, "is_active": True,
+                                            "used_count": 0, "max_uses": None} for code in sorted(promo_codes)])
+        db.commit()
+    finally:
+        db.close()
+    with engine.begin() as connection:
+        refresh_user_access(connection)
+    return {"users": len(telegram_ids), "seeded": True, "subscriptions": len(subscriptions),
+            "whitelist": len(listed), "promo_codes": len(promo_codes)}
+
+
+def as_update(update_id: int, entry: dict):
+    if entry["type"] == "callback_query":
+        return harness.callback_update(update_id, entry["user"], entry.get("data") or "")
+    return harness.message_update(update_id, entry["user"], entry.get("text"))
+
+
+async def replay(samples: harness.UpdateSamples, dispatcher, bot, entries: list[dict], speed: float,
+                 concurrency: int) -> tuple[float, list[float]]:
+    # One lane per user with updates waiting keeps that user's order; lanes
+    # end when drained and come back with the user's next update
+    semaphore = asyncio.Semaphore(concurrency)
+    lanes: dict[int, deque] = {}
+    running: set[asyncio.Task] = set()
+    lags = []
+
+    async def lane(user: int, queue: deque) -> None:
+        while queue:
+            update, arrived = queue.popleft()
+            async with semaphore:
+                await samples.feed(dispatcher, bot, update, arrived)
+        del lanes[user]
+
+    started = time.perf_counter()
+    first = entries[0]["ts"]
+    for update_id, entry in enumerate(entries, 1):
+        arrived = None
+        if speed:
+            due = started + (entry["ts"] - first) / speed
+            delay = due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            arrived = time.perf_counter()
+            lags.append(arrived - due)
+        queue = lanes.get(entry["user"])
+        if queue is None:
+            queue = lanes[entry["user"]] = deque()
+            task = asyncio.create_task(lane(entry["user"], queue))
+            running.add(task)
+            task.add_done_callback(running.discard)
+        queue.append((as_update(update_id, entry), arrived))
+    while running:
+        await asyncio.gather(*running)
+    return time.perf_counter() - started, lags
+
+
+async def main(args) -> None:
+    from recorder import recording_files
+
+    files = recording_files(args.paths)
+    entries = load(args.paths, args.limit)
+    if not entries:
+        print("no recorded messages or callbacks in " + ", ".join(args.paths))
+        sys.exit(1)
+    recording = analyse(entries)
+    seeded = seed(recording["users"] - recording["registering"], recording["promo_codes"],
+                  args.subscribed, args.whitelisted)
+
+    import bot as bot_module
+    from catalog import message_catalog
+    from models import async_engine
+    harness.quiet()
+
+    await message_catalog.refresh()
+    samples = harness.UpdateSamples(async_engine.sync_engine)
+    bot_module.dp.update.outer_middleware(samples)
+    bot = harness.stub_bot(args.api_latency)
+
+    elapsed, lags = await replay(samples, bot_module.dp, bot, entries, args.speed, args.concurrency)
+    await bot_module.storage.flush()
+    await bot_module.referral_recorder.flush()
+
+    updates = len(samples.samples)
+    charged = sum(sample.statements for sample in samples.samples)
+    api_calls = dict(sorted(bot.session.calls.items()))
+    waits = harness.latency_summary([sample.waited for sample in samples.samples])
+    pacing = harness.latency_summary(lags)
+    results = {
+        "benchmark": "replay",
+        "at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "revision": harness.revision(),
+        "environment": harness.environment(),
+        "args": {key: value for key, value in vars(args).items() if key not in ("compare", "output", "database_url")},
+        "recording": {"files": [os.path.basename(path) for path in files], "updates": len(entries),
+                      "users": len(recording["users"]), "registering": len(recording["registering"]),
+                      "span_seconds": recording["span_seconds"], "peak_per_second": recording["peak_per_second"],
+                      "from": datetime.datetime.fromtimestamp(entries[0]["ts"], datetime.timezone.utc).isoformat(),
+                      "to": datetime.datetime.fromtimestamp(entries[-1]["ts"], datetime.timezone.utc).isoformat()},
+        "seed": seeded,
+        "updates": updates,
+        "seconds": round(elapsed, 3),
+        "updates_per_second": round(updates / elapsed, 1) if elapsed else 0.0,
+        **harness.latency_summary([sample.seconds for sample in samples.samples]),
+        "wait_p50_ms": waits["p50_ms"],
+        "wait_p99_ms": waits["p99_ms"],
+        # How late the replay itself delivered updates; large values mean this
+        # machine could not keep the recorded pace and latencies are understated
+        "pacing_lag_p99_ms": pacing["p99_ms"],
+        "errors": sum(1 for sample in samples.samples if sample.failed),
+        "statements_per_update": round(charged / updates, 2) if updates else 0.0,
+        "background_statements": samples.statements - charged,
+        "api_calls": api_calls,
+        "handlers": harness.summarize_samples(samples.samples),
+    }
+
+    await bot_module.referral_recorder.close()
+    await bot_module.storage.close()
+    await async_engine.dispose()
+
+    speed = f"{args.speed:g}x" if args.speed else "max speed"
+    print(f"{len(entries)} recorded updates from {len(recording['users'])} users over "
+          f"{recording['span_seconds']:.0f}s (peak {recording['peak_per_second']}/s), replayed at {speed}")
+    print(f"{updates} updates in {elapsed:.2f}s: {results['updates_per_second']:.0f} updates/s, "
+          f"p50 {results['p50_ms']:.2f} ms, p99 {results['p99_ms']:.2f} ms (waiting p99 {results['wait_p99_ms']:.2f} ms), "
+          f"pacing lag p99 {results['pacing_lag_p99_ms']:.2f} ms, {results['errors']} errors\n")
+    harness.print_handlers(results["handlers"])
+    print("\napi calls: " + ", ".join(f"{name} {count}" for name, count in api_calls.items()))
+    path = harness.save_results("replay", results, args.output)
+    print(f"results: {path}")
+    if args.compare:
+        harness.print_comparison(harness.load_results(args.compare), results)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="+", help="recording files or directories")
+    parser.add_argument("--speed", type=float, default=1.0, help="1 keeps the recorded pace, 0 replays at max speed")
+    parser.add_argument("--concurrency", type=int, help="updates handled at once, defaults to WEBHOOK_CONCURRENCY")
+    parser.add_argument("--limit", type=int, help="replay only the first N updates")
+    parser.add_argument("--subscribed", type=float, default=0.5, help="share of seeded users with a subscription")
+    parser.add_argument("--whitelisted", type=float, default=0.01, help="share of seeded users on the whitelist")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="seconds per stubbed Telegram API call")
+    parser.add_argument("--output", help="results file, defaults to benchmarks/results/replay-<time>-<commit>.json")
+    parser.add_argument("--compare", help="earlier results file to compare this run against")
+    parser.add_argument("--database-url", help="defaults to a throwaway SQLite file")
+    args = parser.parse_args()
+    harness.use_database(args.database_url)
+    if args.concurrency is None:
+        from config import WEBHOOK_CONCURRENCY
+        args.concurrency = WEBHOOK_CONCURRENCY
+    asyncio.run(main(args))
@@ -1,15 +1,17 @@
 import asyncio
+import inspect
 import logging
 import re
 import datetime
+import time
 from functools import wraps
 import aiohttp
 
-from aiogram import Bot, Dispatcher, types, F
+from aiogram import BaseMiddleware, Bot, Dispatcher, types, F
+from aiogram.dispatcher.event.bases import UNHANDLED
 from aiogram.filters import CommandStart
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import (
     ReplyKeyboardMarkup,
     KeyboardButton,
@@ -21,26 +23,108 @@ from aiogram.types import (
 from config import (
     BOT_TOKEN,
     DEFAULT_REFERRAL_STATUS,
-    ADMIN_TG_ACCOUNT,
     BOT_USERNAME,
-    COMPANY_NAME,
-    COMPANY_REGISTRATION_NUMBER,
-    COMPANY_ADDRESS,
-    COMPANY_BANK,
-    COMPANY_ACCOUNT,
-    COMPANY_SWIFT,
-    COMPANY_IBAN
+    BOT_MODE,
+    WEBHOOK_BASE_URL,
+    WEBHOOK_PATH,
+    WEBHOOK_SECRET,
+    WEBHOOK_QUEUE_SIZE,
+    WEBHOOK_CONCURRENCY,
+    WEB_BIND,
+    SHARD_WORKERS,
+    PAYMENT_PROVIDER
 )
-from database import init_db, get_db
-from models import User, Subscription, Whitelist, PromoCode
+import queries
+from access_cache import AccessEntry, UserSnapshot, access_cache
+from database import init_db, get_async_db
+from fsm_storage import SQLStorage
+from models import User, async_engine
+from promo import EXHAUSTED, INACTIVE, PromoRedeemer, active_promo
+from broadcast import BroadcastRunner
+from expiry import ExpiryScheduler
+from payments import get_provider
+from renewal import RenewalRunner
+from payment_webhook import PaymentNotificationConsumer
+from referrals import ReferralRecorder, resolve_referrer
+from catalog import message_catalog
+from recorder import update_recorder
+from metrics import (
+    DBTally,
+    db_tally,
+    handler_db_seconds,
+    handler_db_statements,
+    handler_duration,
+    handler_updates,
+    instrument_engine
+)
+from shard import ShardRouter, poll_updates
+from sqlprofile import sql_profiler
+from webhook import UpdateQueue, WebhookApp
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-storage = MemoryStorage()
+storage = SQLStorage()
 bot = Bot(token=BOT_TOKEN)
 dp = Dispatcher(storage=storage)
 
+
+# Outer middleware on every update: latency, outcome and the SQL it cost, by
+# the handler that took it (filled in by HandlerNameMiddleware once routing
+# picked one; updates no handler wanted are labelled with their event type)
+class UpdateMetricsMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        tally = DBTally()
+        token = db_tally.set(tally)
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            result = await handler(event, data)
+            outcome = "unhandled" if result is UNHANDLED else "ok"
+            return result
+        finally:
+            elapsed = time.perf_counter() - started
+            db_tally.reset(token)
+            label = (tally.label or event.event_type,)
+            handler_duration.observe(label, elapsed)
+            handler_updates.inc(label + (outcome,))
+            handler_db_statements.observe(label, tally.statements)
+            handler_db_seconds.observe(label, tally.seconds)
+            if sql_profiler is not None:
+                sql_profiler.report("handler", label[0], tally)
+
+
+class HandlerNameMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        tally = db_tally.get()
+        if tally is not None:
+            tally.label = data["handler"].callback.__name__
+        return await handler(event, data)
+
+
+instrument_engine(async_engine.sync_engine)
+if sql_profiler is not None:
+    sql_profiler.instrument(async_engine.sync_engine)
+dp.update.outer_middleware(UpdateMetricsMiddleware())
+if update_recorder is not None:
+    dp.update.outer_middleware(update_recorder)
+dp.message.middleware(HandlerNameMiddleware())
+dp.callback_query.middleware(HandlerNameMiddleware())
+if SHARD_WORKERS > 0:
+    # This process only ingests; handlers run in SHARD_WORKERS worker processes
+    update_queue = ShardRouter(bot, workers=SHARD_WORKERS, maxsize=WEBHOOK_QUEUE_SIZE)
+else:
+    update_queue = UpdateQueue(dp, bot, maxsize=WEBHOOK_QUEUE_SIZE, concurrency=WEBHOOK_CONCURRENCY)
+webhook_app = WebhookApp(update_queue, path=WEBHOOK_PATH, secret=WEBHOOK_SECRET)
+broadcast_runner = BroadcastRunner(bot)
+# Shares the broadcast rate limiter so both stay within Telegram's per-bot limit together
+expiry_scheduler = ExpiryScheduler(bot, broadcast_runner.limiter)
+payment_provider = get_provider(PAYMENT_PROVIDER)
+renewal_runner = RenewalRunner(payment_provider) if payment_provider else None
+payment_consumer = PaymentNotificationConsumer()
+promo_redeemer = PromoRedeemer()
+referral_recorder = ReferralRecorder()
+
 class RegistrationStates(StatesGroup):
     waiting_for_email = State()
     waiting_for_promo = State()
@@ -53,11 +137,48 @@ main_keyboard = ReplyKeyboardMarkup(
     ],
     resize_keyboard=True
 )
+if update_recorder is not None:
+    # Button texts are recorded as they are; other free text is masked
+    update_recorder.keep(button.text for row in main_keyboard.keyboard for button in row)
 
 def is_valid_email(email: str) -> bool:
     return "@" in email and "." in email
 
+async def resolve_access(telegram_id: int) -> AccessEntry | None:
+    entry = access_cache.get(telegram_id)
+    if entry is not None:
+        return entry
+
+    async with get_async_db() as db:
+        user_db = await db.scalar(queries.user_by_telegram_id(telegram_id))
+        if not user_db:
+            return None
+        return access_cache.put(user_db)
+
+async def get_auto_renewal(user: UserSnapshot) -> bool:
+    async with get_async_db() as db:
+        return bool(await db.scalar(queries.latest_auto_renewal(user.id)))
+
+async def deny_unregistered(target_message: types.Message, state: FSMContext | None, user_tg: types.User, entry: AccessEntry | None, checker: str):
+    telegram_id = user_tg.id
+    user_db = entry.user if entry else None
+    logger.warning(f"Access denied for {telegram_id} by {checker}: Not registered, no email, or inactive.")
+    await target_message.answer("Пожалуйста, пройдите регистрацию (или убедитесь, что ваш аккаунт активен), используя /start.")
+    if state and (not user_db or not user_db.email or user_db.email.startswith("temp_")):
+        logger.info(f"Redirecting user {telegram_id} to email input.")
+        if not user_db:
+            await state.update_data(new_telegram_id=telegram_id, new_username=user_tg.username)
+        else:
+            await state.update_data(user_id_to_update=user_db.id)
+        await target_message.answer("Пожалуйста, введите ваш email:", reply_markup=ReplyKeyboardRemove())
+        await state.set_state(RegistrationStates.waiting_for_email)
+
+def is_registered_active(entry: AccessEntry | None) -> bool:
+    return bool(entry and entry.user.email and not entry.user.email.startswith("temp_") and entry.user.is_active)
+
 def check_registered_active(func):
+    wants_access = "access" in inspect.signature(func).parameters
+
     @wraps(func)
     async def wrapper(message_or_cq: types.Message | types.CallbackQuery, state: FSMContext | None = None, *args, **kwargs):
         if isinstance(message_or_cq, types.Message):
@@ -71,31 +192,21 @@ def check_registered_active(func):
             logger.error(f"check_registered_active applied to unsupported type: {type(message_or_cq)}")
             return
 
-        telegram_id = user_tg.id
-        user_db: User | None = None
-
-        with get_db() as db:
-            user_db = db.query(User).filter(User.telegram_id == telegram_id).first()
-
-            if not user_db or not user_db.email or user_db.email.startswith("temp_") or not user_db.is_active:
-                logger.warning(f"Access denied for {telegram_id} by check_registered_active: Not registered, no email, or inactive.")
-                await target_message.answer("Пожалуйста, пройдите регистрацию (или убедитесь, что ваш аккаунт активен), используя /start.")
-                if state and (not user_db or not user_db.email or user_db.email.startswith("temp_")):
-                    logger.info(f"Redirecting user {telegram_id} to email input.")
-                    if not user_db:
-                        await state.update_data(new_telegram_id=telegram_id, new_username=user_tg.username)
-                    else:
-                        await state.update_data(user_id_to_update=user_db.id)
-                    await target_message.answer("Пожалуйста, введите ваш email:", reply_markup=ReplyKeyboardRemove())
-                    await state.set_state(RegistrationStates.waiting_for_email)
-                return
+        entry = await resolve_access(user_tg.id)
+        if not is_registered_active(entry):
+            await deny_unregistered(target_message, state, user_tg, entry, "check_registered_active")
+            return
 
-            kwargs['user'] = user_db
-            return await func(message_or_cq, *args, **kwargs)
+        kwargs['user'] = entry.user
+        if wants_access:
+            kwargs['access'] = entry
+        return await func(message_or_cq, *args, **kwargs)
 
     return wrapper
 
 def check_access(handler):
+    wants_access = "access" in inspect.signature(handler).parameters
+
     @wraps(handler)
     async def wrapper(message_or_cq: types.Message | types.CallbackQuery, state: FSMContext | None = None, *args, **kwargs):
         if isinstance(message_or_cq, types.Message):
@@ -110,50 +221,24 @@ def check_access(handler):
             return
         
         telegram_id = user_tg.id
-        user_db: User | None = None
-        access_granted = False
-        now = datetime.datetime.now(datetime.timezone.utc)
-
-        with get_db() as db:
-            user_db = db.query(User).filter(User.telegram_id == telegram_id).first()
-
-            if not user_db or not user_db.email or user_db.email.startswith("temp_") or not user_db.is_active:
-                logger.warning(f"Access denied for {telegram_id} by check_access: Not registered, no email, or inactive.")
-                await target_message.answer("Пожалуйста, пройдите регистрацию (или убедитесь, что ваш аккаунт активен), используя /start.")
-                if state and (not user_db or not user_db.email or user_db.email.startswith("temp_")):
-                     logger.info(f"Redirecting user {telegram_id} to email input.")
-                     if not user_db:
-                         await state.update_data(new_telegram_id=telegram_id, new_username=user_tg.username)
-                     else:
-                         await state.update_data(user_id_to_update=user_db.id)
-                     await target_message.answer("Пожалуйста, введите ваш email:", reply_markup=ReplyKeyboardRemove())
-                     await state.set_state(RegistrationStates.waiting_for_email)
-                return
+        entry = await resolve_access(telegram_id)
+        if not is_registered_active(entry):
+            await deny_unregistered(target_message, state, user_tg, entry, "check_access")
+            return
 
-            logger.debug(f"Checking whitelist for telegram_id: {telegram_id} (type: {type(telegram_id)})")
-            whitelist_entry = db.query(Whitelist).filter(Whitelist.telegram_id == telegram_id).first()
-            logger.debug(f"Whitelist query result for {telegram_id}: {whitelist_entry}")
-            is_whitelisted = whitelist_entry is not None
-            if is_whitelisted:
-                logger.info(f"Access granted for {telegram_id}: Whitelisted.")
-                access_granted = True
-            else:
-                active_subscription = (db.query(Subscription)
-                                       .filter(Subscription.user_id == user_db.id)
-                                       .filter(Subscription.end_date > now)
-                                       .order_by(Subscription.end_date.desc())
-                                       .first())
-                if active_subscription:
-                    logger.info(f"Access granted for {telegram_id}: Active subscription until {active_subscription.end_date}.")
-                    access_granted = True
-
-            if access_granted:
-                kwargs['user'] = user_db
-                return await handler(message_or_cq, *args, **kwargs)
-            else:
-                logger.warning(f"Access denied for {telegram_id}: No active subscription or whitelist entry.")
-                await target_message.answer("❌ У вас нет активного доступа к курсу.")
-                return
+        if entry.is_whitelisted:
+            logger.info(f"Access granted for {telegram_id}: Whitelisted.")
+        elif entry.has_subscription:
+            logger.info(f"Access granted for {telegram_id}: Active subscription until {entry.subscription_end}.")
+        else:
+            logger.warning(f"Access denied for {telegram_id}: No active subscription or whitelist entry.")
+            await target_message.answer("❌ У вас нет активного доступа к курсу.")
+            return
+
+        kwargs['user'] = entry.user
+        if wants_access:
+            kwargs['access'] = entry
+        return await handler(message_or_cq, *args, **kwargs)
 
     return wrapper
 
@@ -168,22 +253,14 @@ async def handle_start(message: types.Message, state: FSMContext):
     
     if start_param:
         if start_param == "offer":
-            await message.answer(
-                "Публичная оферта доступна по ссылке:\n"
-                "https://docs.google.com/document/d/1tgPqQTkjQDgftj-a0vNOgs53mi7-sctjv4WJ2BF9DTA/edit",
-                disable_web_page_preview=True
-            )
+            await message.answer(**message_catalog["start_offer"].kwargs())
             return
         elif start_param == "privacy":
-            await message.answer(
-                "Политика конфиденциальности доступна по ссылке:\n"
-                "https://docs.google.com/document/d/10s0vc9sBXMeC8a-_VGSXzCPi0Z5k4AMy/edit",
-                disable_web_page_preview=True
-            )
+            await message.answer(**message_catalog["start_privacy"].kwargs())
             return
 
-    with get_db() as db:
-        user = db.query(User).filter(User.telegram_id == telegram_id).first()
+    async with get_async_db() as db:
+        user = await db.scalar(queries.user_by_telegram_id(telegram_id))
 
         if user:
             logger.info(f"User {telegram_id} already exists.")
@@ -203,9 +280,12 @@ async def handle_start(message: types.Message, state: FSMContext):
                 await message.answer(f"С возвращением, {first_name}!", reply_markup=main_keyboard)
         else:
             logger.info(f"New user: {telegram_id} ({username}). Requesting email.")
+            # Any other start parameter is a referral link; attribution happens once the email is in
+            referrer_id = await resolve_referrer(start_param) if start_param else None
             await state.update_data(
                 new_telegram_id=telegram_id,
-                new_username=username
+                new_username=username,
+                referrer_id=referrer_id
             )
             await message.answer(
                 f"Добро пожаловать, {first_name}! "
@@ -223,8 +303,8 @@ async def handle_email(message: types.Message, state: FSMContext):
         await message.answer("Не похоже на email. Пожалуйста, введите корректный адрес электронной почты.")
         return
 
-    with get_db() as db:
-        existing_user_by_email = db.query(User).filter(User.email == email).first()
+    async with get_async_db() as db:
+        existing_user_by_email = await db.scalar(queries.user_by_email(email))
         user_data = await state.get_data()
         user_id_to_update = user_data.get('user_id_to_update')
 
@@ -233,10 +313,11 @@ async def handle_email(message: types.Message, state: FSMContext):
                 return
 
         if user_id_to_update:
-            user_to_update = db.query(User).filter(User.id == user_id_to_update).first()
+            user_to_update = await db.get(User, user_id_to_update)
             if user_to_update:
                 user_to_update.email = email
-                db.commit()
+                await db.commit()
+                access_cache.invalidate(user_to_update.telegram_id)
                 logger.info(f"Email updated for user {user_to_update.telegram_id}.")
                 await message.answer("Спасибо! Ваш email обновлен.", reply_markup=main_keyboard)
                 await state.clear()
@@ -260,8 +341,12 @@ async def handle_email(message: types.Message, state: FSMContext):
                 email=email
             )
             db.add(new_user)
-            db.commit()
+            await db.commit()
             logger.info(f"New user {new_telegram_id} registered with email {email}.")
+            referrer_id = user_data.get('referrer_id')
+            if referrer_id:
+                referral_recorder.record(referrer_id, new_user.id)
+                logger.info(f"User {new_telegram_id} referred by user id {referrer_id}.")
             await message.answer("Спасибо! Вы успешно зарегистрированы.", reply_markup=main_keyboard)
             await state.clear()
 
@@ -271,24 +356,15 @@ async def handle_email_incorrect_input(message: types.Message):
 
 @dp.message(F.text == "👤 Мой аккаунт")
 @check_registered_active
-async def handle_my_account(message: types.Message, *, user: User):
+async def handle_my_account(message: types.Message, *, user: UserSnapshot, access: AccessEntry):
     logger.info(f"User {user.telegram_id} requested account info.")
     
-    now = datetime.datetime.now(datetime.timezone.utc)
     access_status_text = "❌ Доступ к курсу отсутствует"
-    with get_db() as db:
-        is_whitelisted = db.query(Whitelist).filter(Whitelist.telegram_id == user.telegram_id).first() is not None
-        if is_whitelisted:
-            access_status_text = "✅ Доступ к курсу есть (белый список)"
-        else:
-            active_subscription = (db.query(Subscription)
-                                   .filter(Subscription.user_id == user.id)
-                                   .filter(Subscription.end_date > now)
-                                   .order_by(Subscription.end_date.desc())
-                                   .first())
-            if active_subscription:
-                end_date_str = active_subscription.end_date.strftime("%d.%m.%Y %H:%M")
-                access_status_text = f"✅ Доступ к курсу есть (до {end_date_str} UTC)"
+    if access.is_whitelisted:
+        access_status_text = "✅ Доступ к курсу есть (белый список)"
+    elif access.has_subscription:
+        end_date_str = access.subscription_end.strftime("%d.%m.%Y %H:%M")
+        access_status_text = f"✅ Доступ к курсу есть (до {end_date_str} UTC)"
 
     account_info = (
         f"👤 Ваш аккаунт:\n"
@@ -300,7 +376,7 @@ async def handle_my_account(message: types.Message, *, user: User):
 
 @dp.message(F.text == "🔗 Ваша реферальная ссылка")
 @check_access
-async def handle_referral_link(message: types.Message, *, user: User):
+async def handle_referral_link(message: types.Message, *, user: UserSnapshot):
     logger.info(f"User {user.telegram_id} requested referral link.")
     
     start_param = user.referral_link_override if user.referral_link_override else user.telegram_id
@@ -311,7 +387,7 @@ async def handle_referral_link(message: types.Message, *, user: User):
 
 @dp.message(F.text == "📊 Статус реф. ссылки")
 @check_access
-async def handle_referral_status(message: types.Message, *, user: User):
+async def handle_referral_status(message: types.Message, *, user: UserSnapshot):
     logger.info(f"User {user.telegram_id} requested referral status.")
     status_flag = user.referral_status_override
     if status_flag is None:
@@ -320,68 +396,30 @@ async def handle_referral_status(message: types.Message, *, user: User):
     status_icon = "✅" if status_flag else "❌"
     status_text = "Активна" if status_flag else "Не активна"
 
-    await message.answer(f"📊 Статус вашей реферальной ссылки: {status_icon} ({status_text})")
+    async with get_async_db() as db:
+        referral_count = await db.scalar(queries.referral_count(user.id)) or 0
+
+    await message.answer(
+        f"📊 Статус вашей реферальной ссылки: {status_icon} ({status_text})\n"
+        f"👥 Приглашено пользователей: {referral_count}"
+    )
+
+async def subscription_status(user: UserSnapshot, access: AccessEntry) -> dict:
+    if access.has_subscription:
+        auto_renewal = await get_auto_renewal(user)
+        return message_catalog["subscription_active"].kwargs(
+            end_date=access.subscription_end.strftime("%d.%m.%Y %H:%M UTC"),
+            auto_renewal='🔄 Автоплатеж включен' if auto_renewal else '❌ Автоплатеж отключен'
+        )
+    if access.is_whitelisted:
+        return message_catalog["subscription_whitelisted"].kwargs()
+    return message_catalog["subscription_inactive"].kwargs()
 
 @dp.message(F.text == "⏳ Моя подписка")
 @check_registered_active
-async def handle_my_subscription(message: types.Message, *, user: User):
+async def handle_my_subscription(message: types.Message, *, user: UserSnapshot, access: AccessEntry):
     logger.info(f"User {user.telegram_id} requested subscription status.")
-    now = datetime.datetime.now(datetime.timezone.utc)
-    
-    with get_db() as db:
-        active_subscription = (db.query(Subscription)
-                               .filter(Subscription.user_id == user.id)
-                               .filter(Subscription.end_date > now)
-                               .order_by(Subscription.end_date.desc())
-                               .first())
-        is_whitelisted = db.query(Whitelist).filter(Whitelist.telegram_id == user.telegram_id).first() is not None
-        
-        if active_subscription:
-            end_date_str = active_subscription.end_date.strftime("%d.%m.%Y %H:%M UTC")
-            keyboard = InlineKeyboardMarkup(
-                inline_keyboard=[
-                    [
-                        InlineKeyboardButton(text="Продлить подписку", callback_data="buy_access"),
-                        InlineKeyboardButton(text="Ввести промокод", callback_data="enter_promo")
-                    ],
-                    [InlineKeyboardButton(text="Отключить автоплатеж", callback_data="disable_auto_renewal")]
-                ]
-            )
-            
-            await message.answer(
-                f"✅ Ваш доступ к обучающему курсу активен до: {end_date_str}\n\n"
-                f"{'🔄 Автоплатеж включен' if active_subscription.auto_renewal else '❌ Автоплатеж отключен'}\n\n"
-                "Для продления подписки нажмите на кнопку ниже:",
-                reply_markup=keyboard
-            )
-        elif is_whitelisted:
-            await message.answer(
-                "✅ У вас постоянный доступ к курсу (белый список)."
-            )
-        else:
-            keyboard = InlineKeyboardMarkup(
-                inline_keyboard=[
-                    [
-                        InlineKeyboardButton(text="Оплатить 1500₽", callback_data="process_payment"),
-                        InlineKeyboardButton(text="Ввести промокод", callback_data="enter_promo")
-                    ],
-                    [InlineKeyboardButton(text="Отключить автоплатеж", callback_data="disable_auto_renewal")]
-                ]
-            )
-            await message.answer(
-                "📚 Продукт: Приватный чат \"СИСТЕМНИК УБТ ПРИВАТ\"\n\n"
-                "🗓 Тарифный план: СИСТЕМНИК УБТ (Карта РФ)\n\n"
-                "— Тип платежа: Автоплатеж с интервалом 30d 0h 0m\n"
-                "— Сумма к оплате: 1500 RUB\n\n"
-                "После оплаты будет предоставлен доступ:\n\n"
-                "— Группа «СИСТЕМНИК УБТ ПРИВАТ»\n\n"
-                "Оплачивая подписку вы принимаете условия "
-                "[Публичной оферты](https://docs.google.com/document/d/1tgPqQTkjQDgftj-a0vNOgs53mi7-sctjv4WJ2BF9DTA/edit) и "
-                "[Политики конфиденциальности](https://docs.google.com/document/d/10s0vc9sBXMeC8a-_VGSXzCPi0Z5k4AMy/edit)",
-                reply_markup=keyboard,
-                parse_mode="Markdown",
-                disable_web_page_preview=True
-            )
+    await message.answer(**await subscription_status(user, access))
 
 @dp.callback_query(F.data == "enter_promo")
 async def handle_enter_promo(callback: types.CallbackQuery, state: FSMContext):
@@ -392,59 +430,58 @@ async def handle_enter_promo(callback: types.CallbackQuery, state: FSMContext):
 @dp.message(RegistrationStates.waiting_for_promo)
 async def handle_promo_code(message: types.Message, state: FSMContext):
     promo_code = message.text.strip().upper()
-    with get_db() as db:
-        promo = db.query(PromoCode).filter(
-            PromoCode.code == promo_code,
-            PromoCode.is_active == True
-        ).first()
-        
-        if not promo:
-            keyboard = InlineKeyboardMarkup(
-                inline_keyboard=[
-                    [InlineKeyboardButton(text="Купить доступ", callback_data="buy_access")]
-                ]
-            )
-            await message.answer(
-                "❌ Неверный или неактивный промокод. Попробуйте еще раз или нажмите 'Купить доступ'.",
-                reply_markup=keyboard
-            )
-            return
-            
-        if promo.max_uses is not None and promo.used_count >= promo.max_uses:
-            keyboard = InlineKeyboardMarkup(
-                inline_keyboard=[
-                    [InlineKeyboardButton(text="Купить доступ", callback_data="buy_access")]
-                ]
-            )
-            await message.answer(
-                "❌ Промокод уже использован максимальное количество раз.",
-                reply_markup=keyboard
-            )
+    retry_keyboard = InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text="Купить доступ", callback_data="buy_access")]
+        ]
+    )
+    promo = await active_promo(promo_code)
+    outcome = INACTIVE
+    if promo:
+        entry = await resolve_access(message.from_user.id)
+        if not is_registered_active(entry):
+            await deny_unregistered(message, state, message.from_user, entry, "handle_promo_code")
             return
-            
-        original_price = 1500
-        discount = original_price * (promo.discount_percent / 100)
-        final_price = original_price - discount
-        
-        keyboard = InlineKeyboardMarkup(
-            inline_keyboard=[
-                [
-                    InlineKeyboardButton(
-                        text=f"Купить доступ за {int(final_price)}₽",
-                        callback_data=f"buy_access_with_promo_{promo.id}"
-                    )
-                ]
-            ]
+        # Claims one use atomically; entering the same code again does not use it up twice
+        outcome = await promo_redeemer.redeem(promo, entry.user.id)
+
+    if outcome == INACTIVE:
+        await message.answer(
+            "❌ Неверный или неактивный промокод. Попробуйте еще раз или нажмите 'Купить доступ'.",
+            reply_markup=retry_keyboard
         )
-        
+        return
+
+    if outcome == EXHAUSTED:
         await message.answer(
-            f"✅ Промокод применен!\n\n"
-            f"Стоимость: {int(final_price)}₽\n"
-            f"<s>1500₽</s>",
-            reply_markup=keyboard,
-            parse_mode="HTML"
+            "❌ Промокод уже использован максимальное количество раз.",
+            reply_markup=retry_keyboard
         )
-        await state.clear()
+        return
+
+    original_price = message_catalog.price
+    discount = original_price * (promo.discount_percent / 100)
+    final_price = original_price - discount
+    
+    keyboard = InlineKeyboardMarkup(
+        inline_keyboard=[
+            [
+                InlineKeyboardButton(
+                    text=f"Купить доступ за {int(final_price)}₽",
+                    callback_data=f"buy_access_with_promo_{promo.id}"
+                )
+            ]
+        ]
+    )
+    
+    await message.answer(
+        f"✅ Промокод применен!\n\n"
+        f"Стоимость: {int(final_price)}₽\n"
+        f"<s>{original_price}₽</s>",
+        reply_markup=keyboard,
+        parse_mode="HTML"
+    )
+    await state.clear()
 
 @dp.callback_query(F.data.startswith("buy_access_with_promo_"))
 async def handle_buy_with_promo(callback: types.CallbackQuery):
@@ -453,227 +490,135 @@ async def handle_buy_with_promo(callback: types.CallbackQuery):
 
 @dp.callback_query(F.data == "buy_access")
 async def handle_buy_access(callback: types.CallbackQuery):
-    text = (
-        "📚 Продукт: Приватный чат \"СИСТЕМНИК УБТ ПРИВАТ\"\n\n"
-        "🗓 Тарифный план: СИСТЕМНИК УБТ (Карта РФ)\n\n"
-        "— Тип платежа: Автоплатеж с интервалом 30d 0h 0m\n"
-        "— Сумма к оплате: 1500 RUB\n\n"
-        "После оплаты будет предоставлен доступ:\n\n"
-        "— Группа «СИСТЕМНИК УБТ ПРИВАТ»\n\n"
-        "Оплачивая подписку вы принимаете условия "
-        "[Публичной оферты](https://docs.google.com/document/d/1tgPqQTkjQDgftj-a0vNOgs53mi7-sctjv4WJ2BF9DTA/edit) и "
-        "[Политики конфиденциальности](https://docs.google.com/document/d/10s0vc9sBXMeC8a-_VGSXzCPi0Z5k4AMy/edit)"
-    )
-    
-    keyboard = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text="Оплатить 1500₽", callback_data="process_payment")],
-            [InlineKeyboardButton(text="Ввести промокод", callback_data="enter_promo")]
-        ]
-    )
-    
-    await callback.message.edit_text(text, reply_markup=keyboard, parse_mode="Markdown", disable_web_page_preview=True)
+    await callback.message.edit_text(**message_catalog["buy_access"].kwargs())
     await callback.answer()
 
 @dp.callback_query(F.data == "show_offer")
 async def handle_show_offer(callback: types.CallbackQuery):
-    offer_text = (
-        "📜 *ПУБЛИЧНАЯ ОФЕРТА*\n\n"
-        "1. ОБЩИЕ ПОЛОЖЕНИЯ\n\n"
-        "1.1. Настоящая оферта является предложением заключить договор на оказание информационных услуг.\n"
-        "1.2. Акцептом оферты является оплата услуг.\n\n"
-        "2. УСЛОВИЯ ПОДПИСКИ\n\n"
-        "2.1. Подписка предоставляется на 30 дней.\n"
-        "2.2. Автопродление происходит автоматически.\n"
-        "2.3. Отмена подписки возможна в любой момент.\n\n"
-        "[Полный текст оферты](https://docs.google.com/document/d/1tgPqQTkjQDgftj-a0vNOgs53mi7-sctjv4WJ2BF9DTA/edit)"
-    )
-    
-    keyboard = InlineKeyboardMarkup(
-        inline_keyboard=[[InlineKeyboardButton(text="« Назад", callback_data="buy_access")]]
-    )
-    
-    await callback.message.edit_text(offer_text, reply_markup=keyboard, parse_mode="Markdown", disable_web_page_preview=True)
+    await callback.message.edit_text(**message_catalog["offer"].kwargs())
     await callback.answer()
 
 @dp.callback_query(F.data == "show_privacy")
 async def handle_show_privacy(callback: types.CallbackQuery):
-    privacy_text = (
-        "🔒 *ПОЛИТИКА КОНФИДЕНЦИАЛЬНОСТИ*\n\n"
-        "1. ОБРАБОТКА ДАННЫХ\n\n"
-        "1.1. Мы обрабатываем только те данные, которые необходимы для оказания услуг.\n"
-        "1.2. Ваши персональные данные не передаются третьим лицам.\n\n"
-        "2. ХРАНЕНИЕ ИНФОРМАЦИИ\n\n"
-        "2.1. Данные хранятся на защищенных серверах.\n"
-        "2.2. Срок хранения определяется законодательством.\n\n"
-        "[Полный текст политики](https://docs.google.com/document/d/10s0vc9sBXMeC8a-_VGSXzCPi0Z5k4AMy/edit)"
-    )
-    
-    keyboard = InlineKeyboardMarkup(
-        inline_keyboard=[[InlineKeyboardButton(text="« Назад", callback_data="buy_access")]]
-    )
-    
-    await callback.message.edit_text(privacy_text, reply_markup=keyboard, parse_mode="Markdown", disable_web_page_preview=True)
+    await callback.message.edit_text(**message_catalog["privacy"].kwargs())
     await callback.answer()
 
 @dp.callback_query(F.data == "show_requisites")
 async def handle_show_requisites(callback: types.CallbackQuery):
-    requisites_text = (
-        "📋 *РЕКВИЗИТЫ КОМПАНИИ*\n\n"
-        f"Название компании: {COMPANY_NAME}\n"
-        f"Регистрационный номер: {COMPANY_REGISTRATION_NUMBER}\n"
-        f"Адрес: {COMPANY_ADDRESS}\n\n"
-        "Банковские реквизиты:\n"
-        f"Банк: {COMPANY_BANK}\n"
-        f"Счет: {COMPANY_ACCOUNT}\n"
-        f"SWIFT: {COMPANY_SWIFT}\n"
-        f"IBAN: {COMPANY_IBAN}"
-    )
-    
-    keyboard = InlineKeyboardMarkup(
-        inline_keyboard=[[InlineKeyboardButton(text="« Назад", callback_data="buy_access")]]
-    )
-    
-    await callback.message.edit_text(requisites_text, reply_markup=keyboard, parse_mode="Markdown")
+    await callback.message.edit_text(**message_catalog["requisites"].kwargs())
     await callback.answer()
 
 @dp.callback_query(F.data == "process_payment")
 async def handle_process_payment(callback: types.CallbackQuery):
-    await callback.message.answer(
-        "📚 Продукт: Приватный чат \"СИСТЕМНИК УБТ ПРИВАТ\"\n\n"
-        "🗓 Тарифный план: СИСТЕМНИК УБТ (Карта РФ)\n\n"
-        "— Тип платежа: Автоплатеж с интервалом 30d 0h 0m\n"
-        "— Сумма к оплате: 1500 RUB\n\n"
-        "После оплаты будет предоставлен доступ:\n\n"
-        "— Группа «СИСТЕМНИК УБТ ПРИВАТ»\n\n"
-        "Оплачивая подписку вы принимаете условия "
-        "[Публичной оферты](https://docs.google.com/document/d/1tgPqQTkjQDgftj-a0vNOgs53mi7-sctjv4WJ2BF9DTA/edit) и "
-        "[Политики конфиденциальности](https://docs.google.com/document/d/10s0vc9sBXMeC8a-_VGSXzCPi0Z5k4AMy/edit)",
-        parse_mode="Markdown",
-        disable_web_page_preview=True
-    )
+    await callback.message.answer(**message_catalog["process_payment"].kwargs())
     await callback.answer()
 
 @dp.message(F.text == "🆘 Поддержка")
 async def handle_support(message: types.Message):
     logger.info(f"User {message.from_user.id} requested support info.")
-    support_contact = f"@{ADMIN_TG_ACCOUNT}"
-    text = (
-        "Если не получается оплатить, читаем:\n\n"
-        "⚠️ Бот иногда не справляется с большими наплывами участников. "
-        "Пробуйте раз в несколько минут, или через час, в любом случае рано или поздно всё прогрузится!\n\n"
-        f"📨 Только по долгим проблемам с оплатой — {support_contact}"
-    )
-    await message.answer(text)
+    await message.answer(**message_catalog["support"].kwargs())
 
 @dp.message(F.text)
 @check_access
-async def handle_unknown_text(message: types.Message, *, user: User):
+async def handle_unknown_text(message: types.Message, *, user: UserSnapshot):
     logger.warning(f"User {user.telegram_id} sent unknown text: {message.text}")
     await message.reply("Пожалуйста, используйте кнопки на клавиатуре для взаимодействия с ботом.", reply_markup=main_keyboard)
 
 @dp.callback_query(F.data == "disable_auto_renewal")
 @check_registered_active
-async def handle_disable_auto_renewal(callback: types.CallbackQuery, *, user: User):
+async def handle_disable_auto_renewal(callback: types.CallbackQuery, *, user: UserSnapshot):
     logger.info(f"User {user.telegram_id} requested to disable auto renewal.")
     now = datetime.datetime.now(datetime.timezone.utc)
     
-    with get_db() as db:
-        active_subscription = (db.query(Subscription)
-                               .filter(Subscription.user_id == user.id)
-                               .filter(Subscription.end_date > now)
-                               .order_by(Subscription.end_date.desc())
-                               .first())
+    async with get_async_db() as db:
+        active_subscription = await db.scalar(queries.active_subscription(user.id, now))
         
         if active_subscription:
             active_subscription.auto_renewal = False
-            db.commit()
+            await db.commit()
         
-        await callback.message.edit_text(
-            "Автоплатежи отключены! ✅\n"
-            "В следующем месяце не будет списания.",
-            reply_markup=InlineKeyboardMarkup(
-                inline_keyboard=[
-                    [InlineKeyboardButton(text="« Назад к подписке", callback_data="show_subscription")]
-                ]
-            )
-        )
+        await callback.message.edit_text(**message_catalog["auto_renewal_disabled"].kwargs())
 
 @dp.callback_query(F.data == "show_subscription")
 @check_registered_active
-async def handle_show_subscription(callback: types.CallbackQuery, *, user: User):
-    now = datetime.datetime.now(datetime.timezone.utc)
-    
-    with get_db() as db:
-        active_subscription = (db.query(Subscription)
-                               .filter(Subscription.user_id == user.id)
-                               .filter(Subscription.end_date > now)
-                               .order_by(Subscription.end_date.desc())
-                               .first())
-        is_whitelisted = db.query(Whitelist).filter(Whitelist.telegram_id == user.telegram_id).first() is not None
-        
-        if active_subscription:
-            end_date_str = active_subscription.end_date.strftime("%d.%m.%Y %H:%M UTC")
-            keyboard = InlineKeyboardMarkup(
-                inline_keyboard=[
-                    [
-                        InlineKeyboardButton(text="Продлить подписку", callback_data="buy_access"),
-                        InlineKeyboardButton(text="Ввести промокод", callback_data="enter_promo")
-                    ],
-                    [InlineKeyboardButton(text="Отключить автоплатеж", callback_data="disable_auto_renewal")]
-                ]
-            )
-            
-            await callback.message.edit_text(
-                f"✅ Ваш доступ к обучающему курсу активен до: {end_date_str}\n\n"
-                f"{'🔄 Автоплатеж включен' if active_subscription.auto_renewal else '❌ Автоплатеж отключен'}\n\n"
-                "Для продления подписки нажмите на кнопку ниже:",
-                reply_markup=keyboard
-            )
-        elif is_whitelisted:
-            await callback.message.edit_text(
-                "✅ У вас постоянный доступ к курсу (белый список)."
-            )
-        else:
-            keyboard = InlineKeyboardMarkup(
-                inline_keyboard=[
-                    [
-                        InlineKeyboardButton(text="Оплатить 1500₽", callback_data="process_payment"),
-                        InlineKeyboardButton(text="Ввести промокод", callback_data="enter_promo")
-                    ],
-                    [InlineKeyboardButton(text="Отключить автоплатеж", callback_data="disable_auto_renewal")]
-                ]
-            )
-            await callback.message.edit_text(
-                "📚 Продукт: Приватный чат \"СИСТЕМНИК УБТ ПРИВАТ\"\n\n"
-                "🗓 Тарифный план: СИСТЕМНИК УБТ (Карта РФ)\n\n"
-                "— Тип платежа: Автоплатеж с интервалом 30d 0h 0m\n"
-                "— Сумма к оплате: 1500 RUB\n\n"
-                "После оплаты будет предоставлен доступ:\n\n"
-                "— Группа «СИСТЕМНИК УБТ ПРИВАТ»\n\n"
-                "Оплачивая подписку вы принимаете условия "
-                "[Публичной оферты](https://docs.google.com/document/d/1tgPqQTkjQDgftj-a0vNOgs53mi7-sctjv4WJ2BF9DTA/edit) и "
-                "[Политики конфиденциальности](https://docs.google.com/document/d/10s0vc9sBXMeC8a-_VGSXzCPi0Z5k4AMy/edit)",
-                reply_markup=keyboard,
-                parse_mode="Markdown",
-                disable_web_page_preview=True
-            )
+async def handle_show_subscription(callback: types.CallbackQuery, *, user: UserSnapshot, access: AccessEntry):
+    await callback.message.edit_text(**await subscription_status(user, access))
     await callback.answer()
 
-async def main():
-    logger.info("Initializing database...")
-    init_db()
-    logger.info("Database initialized.")
-
+async def run_polling():
     try:
         await bot.delete_webhook(drop_pending_updates=True)
         logger.info("Webhook deleted successfully")
     except Exception as e:
         logger.error(f"Failed to delete webhook: {e}")
 
+    if SHARD_WORKERS > 0:
+        logger.info(f"Starting bot polling with {SHARD_WORKERS} workers...")
+        await update_queue.start()
+        try:
+            await poll_updates(bot, update_queue, dp.resolve_used_update_types())
+        finally:
+            await update_queue.stop()
+            await bot.session.close()
+        return
+
     logger.info("Starting bot polling...")
     await dp.start_polling(bot)
 
+async def run_webhook(serve_endpoint: bool):
+    webhook_url = WEBHOOK_BASE_URL.rstrip("/") + WEBHOOK_PATH
+    await update_queue.start()
+    try:
+        await bot.set_webhook(
+            url=webhook_url,
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=dp.resolve_used_update_types(),
+            drop_pending_updates=True,
+        )
+        logger.info(f"Webhook set to {webhook_url}")
+        if serve_endpoint:
+            from hypercorn.asyncio import serve
+            from hypercorn.config import Config
+
+            config = Config()
+            config.bind = [WEB_BIND]
+            await serve(webhook_app, config)
+        else:
+            await asyncio.Event().wait()
+    finally:
+        await update_queue.stop()
+        await bot.session.close()
+
+async def main(serve_webhook: bool = True):
+    logger.info("Initializing database...")
+    init_db()
+    logger.info("Database initialized.")
+    await message_catalog.refresh()
+
+    broadcast_task = asyncio.create_task(broadcast_runner.run())
+    expiry_task = asyncio.create_task(expiry_scheduler.run())
+    renewal_task = asyncio.create_task(renewal_runner.run()) if renewal_runner else None
+    payment_task = asyncio.create_task(payment_consumer.run())
+    catalog_task = asyncio.create_task(message_catalog.run())
+    try:
+        if BOT_MODE == "webhook":
+            # run.py mounts webhook_app on its own server and passes serve_webhook=False
+            await run_webhook(serve_webhook)
+        else:
+            await run_polling()
+    finally:
+        broadcast_task.cancel()
+        expiry_task.cancel()
+        payment_task.cancel()
+        catalog_task.cancel()
+        if renewal_task:
+            renewal_task.cancel()
+            await payment_provider.close()
+        await referral_recorder.close()
+        if update_recorder is not None:
+            await update_recorder.close()
+        await storage.close()
+
 if __name__ == "__main__":
     try:
         asyncio.run(main())
@@ -0,0 +1,237 @@
+import asyncio
+import datetime
+import logging
+import time
+from functools import partial
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from sqlalchemy import insert, or_, select, update
+
+from config import (
+    BROADCAST_RATE,
+    BROADCAST_CONCURRENCY,
+    BROADCAST_CHUNK_SIZE,
+    BROADCAST_MAX_ATTEMPTS,
+    BROADCAST_POLL_INTERVAL
+)
+from database import get_async_db
+from media import ensure_file_id, send_media
+from models import User, BroadcastJob, BroadcastRecipient
+
+logger = logging.getLogger(__name__)
+
+ACTIVE_STATUSES = ("pending", "running")
+
+
+class RateLimiter:
+    # Token bucket shared by every send of the runner (Telegram allows ~30
+    # messages/second per bot), plus a minimum interval per chat
+    def __init__(self, rate: float, per_chat_interval: float = 1.0):
+        self.rate = rate
+        self.per_chat_interval = per_chat_interval
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.chat_last_sent: dict[int, float] = {}
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float) -> None:
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self, chat_id: int) -> None:
+        while True:
+            async with self._lock:
+                now = time.monotonic()
+                wait = self.paused_until - now
+                chat_wait = self.chat_last_sent.get(chat_id, 0.0) + self.per_chat_interval - now
+                if wait <= 0 and chat_wait <= 0:
+                    self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        self.chat_last_sent[chat_id] = now
+                        if len(self.chat_last_sent) > 10000:
+                            cutoff = now - self.per_chat_interval
+                            self.chat_last_sent = {k: v for k, v in self.chat_last_sent.items() if v > cutoff}
+                        return
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    wait = max(wait, chat_wait)
+            await asyncio.sleep(wait)
+
+
+class BroadcastRunner:
+    def __init__(self, bot: Bot, rate: float = BROADCAST_RATE, concurrency: int = BROADCAST_CONCURRENCY,
+                 chunk_size: int = BROADCAST_CHUNK_SIZE, max_attempts: int = BROADCAST_MAX_ATTEMPTS,
+                 poll_interval: float = BROADCAST_POLL_INTERVAL):
+        self.bot = bot
+        self.limiter = RateLimiter(rate)
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.chunk_size = chunk_size
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+
+    async def run(self) -> None:
+        logger.info("Broadcast runner started.")
+        while True:
+            try:
+                job_id = await self.next_job_id()
+                if job_id is None:
+                    await asyncio.sleep(self.poll_interval)
+                    continue
+                await self.process(job_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Broadcast runner iteration failed")
+                await asyncio.sleep(self.poll_interval)
+
+    async def next_job_id(self) -> int | None:
+        async with get_async_db() as db:
+            # Jobs left "running" by a crashed process are resumed first
+            running = await db.scalar(select(BroadcastJob.id).where(BroadcastJob.status == "running")
+                                      .order_by(BroadcastJob.id).limit(1))
+            if running is not None:
+                return running
+            return await db.scalar(select(BroadcastJob.id).where(BroadcastJob.status == "pending")
+                                   .order_by(BroadcastJob.id).limit(1))
+
+    async def process(self, job_id: int) -> None:
+        async with get_async_db() as db:
+            job = await db.get(BroadcastJob, job_id)
+            if job is None or job.status not in ACTIVE_STATUSES:
+                return
+            if job.status == "pending":
+                job.status = "running"
+                job.started_at = datetime.datetime.utcnow()
+                await db.commit()
+            message_text, media_id = job.message_text, job.media_id
+            logger.info(f"Processing broadcast job {job_id} (cursor={job.cursor_user_id}, sent={job.sent_count}).")
+
+        if media_id is not None:
+            try:
+                # Uploaded at most once per asset; every recipient gets the cached file_id
+                media_type, file_id = await ensure_file_id(self.bot, media_id)
+            except TelegramRetryAfter as e:
+                # The job stays running and the next poll picks it up again
+                logger.warning(f"Broadcast job {job_id}: media upload throttled, retrying in {e.retry_after}s.")
+                await asyncio.sleep(e.retry_after)
+                return
+            except (RuntimeError, TelegramAPIError, OSError) as e:
+                # A running job is picked first on every poll, so retrying a
+                # failed upload forever would keep queued jobs from starting
+                await self.fail(job_id, f"Media upload failed: {e}")
+                return
+            send = partial(send_media, self.bot, media_type=media_type, file_id=file_id, caption=message_text)
+        else:
+            send = partial(self.bot.send_message, text=message_text)
+
+        while True:
+            async with get_async_db() as db:
+                status = await db.scalar(select(BroadcastJob.status).where(BroadcastJob.id == job_id))
+            if status not in ACTIVE_STATUSES:
+                logger.info(f"Broadcast job {job_id} stopped with status {status}.")
+                return
+
+            recipients = await self.pending_recipients(job_id)
+            if recipients:
+                await self.send_chunk(job_id, send, recipients)
+                continue
+            if not await self.enumerate_chunk(job_id):
+                break
+
+        async with get_async_db() as db:
+            await db.execute(update(BroadcastJob)
+                             .where(BroadcastJob.id == job_id, BroadcastJob.status == "running")
+                             .values(status="completed", finished_at=datetime.datetime.utcnow()))
+            await db.commit()
+        logger.info(f"Broadcast job {job_id} completed.")
+
+    async def fail(self, job_id: int, error: str) -> None:
+        logger.error(f"Broadcast job {job_id} failed: {error}")
+        async with get_async_db() as db:
+            await db.execute(update(BroadcastJob).where(BroadcastJob.id == job_id)
+                             .values(status="failed", error=error, finished_at=datetime.datetime.utcnow()))
+            await db.commit()
+
+    async def pending_recipients(self, job_id: int) -> list:
+        async with get_async_db() as db:
+            result = await db.execute(
+                select(BroadcastRecipient.id, BroadcastRecipient.telegram_id, BroadcastRecipient.attempts)
+                .where(BroadcastRecipient.job_id == job_id, BroadcastRecipient.status == "pending")
+                .order_by(BroadcastRecipient.id)
+                .limit(self.chunk_size)
+            )
+            return result.all()
+
+    async def enumerate_chunk(self, job_id: int) -> bool:
+        # Recipients are materialized one keyset chunk at a time; the cursor and
+        # the recipient rows commit together so a restart never skips or repeats users
+        async with get_async_db() as db:
+            job = await db.get(BroadcastJob, job_id)
+            if job.enumeration_done:
+                return False
+
+            query = (select(User.id, User.telegram_id)
+                     .where(User.id > job.cursor_user_id, User.telegram_id.isnot(None))
+                     .order_by(User.id)
+                     .limit(self.chunk_size))
+            if job.target == "selected":
+                query = query.where(User.id == job.selected_user_id)
+            elif job.target == "students":
+                now = datetime.datetime.now(datetime.timezone.utc)
+                query = query.where(or_(User.is_whitelisted == True, User.access_until > now))
+            users = (await db.execute(query)).all()
+
+            if users:
+                await db.execute(insert(BroadcastRecipient), [
+                    {"job_id": job_id, "user_id": user_id, "telegram_id": telegram_id,
+                     "status": "pending", "attempts": 0}
+                    for user_id, telegram_id in users
+                ])
+                job.cursor_user_id = users[-1].id
+                job.total_count += len(users)
+            if len(users) < self.chunk_size or job.target == "selected":
+                job.enumeration_done = True
+            await db.commit()
+            return bool(users) or not job.enumeration_done
+
+    async def send_chunk(self, job_id: int, send, recipients: list) -> None:
+        outcomes = await asyncio.gather(*(self.deliver(send, recipient) for recipient in recipients))
+        now = datetime.datetime.utcnow()
+        rows, sent, failed = [], 0, 0
+        for recipient, (status, error, attempts) in zip(recipients, outcomes):
+            rows.append({"id": recipient.id, "status": status, "error": error, "attempts": attempts,
+                         "sent_at": now if status == "sent" else None})
+            sent += status == "sent"
+            failed += status == "failed"
+        async with get_async_db() as db:
+            await db.execute(update(BroadcastRecipient), rows)
+            await db.execute(update(BroadcastJob).where(BroadcastJob.id == job_id).values(
+                sent_count=BroadcastJob.sent_count + sent,
+                failed_count=BroadcastJob.failed_count + failed,
+            ))
+            await db.commit()
+        logger.info(f"Broadcast job {job_id}: chunk of {len(recipients)} done ({sent} sent, {failed} failed).")
+
+    async def deliver(self, send, recipient) -> tuple[str, str | None, int]:
+        attempts = recipient.attempts
+        async with self.semaphore:
+            while True:
+                attempts += 1
+                await self.limiter.acquire(recipient.telegram_id)
+                try:
+                    await send(recipient.telegram_id)
+                    return "sent", None, attempts
+                except TelegramRetryAfter as e:
+                    logger.warning(f"Flood control hit, pausing broadcast for {e.retry_after}s")
+                    self.limiter.pause(e.retry_after)
+                    # A 429 is Telegram throttling us, not a failed attempt
+                    attempts -= 1
+                except (TelegramForbiddenError, TelegramBadRequest) as e:
+                    return "failed", str(e), attempts
+                except Exception as e:
+                    if attempts >= self.max_attempts:
+                        return "failed", str(e), attempts
+                    await asyncio.sleep(min(2 ** attempts, 30))
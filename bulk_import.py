@@ -0,0 +1,196 @@
+import csv
+import itertools
+import logging
+import re
+from dataclasses import dataclass, field
+from typing import IO, Callable, Iterable, Iterator
+
+from access_cache import access_cache
+from config import IMPORT_CHUNK_SIZE, IMPORT_CHUNKS_PER_TRANSACTION
+from models import User, Whitelist, dialect_insert, engine, refresh_user_access
+
+logger = logging.getLogger(__name__)
+
+DELIMITERS = ",\t;"
+MAX_TELEGRAM_ID = 2 ** 63 - 1
+MAX_ERRORS = 20
+_EMAIL = re.compile(r"[^@\s]+@[^@\s]+\.[^@\s]+")
+_TRUE = {"1", "true", "yes", "y", "да"}
+_FALSE = {"0", "false", "no", "n", "нет"}
+
+# Column order of files without a header, and the header names each column may go by
+WHITELIST_COLUMNS = ("telegram_id",)
+USER_COLUMNS = ("telegram_id", "email", "telegram_username", "is_active")
+COLUMN_ALIASES = {
+    "telegram_id": ("telegram_id", "telegram id", "tg_id", "id"),
+    "email": ("email", "e-mail", "mail"),
+    "telegram_username": ("telegram_username", "username", "telegram username"),
+    "is_active": ("is_active", "active"),
+}
+
+
+class ImportFormatError(ValueError):
+    pass
+
+
+@dataclass
+class ImportReport:
+    rows: int = 0
+    inserted: int = 0
+    # Valid rows already in the table or repeated within the file
+    skipped: int = 0
+    invalid: int = 0
+    # (line number, reason) of the first MAX_ERRORS invalid rows
+    errors: list[tuple[int, str]] = field(default_factory=list)
+
+    def reject(self, line: int, reason: str) -> None:
+        self.invalid += 1
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append((line, reason))
+
+    def as_dict(self) -> dict:
+        return {"rows": self.rows, "inserted": self.inserted, "skipped": self.skipped, "invalid": self.invalid}
+
+
+def read_rows(stream: IO[str], columns: tuple[str, ...]) -> Iterator[tuple[int, dict]]:
+    # Yields (line number, {column: raw value}) one row at a time. The
+    # delimiter is whichever of , tab ; the first line has most of; a first
+    # line not starting with a number is a header naming the columns
+    first = stream.readline()
+    if not first:
+        return
+    delimiter = max(DELIMITERS, key=first.count)
+    reader = csv.reader(itertools.chain([first], stream), delimiter=delimiter)
+    header = next(reader)
+    if header and header[0].strip().isdigit():
+        positions = {name: index for index, name in enumerate(columns)}
+        rows = itertools.chain([header], reader)
+    else:
+        names = [name.strip().lower() for name in header]
+        positions = {}
+        for column in columns:
+            for alias in COLUMN_ALIASES[column]:
+                if alias in names:
+                    positions[column] = names.index(alias)
+                    break
+        if columns[0] not in positions:
+            raise ImportFormatError(f"header has no {columns[0]} column: {', '.join(header)}")
+        rows = reader
+    for row in rows:
+        if not any(value.strip() for value in row):
+            continue
+        yield reader.line_num, {column: row[index].strip() if index < len(row) else ""
+                                for column, index in positions.items()}
+
+
+def parse_telegram_id(value: str) -> int:
+    telegram_id = int(value)
+    if not 0 < telegram_id <= MAX_TELEGRAM_ID:
+        raise ValueError(value)
+    return telegram_id
+
+
+def whitelist_row(values: dict) -> dict:
+    try:
+        return {"telegram_id": parse_telegram_id(values["telegram_id"])}
+    except ValueError:
+        raise ValueError(f"telegram_id {values['telegram_id']!r} is not a Telegram ID")
+
+
+def user_row(values: dict) -> dict:
+    row = whitelist_row(values)
+    email = values.get("email", "")
+    if not _EMAIL.fullmatch(email) or len(email) > 254:
+        raise ValueError(f"email {email!r} is not an email address")
+    active = values.get("is_active", "").lower()
+    if active and active not in _TRUE | _FALSE:
+        raise ValueError(f"is_active {values['is_active']!r} is not a yes/no value")
+    row["email"] = email
+    row["telegram_username"] = values.get("telegram_username", "").lstrip("@") or None
+    row["is_active"] = active not in _FALSE
+    return row
+
+
+def _valid_rows(report: ImportReport, rows: Iterable[tuple[int, dict]],
+                parse: Callable[[dict], dict]) -> Iterator[dict]:
+    for line, values in rows:
+        report.rows += 1
+        try:
+            yield parse(values)
+        except ValueError as e:
+            report.reject(line, str(e))
+
+
+def _chunks(rows: Iterable[dict], size: int, keys: tuple[str, ...]) -> Iterator[list[dict]]:
+    # Rows repeating a unique key of an earlier row in the same chunk are
+    # dropped here; repeats across chunks and existing rows are left to
+    # ON CONFLICT DO NOTHING
+    iterator = iter(rows)
+    while chunk := list(itertools.islice(iterator, size)):
+        seen = {key: set() for key in keys}
+        unique = []
+        for row in chunk:
+            if any(row[key] in seen[key] for key in keys):
+                continue
+            for key in keys:
+                seen[key].add(row[key])
+            unique.append(row)
+        yield unique
+
+
+def _write(report: ImportReport, chunks: Iterator[list[dict]], write: Callable, bind,
+           chunks_per_transaction: int) -> None:
+    # Only one chunk is held at a time; every chunks_per_transaction chunks
+    # are committed together, so a failure keeps the batches committed before it
+    for first in chunks:
+        with bind.begin() as connection:
+            for chunk in itertools.chain([first], itertools.islice(chunks, chunks_per_transaction - 1)):
+                report.inserted += write(connection, chunk)
+
+
+def _run(stream: IO[str], columns: tuple[str, ...], parse: Callable[[dict], dict], keys: tuple[str, ...],
+         write: Callable, bind, chunk_size: int, chunks_per_transaction: int) -> ImportReport:
+    report = ImportReport()
+    rows = _valid_rows(report, read_rows(stream, columns), parse)
+    _write(report, _chunks(rows, chunk_size, keys), write, bind, chunks_per_transaction)
+    report.skipped = report.rows - report.invalid - report.inserted
+    if report.inserted:
+        # One cache-wide reset instead of an invalidation per imported id
+        access_cache.clear()
+    return report
+
+
+def _insert_whitelist(connection, chunk: list[dict]) -> int:
+    whitelist = Whitelist.__table__
+    insert = dialect_insert(connection.dialect.name, whitelist)
+    inserted = connection.execute(insert.on_conflict_do_nothing(index_elements=[whitelist.c.telegram_id])
+                                  .returning(whitelist.c.telegram_id), chunk).scalars().all()
+    refresh_user_access(connection, telegram_ids=inserted)
+    return len(inserted)
+
+
+def _insert_users(connection, chunk: list[dict]) -> int:
+    users = User.__table__
+    insert = dialect_insert(connection.dialect.name, users)
+    # Conflicts on either unique column (telegram_id, email) skip the row
+    inserted = connection.execute(insert.on_conflict_do_nothing().returning(users.c.telegram_id),
+                                  chunk).scalars().all()
+    # Picks up whitelist entries made before the user was imported
+    refresh_user_access(connection, telegram_ids=inserted)
+    return len(inserted)
+
+
+def import_whitelist(stream: IO[str], bind=engine, chunk_size: int = IMPORT_CHUNK_SIZE,
+                     chunks_per_transaction: int = IMPORT_CHUNKS_PER_TRANSACTION) -> ImportReport:
+    report = _run(stream, WHITELIST_COLUMNS, whitelist_row, ("telegram_id",), _insert_whitelist, bind,
+                  chunk_size, chunks_per_transaction)
+    logger.info(f"Whitelist import: {report.as_dict()}")
+    return report
+
+
+def import_users(stream: IO[str], bind=engine, chunk_size: int = IMPORT_CHUNK_SIZE,
+                 chunks_per_transaction: int = IMPORT_CHUNKS_PER_TRANSACTION) -> ImportReport:
+    report = _run(stream, USER_COLUMNS, user_row, ("telegram_id", "email"), _insert_users, bind,
+                  chunk_size, chunks_per_transaction)
+    logger.info(f"User import: {report.as_dict()}")
+    return report
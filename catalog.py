@@ -0,0 +1,306 @@
+import asyncio
+import json
+import logging
+from dataclasses import dataclass, field
+from types import MappingProxyType
+
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+from sqlalchemy import select
+
+import queries
+from config import (
+    ADMIN_TG_ACCOUNT,
+    COMPANY_NAME,
+    COMPANY_REGISTRATION_NUMBER,
+    COMPANY_ADDRESS,
+    COMPANY_BANK,
+    COMPANY_ACCOUNT,
+    COMPANY_SWIFT,
+    COMPANY_IBAN,
+    SUBSCRIPTION_PRICE,
+    SUBSCRIPTION_DAYS,
+    MESSAGE_CATALOG_INTERVAL,
+    OFFER_URL,
+    PRIVACY_URL
+)
+from database import get_async_db
+from models import CatalogMessage
+
+logger = logging.getLogger(__name__)
+
+PARSE_MODES = ("Markdown", "HTML")
+
+
+@dataclass(frozen=True)
+class MessageDefault:
+    title: str
+    text: str
+    parse_mode: str | None = None
+    disable_web_page_preview: bool = False
+    keyboard: tuple = ()
+    # Filled in per call; everything else is substituted when the catalog loads
+    fields: tuple[str, ...] = ()
+
+
+PAY_BUTTON = {"text": "Оплатить {price}₽", "callback_data": "process_payment"}
+PROMO_BUTTON = {"text": "Ввести промокод", "callback_data": "enter_promo"}
+DISABLE_RENEWAL_BUTTON = {"text": "Отключить автоплатеж", "callback_data": "disable_auto_renewal"}
+BACK_BUTTON = {"text": "« Назад", "callback_data": "buy_access"}
+
+# "tariff" is a fragment: the other messages include it as {tariff}
+DEFAULT_MESSAGES = {
+    "tariff": MessageDefault(
+        "Описание тарифа (подставляется как {tariff})",
+        "📚 Продукт: Приватный чат \"СИСТЕМНИК УБТ ПРИВАТ\"\n\n"
+        "🗓 Тарифный план: СИСТЕМНИК УБТ (Карта РФ)\n\n"
+        "— Тип платежа: Автоплатеж с интервалом {days}d 0h 0m\n"
+        "— Сумма к оплате: {price} RUB\n\n"
+        "После оплаты будет предоставлен доступ:\n\n"
+        "— Группа «СИСТЕМНИК УБТ ПРИВАТ»\n\n"
+        "Оплачивая подписку вы принимаете условия "
+        "[Публичной оферты]({offer_url}) и "
+        "[Политики конфиденциальности]({privacy_url})",
+        parse_mode="Markdown",
+    ),
+    "subscription_inactive": MessageDefault(
+        "Моя подписка: доступа нет",
+        "{tariff}",
+        parse_mode="Markdown",
+        disable_web_page_preview=True,
+        keyboard=((PAY_BUTTON, PROMO_BUTTON), (DISABLE_RENEWAL_BUTTON,)),
+    ),
+    "subscription_active": MessageDefault(
+        "Моя подписка: доступ активен",
+        "✅ Ваш доступ к обучающему курсу активен до: {end_date}\n\n"
+        "{auto_renewal}\n\n"
+        "Для продления подписки нажмите на кнопку ниже:",
+        keyboard=(({"text": "Продлить подписку", "callback_data": "buy_access"}, PROMO_BUTTON),
+                  (DISABLE_RENEWAL_BUTTON,)),
+        fields=("end_date", "auto_renewal"),
+    ),
+    "subscription_whitelisted": MessageDefault(
+        "Моя подписка: белый список",
+        "✅ У вас постоянный доступ к курсу (белый список).",
+    ),
+    "buy_access": MessageDefault(
+        "Покупка доступа",
+        "{tariff}",
+        parse_mode="Markdown",
+        disable_web_page_preview=True,
+        keyboard=((PAY_BUTTON,), (PROMO_BUTTON,)),
+    ),
+    "process_payment": MessageDefault(
+        "Оплата",
+        "{tariff}",
+        parse_mode="Markdown",
+        disable_web_page_preview=True,
+    ),
+    "auto_renewal_disabled": MessageDefault(
+        "Автоплатеж отключен",
+        "Автоплатежи отключены! ✅\n"
+        "В следующем месяце не будет списания.",
+        keyboard=(({"text": "« Назад к подписке", "callback_data": "show_subscription"},),),
+    ),
+    "start_offer": MessageDefault(
+        "Ссылка на оферту (/start offer)",
+        "Публичная оферта доступна по ссылке:\n{offer_url}",
+        disable_web_page_preview=True,
+    ),
+    "start_privacy": MessageDefault(
+        "Ссылка на политику (/start privacy)",
+        "Политика конфиденциальности доступна по ссылке:\n{privacy_url}",
+        disable_web_page_preview=True,
+    ),
+    "offer": MessageDefault(
+        "Публичная оферта",
+        "📜 *ПУБЛИЧНАЯ ОФЕРТА*\n\n"
+        "1. ОБЩИЕ ПОЛОЖЕНИЯ\n\n"
+        "1.1. Настоящая оферта является предложением заключить договор на оказание информационных услуг.\n"
+        "1.2. Акцептом оферты является оплата услуг.\n\n"
+        "2. УСЛОВИЯ ПОДПИСКИ\n\n"
+        "2.1. Подписка предоставляется на {days} дней.\n"
+        "2.2. Автопродление происходит автоматически.\n"
+        "2.3. Отмена подписки возможна в любой момент.\n\n"
+        "[Полный текст оферты]({offer_url})",
+        parse_mode="Markdown",
+        disable_web_page_preview=True,
+        keyboard=((BACK_BUTTON,),),
+    ),
+    "privacy": MessageDefault(
+        "Политика конфиденциальности",
+        "🔒 *ПОЛИТИКА КОНФИДЕНЦИАЛЬНОСТИ*\n\n"
+        "1. ОБРАБОТКА ДАННЫХ\n\n"
+        "1.1. Мы обрабатываем только те данные, которые необходимы для оказания услуг.\n"
+        "1.2. Ваши персональные данные не передаются третьим лицам.\n\n"
+        "2. ХРАНЕНИЕ ИНФОРМАЦИИ\n\n"
+        "2.1. Данные хранятся на защищенных серверах.\n"
+        "2.2. Срок хранения определяется законодательством.\n\n"
+        "[Полный текст политики]({privacy_url})",
+        parse_mode="Markdown",
+        disable_web_page_preview=True,
+        keyboard=((BACK_BUTTON,),),
+    ),
+    "requisites": MessageDefault(
+        "Реквизиты",
+        "📋 *РЕКВИЗИТЫ КОМПАНИИ*\n\n"
+        "Название компании: {company_name}\n"
+        "Регистрационный номер: {company_registration_number}\n"
+        "Адрес: {company_address}\n\n"
+        "Банковские реквизиты:\n"
+        "Банк: {company_bank}\n"
+        "Счет: {company_account}\n"
+        "SWIFT: {company_swift}\n"
+        "IBAN: {company_iban}",
+        parse_mode="Markdown",
+        keyboard=((BACK_BUTTON,),),
+    ),
+    "support": MessageDefault(
+        "Поддержка",
+        "Если не получается оплатить, читаем:\n\n"
+        "⚠️ Бот иногда не справляется с большими наплывами участников. "
+        "Пробуйте раз в несколько минут, или через час, в любом случае рано или поздно всё прогрузится!\n\n"
+        "📨 Только по долгим проблемам с оплатой — {support_contact}",
+    ),
+}
+
+
+def variables(price: int) -> dict:
+    return {
+        "price": price,
+        "days": SUBSCRIPTION_DAYS,
+        "offer_url": OFFER_URL,
+        "privacy_url": PRIVACY_URL,
+        "support_contact": f"@{ADMIN_TG_ACCOUNT}",
+        "company_name": COMPANY_NAME,
+        "company_registration_number": COMPANY_REGISTRATION_NUMBER,
+        "company_address": COMPANY_ADDRESS,
+        "company_bank": COMPANY_BANK,
+        "company_account": COMPANY_ACCOUNT,
+        "company_swift": COMPANY_SWIFT,
+        "company_iban": COMPANY_IBAN,
+    }
+
+
+def parse_keyboard(raw: str | None) -> list:
+    if not raw or not raw.strip():
+        return []
+    rows = json.loads(raw)
+    if not isinstance(rows, list) or not all(isinstance(row, list) for row in rows):
+        raise ValueError("клавиатура должна быть списком рядов кнопок")
+    for row in rows:
+        for button in row:
+            if not isinstance(button, dict) or not isinstance(button.get("text"), str) \
+                    or not (isinstance(button.get("callback_data"), str) or isinstance(button.get("url"), str)):
+                raise ValueError("у каждой кнопки должны быть text и callback_data или url")
+    return rows
+
+
+def dump_keyboard(rows) -> str:
+    return json.dumps([list(row) for row in rows], ensure_ascii=False, indent=1) if rows else ""
+
+
+@dataclass(frozen=True)
+class RenderedMessage:
+    text: str
+    parse_mode: str | None
+    disable_web_page_preview: bool
+    reply_markup: InlineKeyboardMarkup | None
+    fields: tuple[str, ...]
+    # Catalog values for messages with per-call fields, whose text stays a template
+    values: dict = field(default_factory=dict, compare=False)
+
+    def kwargs(self, **values) -> dict:
+        return {"text": self.text.format_map({**self.values, **values}) if self.fields else self.text,
+                "parse_mode": self.parse_mode,
+                "disable_web_page_preview": self.disable_web_page_preview or None,
+                "reply_markup": self.reply_markup}
+
+
+def render(text: str, parse_mode: str | None, disable_web_page_preview: bool, keyboard: list,
+           fields: tuple[str, ...], values: dict) -> RenderedMessage:
+    # An unknown name raises KeyError. Texts with per-call fields are formatted
+    # once, in kwargs(), so a literal {{ }} is unescaped only once; here they are
+    # only checked the same way with blanks for the fields
+    if fields:
+        text.format_map({**values, **{name: "" for name in fields}})
+    else:
+        text = text.format_map(values)
+    markup = None
+    if keyboard:
+        markup = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(**{**button, "text": button["text"].format_map(values)}) for button in row]
+            for row in keyboard
+        ])
+    return RenderedMessage(text, parse_mode if parse_mode in PARSE_MODES else None,
+                           bool(disable_web_page_preview), markup, fields, dict(values) if fields else {})
+
+
+def render_all(price: int, overrides: dict) -> dict[str, RenderedMessage]:
+    # overrides: key -> (text, parse_mode, disable_web_page_preview, keyboard rows)
+    values = variables(price)
+    messages = {}
+    for key in ["tariff"] + [key for key in DEFAULT_MESSAGES if key != "tariff"]:
+        default = DEFAULT_MESSAGES[key]
+        built = (default.text, default.parse_mode, default.disable_web_page_preview, default.keyboard)
+        try:
+            messages[key] = render(*overrides.get(key, built), default.fields, values)
+        except (KeyError, ValueError, IndexError, TypeError) as e:
+            logger.error(f"Catalog message {key} is broken ({e!r}), using the built-in text")
+            messages[key] = render(*built, default.fields, values)
+        if key == "tariff":
+            values["tariff"] = messages[key].text
+    return messages
+
+
+# Texts and keyboards the bot sends, rendered once per catalog version into
+# immutable RenderedMessage objects that handlers send as they are. Rows in
+# catalog_messages override the built-in defaults above; the admin panel bumps
+# catalog_state.version with every edit, and run() only rebuilds the catalog
+# when that counter moves, so handlers never touch the database for it
+class MessageCatalog:
+    def __init__(self, interval: float = MESSAGE_CATALOG_INTERVAL):
+        self.interval = interval
+        self.version: int | None = None
+        self.price = SUBSCRIPTION_PRICE
+        self.reloads = 0
+        self._messages = MappingProxyType(render_all(self.price, {}))
+
+    def __getitem__(self, key: str) -> RenderedMessage:
+        return self._messages[key]
+
+    async def run(self) -> None:
+        logger.info("Message catalog watcher started.")
+        while True:
+            try:
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Message catalog refresh failed")
+            await asyncio.sleep(self.interval)
+
+    async def refresh(self) -> bool:
+        async with get_async_db() as db:
+            state = (await db.execute(queries.catalog_state())).first()
+            if state is None or state.version == self.version:
+                return False
+            rows = (await db.execute(select(CatalogMessage))).scalars().all()
+        overrides = {}
+        for row in rows:
+            try:
+                overrides[row.key] = (row.text, row.parse_mode, row.disable_web_page_preview, parse_keyboard(row.keyboard))
+            except ValueError as e:
+                logger.error(f"Catalog message {row.key} has a broken keyboard ({e}), using the built-in one")
+        price = state.price or SUBSCRIPTION_PRICE
+        self._messages = MappingProxyType(render_all(price, overrides))
+        self.price = price
+        self.version = state.version
+        self.reloads += 1
+        logger.info(f"Message catalog loaded at version {state.version} ({len(overrides)} overridden)")
+        return True
+
+    def stats(self) -> dict:
+        return {"version": self.version, "reloads": self.reloads, "price": self.price}
+
+
+message_catalog = MessageCatalog()
@@ -1,4 +1,5 @@
 import os
+from urllib.parse import urlparse
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -24,19 +25,131 @@ COMPANY_ACCOUNT = os.getenv("COMPANY_ACCOUNT", "123456789012")
 COMPANY_SWIFT = os.getenv("COMPANY_SWIFT", "SWIFTCODE")
 COMPANY_IBAN = os.getenv("COMPANY_IBAN", "IBAN123456789")
 
-MERCHANT_ID = "your_merchant_id"
-MERCHANT_SECRET_KEY = "your_secret_key"
+MERCHANT_ID = os.getenv("MERCHANT_ID", "your_merchant_id")
+# Signs payment provider callbacks; without it the callback endpoint is not served
+MERCHANT_SECRET_KEY = os.getenv("MERCHANT_SECRET_KEY", "")
+if MERCHANT_SECRET_KEY == "your_secret_key":
+    MERCHANT_SECRET_KEY = ""
 PAYMENT_SUCCESS_URL = "https://your-site.com/success"
 PAYMENT_FAIL_URL = "https://your-site.com/fail"
 PAYMENT_NOTIFICATION_URL = "https://your-site.com/payment/callback"
 
 ADMIN_SECRET_KEY = "your-secret-key-here"
 
+ACCESS_CACHE_SIZE = int(os.getenv("ACCESS_CACHE_SIZE", "10000"))
+ACCESS_CACHE_TTL = int(os.getenv("ACCESS_CACHE_TTL", "300"))
+
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+WEBHOOK_CONCURRENCY = int(os.getenv("WEBHOOK_CONCURRENCY", "16"))
+WEB_BIND = os.getenv("WEB_BIND", "0.0.0.0:8000")
+
+# "process" runs the admin panel in a supervised child process on ADMIN_BIND
+# (WEB_BIND when polling); "thread" serves it from a thread pool next to the bot,
+# where its rendering still competes with update handling for the GIL
+ADMIN_MODE = os.getenv("ADMIN_MODE", "process").lower()
+ADMIN_THREADS = int(os.getenv("ADMIN_THREADS", "8"))
+ADMIN_BIND = os.getenv("ADMIN_BIND", "0.0.0.0:8001")
+USERS_PAGE_SIZE = int(os.getenv("USERS_PAGE_SIZE", "50"))
+USERS_COUNT_TTL = int(os.getenv("USERS_COUNT_TTL", "60"))
+USER_SEARCH_LIMIT = int(os.getenv("USER_SEARCH_LIMIT", "10"))
+USER_SEARCH_BUDGET_MS = int(os.getenv("USER_SEARCH_BUDGET_MS", "200"))
+
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "20"))
+BROADCAST_CHUNK_SIZE = int(os.getenv("BROADCAST_CHUNK_SIZE", "500"))
+BROADCAST_MAX_ATTEMPTS = int(os.getenv("BROADCAST_MAX_ATTEMPTS", "3"))
+BROADCAST_POLL_INTERVAL = float(os.getenv("BROADCAST_POLL_INTERVAL", "2"))
+
+MEDIA_DIR = os.getenv("MEDIA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "media"))
+MEDIA_UPLOAD_CHAT_ID = int(os.getenv("MEDIA_UPLOAD_CHAT_ID", "0")) or None
+
+FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL", str(24 * 3600)))
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "10000"))
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", "0.5"))
+FSM_FLUSH_BATCH = int(os.getenv("FSM_FLUSH_BATCH", "200"))
+
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS", "0"))
+SHARD_REPORT_INTERVAL = float(os.getenv("SHARD_REPORT_INTERVAL", "60"))
+
+# Reminders go out at 00:00 UTC this many days before the expiry day (0 = on the day)
+EXPIRY_REMINDER_DAYS = [int(days) for days in os.getenv("EXPIRY_REMINDER_DAYS", "3,0").split(",") if days.strip()]
+EXPIRY_RELOAD_INTERVAL = float(os.getenv("EXPIRY_RELOAD_INTERVAL", "3600"))
+EXPIRY_CATCHUP = int(os.getenv("EXPIRY_CATCHUP", str(24 * 3600)))
+EXPIRY_BATCH_SIZE = int(os.getenv("EXPIRY_BATCH_SIZE", "500"))
+
+SUBSCRIPTION_PRICE = int(os.getenv("SUBSCRIPTION_PRICE", "1500"))
+SUBSCRIPTION_DAYS = int(os.getenv("SUBSCRIPTION_DAYS", "30"))
+
+# Auto-renewal is off until a provider is configured ("fake" charges nothing, for local runs)
+PAYMENT_PROVIDER = os.getenv("PAYMENT_PROVIDER", "").lower()
+RENEWAL_INTERVAL = float(os.getenv("RENEWAL_INTERVAL", "600"))
+RENEWAL_LEAD = int(os.getenv("RENEWAL_LEAD", str(24 * 3600)))
+RENEWAL_GRACE = int(os.getenv("RENEWAL_GRACE", str(3 * 24 * 3600)))
+RENEWAL_CHUNK_SIZE = int(os.getenv("RENEWAL_CHUNK_SIZE", "500"))
+RENEWAL_CONCURRENCY = int(os.getenv("RENEWAL_CONCURRENCY", "20"))
+
+# Provider callbacks are served on the path of PAYMENT_NOTIFICATION_URL
+PAYMENT_NOTIFICATION_PATH = urlparse(PAYMENT_NOTIFICATION_URL).path or "/payment/callback"
+PAYMENT_INGEST_BATCH = int(os.getenv("PAYMENT_INGEST_BATCH", "500"))
+PAYMENT_INGEST_TIMEOUT = float(os.getenv("PAYMENT_INGEST_TIMEOUT", "5"))
+PAYMENT_CONSUMER_BATCH = int(os.getenv("PAYMENT_CONSUMER_BATCH", "500"))
+PAYMENT_CONSUMER_INTERVAL = float(os.getenv("PAYMENT_CONSUMER_INTERVAL", "1"))
+
+PROMO_CACHE_TTL = float(os.getenv("PROMO_CACHE_TTL", "60"))
+
+REFERRAL_FLUSH_INTERVAL = float(os.getenv("REFERRAL_FLUSH_INTERVAL", "1"))
+REFERRAL_FLUSH_BATCH = int(os.getenv("REFERRAL_FLUSH_BATCH", "200"))
+REFERRAL_LEADERBOARD_SIZE = int(os.getenv("REFERRAL_LEADERBOARD_SIZE", "50"))
+
+# Prometheus text format on METRICS_PATH of every web server run.py starts; when
+# polling with the admin panel in its own process, the bot's metrics are on METRICS_BIND
+METRICS_PATH = os.getenv("METRICS_PATH", "/metrics")
+METRICS_BIND = os.getenv("METRICS_BIND", "127.0.0.1:9100")
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+METRICS_WORKER_INTERVAL = float(os.getenv("METRICS_WORKER_INTERVAL", "10"))
+
+# Development/staging only: report N+1 shapes, slow statements and full scans per update/request
+SQL_PROFILE = os.getenv("SQL_PROFILE", "false").lower() == "true"
+SQL_PROFILE_PATH = os.getenv("SQL_PROFILE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "sql_profile.jsonl"))
+SQL_PROFILE_SLOW_MS = float(os.getenv("SQL_PROFILE_SLOW_MS", "50"))
+SQL_PROFILE_REPEAT = int(os.getenv("SQL_PROFILE_REPEAT", "3"))
+SQL_PROFILE_STACK_DEPTH = int(os.getenv("SQL_PROFILE_STACK_DEPTH", "6"))
+SQL_PROFILE_EXPLAIN = os.getenv("SQL_PROFILE_EXPLAIN", "true").lower() == "true"
+
+# Texts and keyboards are edited in the admin panel; the bot polls the catalog version
+MESSAGE_CATALOG_INTERVAL = float(os.getenv("MESSAGE_CATALOG_INTERVAL", "5"))
+OFFER_URL = os.getenv("OFFER_URL", "https://docs.google.com/document/d/1tgPqQTkjQDgftj-a0vNOgs53mi7-sctjv4WJ2BF9DTA/edit")
+PRIVACY_URL = os.getenv("PRIVACY_URL", "https://docs.google.com/document/d/10s0vc9sBXMeC8a-_VGSXzCPi0Z5k4AMy/edit")
+
+# Anonymized recording of incoming updates for benchmarks/replay.py. All processes
+# recording the same bot need the same UPDATE_RECORD_KEY to remap ids alike
+UPDATE_RECORD = os.getenv("UPDATE_RECORD", "false").lower() == "true"
+UPDATE_RECORD_DIR = os.getenv("UPDATE_RECORD_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "recordings"))
+UPDATE_RECORD_KEY = os.getenv("UPDATE_RECORD_KEY", "")
+UPDATE_RECORD_ROTATE_MB = float(os.getenv("UPDATE_RECORD_ROTATE_MB", "64"))
+UPDATE_RECORD_ROTATE_MINUTES = float(os.getenv("UPDATE_RECORD_ROTATE_MINUTES", "60"))
+UPDATE_RECORD_KEEP_FILES = int(os.getenv("UPDATE_RECORD_KEEP_FILES", "168"))
+UPDATE_RECORD_FLUSH_INTERVAL = float(os.getenv("UPDATE_RECORD_FLUSH_INTERVAL", "2"))
+
+# Bulk CSV/TSV imports (bulk_import.py): rows per INSERT batch and batches per transaction
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", "1000"))
+IMPORT_CHUNKS_PER_TRANSACTION = int(os.getenv("IMPORT_CHUNKS_PER_TRANSACTION", "20"))
+
 if BOT_TOKEN == "YOUR_BOT_TOKEN_HERE":
     print("Warning: BOT_TOKEN is not set in .env file. Please set it.")
 
 if ADMIN_PASSWORD == "password":
     print("Warning: Default ADMIN_PASSWORD is used. Please change it in .env file for security.")
 
+if BOT_MODE == "webhook" and not WEBHOOK_SECRET:
+    print("Warning: BOT_MODE=webhook without WEBHOOK_SECRET accepts updates from anyone. Please set it.")
+
+if not MERCHANT_SECRET_KEY:
+    print("Warning: MERCHANT_SECRET_KEY is not set, payment callbacks are not accepted. Please set it.")
+
 if ADMIN_TG_ACCOUNT == "Illovesme" and not os.getenv("ADMIN_TG_ACCOUNT"):
     print("Info: Using default ADMIN_TG_ACCOUNT (@Illovesme). You can set your own in the .env file.") 
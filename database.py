@@ -1,3 +1,3 @@
-from models import init_db, get_db
+from models import init_db, get_db, get_async_db
 
-__all__ = ["init_db", "get_db"] 
\ No newline at end of file
+__all__ = ["init_db", "get_db", "get_async_db"]
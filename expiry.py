@@ -0,0 +1,280 @@
+import asyncio
+import datetime
+import heapq
+import logging
+import time
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+from sqlalchemy import delete, select
+
+import queries
+from access_cache import access_cache, as_utc
+from broadcast import RateLimiter
+from config import EXPIRY_REMINDER_DAYS, EXPIRY_RELOAD_INTERVAL, EXPIRY_CATCHUP, EXPIRY_BATCH_SIZE
+from database import get_async_db
+from models import ExpiryNotice, User, async_engine, dialect_insert
+
+logger = logging.getLogger(__name__)
+
+DAY = 24 * 3600
+EXPIRED = "expired"
+
+
+def utc(timestamp: float) -> datetime.datetime:
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc)
+
+
+def reminder_kind(days: int) -> str:
+    return f"reminder_{days}"
+
+
+# Fires expiry reminders and expiry notices from a min-heap of timers instead
+# of polling subscriptions. Only expiries within `horizon` are held in memory:
+# the window is extended by an indexed range scan on users.access_until every
+# `reload_interval`, and access-cache invalidations (subscription, whitelist
+# and account changes) re-read the affected users. Heap entries are never
+# removed in place; one whose access_until no longer matches `expiries` is
+# skipped when it comes up. Each notice is recorded in expiry_notices before it
+# is sent, so a restart never repeats one
+class ExpiryScheduler:
+    def __init__(self, bot: Bot, limiter: RateLimiter, reminder_days: list[int] = EXPIRY_REMINDER_DAYS,
+                 reload_interval: float = EXPIRY_RELOAD_INTERVAL, catchup: float = EXPIRY_CATCHUP,
+                 batch_size: int = EXPIRY_BATCH_SIZE):
+        self.bot = bot
+        self.limiter = limiter
+        self.reminder_days = sorted(set(reminder_days), reverse=True)
+        self.reload_interval = reload_interval
+        self.catchup = catchup
+        self.batch_size = batch_size
+        self.horizon = (max(self.reminder_days, default=0) + 1) * DAY + reload_interval
+        self.heap: list[tuple[float, int, float, str]] = []
+        self.expiries: dict[int, tuple[int, float]] = {}
+        self.loaded_until = 0.0
+        self.next_reload = 0.0
+        self.sent = 0
+        self.failed = 0
+        self._changed: set[int | None] = set()
+        self._wake = asyncio.Event()
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+    def invalidate(self, telegram_id: int | None) -> None:
+        # Called from admin request threads as well as the event loop
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._mark_changed, telegram_id)
+
+    def _mark_changed(self, telegram_id: int | None) -> None:
+        self._changed.add(telegram_id)
+        self._wake.set()
+
+    async def run(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        access_cache.listeners.append(self.invalidate)
+        logger.info("Expiry scheduler started.")
+        try:
+            while True:
+                try:
+                    await self.step()
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    logger.exception("Expiry scheduler iteration failed")
+                    await asyncio.sleep(5)
+                await self.wait()
+        finally:
+            access_cache.listeners.remove(self.invalidate)
+            self._loop = None
+
+    async def wait(self) -> None:
+        now = time.time()
+        timeout = self.next_reload - now
+        if self.heap:
+            timeout = min(timeout, self.heap[0][0] - now)
+        if timeout > 0:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+        self._wake.clear()
+
+    async def step(self) -> None:
+        now = time.time()
+        if None in self._changed:
+            self._changed.clear()
+            await self.reset(now)
+        elif self._changed:
+            changed, self._changed = self._changed, set()
+            await self.refresh(changed, now)
+        if now >= self.next_reload:
+            if not self.loaded_until:
+                await self.reset(now)
+            else:
+                await self.load(self.loaded_until, now + self.horizon)
+                await self.prune(now)
+            self.next_reload = now + self.reload_interval
+        while self.heap and self.heap[0][0] <= time.time():
+            await self.fire(self.pop_due(time.time()))
+
+    async def reset(self, now: float) -> None:
+        self.heap.clear()
+        self.expiries.clear()
+        # Expiries missed while the bot was down are still delivered, once
+        await self.load(now - self.catchup, now + self.horizon)
+
+    async def load(self, start: float, end: float) -> None:
+        loaded = 0
+        async with get_async_db() as db:
+            sent = await self.sent_notices(db, ExpiryNotice.access_until > utc(start),
+                                           ExpiryNotice.access_until <= utc(end))
+            result = await db.stream(queries.users_expiring_between(utc(start), utc(end))
+                                     .execution_options(yield_per=5000))
+            async for user_id, telegram_id, access_until in result:
+                until = as_utc(access_until).timestamp()
+                self.schedule(user_id, telegram_id, until, sent.get((user_id, until), set()))
+                loaded += 1
+        self.loaded_until = max(self.loaded_until, end)
+        logger.info(f"Scheduled {loaded} expiries up to {utc(end):%Y-%m-%d %H:%M} UTC ({len(self.heap)} timers)")
+
+    async def refresh(self, telegram_ids: set[int], now: float) -> None:
+        # Renewals can invalidate a whole chunk of users at once
+        ordered = list(telegram_ids)
+        for start in range(0, len(ordered), 1000):
+            await self.refresh_chunk(ordered[start:start + 1000], now)
+
+    async def refresh_chunk(self, telegram_ids: list[int], now: float) -> None:
+        async with get_async_db() as db:
+            rows = (await db.execute(
+                select(User.id, User.telegram_id, User.access_until, User.is_whitelisted, User.is_active)
+                .where(User.telegram_id.in_(telegram_ids))
+            )).all()
+            user_ids = [row.id for row in rows]
+            sent = await self.sent_notices(db, ExpiryNotice.user_id.in_(user_ids)) if user_ids else {}
+        scheduled = set()
+        for row in rows:
+            if row.access_until is None or row.is_whitelisted or not row.is_active:
+                continue
+            until = as_utc(row.access_until).timestamp()
+            if now - self.catchup < until <= self.loaded_until:
+                self.schedule(row.id, row.telegram_id, until, sent.get((row.id, until), set()))
+                scheduled.add(row.telegram_id)
+        for telegram_id in telegram_ids:
+            if telegram_id not in scheduled:
+                self.expiries.pop(telegram_id, None)
+
+    async def sent_notices(self, db, *conditions) -> dict[tuple[int, float], set[str]]:
+        sent: dict[tuple[int, float], set[str]] = {}
+        result = await db.execute(
+            select(ExpiryNotice.user_id, ExpiryNotice.access_until, ExpiryNotice.kind).where(*conditions)
+        )
+        for user_id, access_until, kind in result:
+            sent.setdefault((user_id, as_utc(access_until).timestamp()), set()).add(kind)
+        return sent
+
+    async def prune(self, now: float) -> None:
+        async with get_async_db() as db:
+            await db.execute(delete(ExpiryNotice).where(ExpiryNotice.access_until < utc(now - self.catchup - DAY)))
+            await db.commit()
+
+    def schedule(self, user_id: int, telegram_id: int, until: float, sent: set[str]) -> None:
+        if self.expiries.get(telegram_id) == (user_id, until):
+            # Timers for this expiry are already in the heap; pushing them again would send twice
+            return
+        self.expiries[telegram_id] = (user_id, until)
+        expiry_day = until - until % DAY
+        for days in self.reminder_days:
+            kind = reminder_kind(days)
+            if kind not in sent:
+                heapq.heappush(self.heap, (expiry_day - days * DAY, telegram_id, until, kind))
+        if EXPIRED not in sent:
+            heapq.heappush(self.heap, (until, telegram_id, until, EXPIRED))
+
+    def pop_due(self, now: float) -> list[tuple[int, int, float, str]]:
+        due = []
+        while self.heap and self.heap[0][0] <= now and len(due) < self.batch_size:
+            fire_at, telegram_id, until, kind = heapq.heappop(self.heap)
+            current = self.expiries.get(telegram_id)
+            if current is None or current[1] != until:
+                continue
+            if kind == EXPIRED:
+                del self.expiries[telegram_id]
+            elif now >= until or now >= fire_at + DAY:
+                # Subscription bought after this reminder's day had passed
+                continue
+            due.append((telegram_id, current[0], until, kind))
+        return due
+
+    async def fire(self, due: list[tuple[int, int, float, str]]) -> None:
+        if not due:
+            return
+        async with get_async_db() as db:
+            # The heap can be stale if a change skipped the access cache, so re-check before sending
+            current = {row.telegram_id: row for row in (await db.execute(
+                select(User.telegram_id, User.access_until, User.is_whitelisted, User.is_active)
+                .where(User.telegram_id.in_([telegram_id for telegram_id, *_ in due]))
+            )).all()}
+            due_checked = [(telegram_id, user_id, until, kind) for telegram_id, user_id, until, kind in due
+                           if telegram_id in current and current[telegram_id].access_until is not None
+                           and as_utc(current[telegram_id].access_until).timestamp() == until
+                           and not current[telegram_id].is_whitelisted and current[telegram_id].is_active]
+            if not due_checked:
+                return
+            insert = dialect_insert(async_engine.dialect.name, ExpiryNotice)
+            recorded = set((await db.execute(
+                insert.on_conflict_do_nothing().returning(ExpiryNotice.user_id, ExpiryNotice.kind), [
+                    {"user_id": user_id, "access_until": utc(until), "kind": kind,
+                     "sent_at": datetime.datetime.utcnow()}
+                    for _, user_id, until, kind in due_checked
+                ])).tuples())
+            await db.commit()
+        # Only notices this call recorded are sent, each once; the others went out before
+        due = []
+        for entry in due_checked:
+            key = (entry[1], entry[3])
+            if key in recorded:
+                recorded.discard(key)
+                due.append(entry)
+        if not due:
+            return
+
+        outcomes = await asyncio.gather(*(self.notify(telegram_id, until, kind)
+                                          for telegram_id, _, until, kind in due))
+        sent = sum(outcomes)
+        self.sent += sent
+        self.failed += len(outcomes) - sent
+        expired = sum(kind == EXPIRED for *_, kind in due)
+        logger.info(f"Expiry notices: {sent} of {len(due)} sent ({expired} expirations)")
+
+    async def notify(self, telegram_id: int, until: float, kind: str) -> bool:
+        text, keyboard = self.message(until, kind)
+        while True:
+            await self.limiter.acquire(telegram_id)
+            try:
+                await self.bot.send_message(telegram_id, text, reply_markup=keyboard)
+                return True
+            except TelegramRetryAfter as e:
+                self.limiter.pause(e.retry_after)
+            except Exception as e:
+                logger.warning(f"Failed to send {kind} notice to {telegram_id}: {e}")
+                return False
+
+    def message(self, until: float, kind: str) -> tuple[str, InlineKeyboardMarkup]:
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="Продлить подписку", callback_data="buy_access")]
+        ])
+        end = utc(until)
+        if kind == EXPIRED:
+            return "❌ Срок вашей подписки истек. Чтобы вернуть доступ к курсу, продлите подписку.", keyboard
+        days = int(kind.rsplit("_", 1)[1])
+        if days == 0:
+            return f"⏳ Ваша подписка заканчивается сегодня в {end:%H:%M} UTC.", keyboard
+        return f"⏳ Ваша подписка заканчивается через {days} дн. ({end:%d.%m.%Y %H:%M} UTC).", keyboard
+
+    def stats(self) -> dict:
+        return {
+            "timers": len(self.heap),
+            "tracked": len(self.expiries),
+            "loaded_until": utc(self.loaded_until).isoformat() if self.loaded_until else None,
+            "sent": self.sent,
+            "failed": self.failed,
+        }
@@ -0,0 +1,177 @@
+import asyncio
+import datetime
+import json
+import logging
+from collections import OrderedDict
+from typing import Any, Mapping
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+from sqlalchemy import delete
+
+from config import FSM_STATE_TTL, FSM_CACHE_SIZE, FSM_FLUSH_INTERVAL, FSM_FLUSH_BATCH
+from database import get_async_db
+from models import FSMRecord, async_engine, dialect_insert
+
+logger = logging.getLogger(__name__)
+
+
+class FSMEntry:
+    __slots__ = ("state", "data", "updated_at")
+
+    def __init__(self, state: str | None, data: dict, updated_at: datetime.datetime):
+        self.state = state
+        self.data = data
+        self.updated_at = updated_at
+
+    @property
+    def empty(self) -> bool:
+        return self.state is None and not self.data
+
+
+# FSM storage on the bot's own database. Writes land in memory first and are
+# flushed in batches; reads go pending writes -> LRU cache -> database.
+# Rows untouched for `ttl` seconds count as abandoned and are swept. The cache
+# assumes each user's updates are handled by one process at a time (as with
+# polling or the sharded workers); upserts never let an older write win.
+class SQLStorage(BaseStorage):
+    def __init__(self, ttl: int = FSM_STATE_TTL, cache_size: int = FSM_CACHE_SIZE,
+                 flush_interval: float = FSM_FLUSH_INTERVAL, flush_batch: int = FSM_FLUSH_BATCH,
+                 key_builder: KeyBuilder | None = None):
+        self.ttl = datetime.timedelta(seconds=ttl)
+        self.cache_size = cache_size
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self.key_builder = key_builder or DefaultKeyBuilder()
+        self.cache: OrderedDict[str, FSMEntry] = OrderedDict()
+        self.pending: dict[str, FSMEntry] = {}
+        self.flushed = 0
+        self.swept = 0
+        self._flush_lock = asyncio.Lock()
+        self._flush_now = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        entry = await self._load(self.key_builder.build(key))
+        entry.state = state.state if isinstance(state, State) else state
+        self._write(self.key_builder.build(key), entry)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        return (await self._load(self.key_builder.build(key))).state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        entry = await self._load(self.key_builder.build(key))
+        entry.data = dict(data)
+        self._write(self.key_builder.build(key), entry)
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        return dict((await self._load(self.key_builder.build(key))).data)
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {"cached": len(self.cache), "pending": len(self.pending),
+                "flushed": self.flushed, "swept": self.swept}
+
+    def _now(self) -> datetime.datetime:
+        return datetime.datetime.utcnow()
+
+    def _expired(self, entry: FSMEntry) -> bool:
+        return entry.updated_at < self._now() - self.ttl
+
+    async def _load(self, key: str) -> FSMEntry:
+        entry = self.pending.get(key) or self.cache.get(key)
+        if entry is None:
+            async with get_async_db() as db:
+                record = await db.get(FSMRecord, key)
+            if record is not None:
+                entry = FSMEntry(record.state, json.loads(record.data), record.updated_at)
+            else:
+                entry = FSMEntry(None, {}, self._now())
+            self._remember(key, entry)
+        elif key in self.cache:
+            self.cache.move_to_end(key)
+        if self._expired(entry):
+            entry = FSMEntry(None, {}, self._now())
+        # Callers mutate the returned entry, so hand out a copy
+        return FSMEntry(entry.state, dict(entry.data), entry.updated_at)
+
+    def _remember(self, key: str, entry: FSMEntry) -> None:
+        if self.cache_size <= 0:
+            return
+        self.cache[key] = entry
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def _write(self, key: str, entry: FSMEntry) -> None:
+        entry.updated_at = self._now()
+        self.pending[key] = entry
+        self._remember(key, entry)
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        if len(self.pending) >= self.flush_batch:
+            self._flush_now.set()
+
+    async def _run(self) -> None:
+        last_sweep = 0.0
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_now.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_now.clear()
+            try:
+                await self.flush()
+                if loop.time() - last_sweep > 60:
+                    last_sweep = loop.time()
+                    await self.sweep()
+            except Exception:
+                logger.exception("FSM storage flush failed")
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            if not self.pending:
+                return
+            batch, self.pending = self.pending, {}
+            removed = [key for key, entry in batch.items() if entry.empty]
+            rows = [{"key": key, "state": entry.state, "data": json.dumps(entry.data), "updated_at": entry.updated_at}
+                    for key, entry in batch.items() if not entry.empty]
+            try:
+                async with get_async_db() as db:
+                    if removed:
+                        await db.execute(delete(FSMRecord).where(FSMRecord.key.in_(removed)))
+                    if rows:
+                        insert = dialect_insert(async_engine.dialect.name, FSMRecord)
+                        await db.execute(insert.on_conflict_do_update(
+                            index_elements=[FSMRecord.key],
+                            set_={"state": insert.excluded.state, "data": insert.excluded.data,
+                                  "updated_at": insert.excluded.updated_at},
+                            where=FSMRecord.updated_at <= insert.excluded.updated_at,
+                        ), rows)
+                    await db.commit()
+            except Exception:
+                # Keep the batch for the next flush unless a newer write replaced it
+                for key, entry in batch.items():
+                    self.pending.setdefault(key, entry)
+                raise
+            self.flushed += len(batch)
+            logger.debug(f"Flushed {len(batch)} FSM states ({len(removed)} cleared)")
+
+    async def sweep(self) -> int:
+        cutoff = self._now() - self.ttl
+        async with get_async_db() as db:
+            result = await db.execute(delete(FSMRecord).where(FSMRecord.updated_at < cutoff))
+            await db.commit()
+        for key in [key for key, entry in self.cache.items() if entry.updated_at < cutoff]:
+            del self.cache[key]
+        if result.rowcount:
+            self.swept += result.rowcount
+            logger.info(f"Evicted {result.rowcount} abandoned FSM states")
+        return result.rowcount
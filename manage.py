@@ -0,0 +1,213 @@
+import argparse
+import datetime
+import io
+import logging
+import sys
+
+import os
+import tempfile
+
+from sqlalchemy import create_engine, func, select
+
+import bulk_import
+import queries
+from sqlprofile import explain_sql
+from models import engine, init_db, User, Referral, refresh_user_access, access_until_expr, is_whitelisted_expr, get_alembic_config, refresh_daily_stats, utc_today
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def backfill_access(args):
+    init_db()
+    users = User.__table__
+    with engine.connect() as conn:
+        max_id = conn.scalar(select(users.c.id).order_by(users.c.id.desc()).limit(1)) or 0
+    for start in range(0, max_id + 1, args.batch_size):
+        ids = range(start, start + args.batch_size)
+        with engine.begin() as conn:
+            conn.execute(
+                users.update()
+                .where(users.c.id >= ids.start, users.c.id < ids.stop)
+                .values(access_until=access_until_expr(), is_whitelisted=is_whitelisted_expr())
+            )
+        logger.info(f"Backfilled users {ids.start}..{min(ids.stop - 1, max_id)}")
+    logger.info("Backfill complete.")
+    return 0
+
+
+def check_access(args):
+    users = User.__table__
+    expected_until = access_until_expr().label("expected_access_until")
+    expected_whitelisted = is_whitelisted_expr().label("expected_is_whitelisted")
+    computed = select(
+        users.c.id,
+        users.c.telegram_id,
+        users.c.access_until,
+        users.c.is_whitelisted,
+        expected_until,
+        expected_whitelisted,
+    ).subquery()
+    drift_query = select(computed).where(
+        computed.c.access_until.is_distinct_from(computed.c.expected_access_until)
+        | (computed.c.is_whitelisted != computed.c.expected_is_whitelisted)
+    ).limit(args.limit)
+
+    with engine.connect() as conn:
+        drifted = conn.execute(drift_query).all()
+
+    for row in drifted:
+        print(f"user id={row.id} telegram_id={row.telegram_id}: "
+              f"access_until={row.access_until} (expected {row.expected_access_until}), "
+              f"is_whitelisted={row.is_whitelisted} (expected {bool(row.expected_is_whitelisted)})")
+
+    if not drifted:
+        print("No drift found.")
+        return 0
+
+    print(f"{len(drifted)} drifted row(s){' (limit reached)' if len(drifted) == args.limit else ''}.")
+    if args.fix:
+        with engine.begin() as conn:
+            refresh_user_access(conn, user_ids=[row.id for row in drifted])
+        print("Drifted rows refreshed.")
+    return 1
+
+
+def explain(conn, statement):
+    compiled = statement.compile(dialect=conn.dialect)
+    if conn.dialect.name == "sqlite":
+        return explain_sql(conn, str(compiled), tuple(compiled.params[name] for name in compiled.positiontup))
+    return explain_sql(conn, str(compiled), compiled.params)
+
+
+def check_query_plans(args):
+    from alembic import command
+
+    urls = args.url or []
+    tmpdir = None
+    if not urls:
+        # Migrate a scratch SQLite database so the check covers the Alembic indexes
+        tmpdir = tempfile.TemporaryDirectory()
+        urls = [f"sqlite:///{os.path.join(tmpdir.name, 'plans.db')}"]
+
+    failures = 0
+    for url in urls:
+        check_engine = create_engine(url)
+        with check_engine.begin() as conn:
+            alembic_cfg = get_alembic_config()
+            alembic_cfg.attributes["connection"] = conn
+            command.upgrade(alembic_cfg, "head")
+        with check_engine.begin() as conn:
+            for name, statement in queries.hot_queries(check_engine.dialect.name).items():
+                details, scans = explain(conn, statement)
+                status = "FULL SCAN" if scans else "ok"
+                print(f"[{check_engine.dialect.name}] {name}: {status} ({'; '.join(details)})")
+                failures += bool(scans)
+        check_engine.dispose()
+
+    if tmpdir is not None:
+        tmpdir.cleanup()
+    if failures:
+        print(f"{failures} hot query(ies) fall back to a full table scan.")
+        return 1
+    return 0
+
+
+def rollup_subscriptions(args):
+    init_db()
+    until = args.until or utc_today() + datetime.timedelta(days=1)
+    since = args.since or until - datetime.timedelta(days=args.days)
+    chunk = datetime.timedelta(days=31)
+    start = since
+    while start < until:
+        end = min(start + chunk, until)
+        with engine.begin() as conn:
+            refresh_daily_stats(conn, start, end)
+        logger.info(f"Rolled up subscriptions for {start}..{end - datetime.timedelta(days=1)}")
+        start = end
+    return 0
+
+
+def recount_referrals(args):
+    init_db()
+    users, referrals = User.__table__, Referral.__table__
+    counted = (select(func.count()).select_from(referrals)
+               .where(referrals.c.user_id == users.c.id).scalar_subquery())
+    with engine.connect() as conn:
+        max_id = conn.scalar(select(users.c.id).order_by(users.c.id.desc()).limit(1)) or 0
+    for start in range(0, max_id + 1, args.batch_size):
+        ids = range(start, start + args.batch_size)
+        with engine.begin() as conn:
+            conn.execute(users.update()
+                         .where(users.c.id >= ids.start, users.c.id < ids.stop, users.c.referral_count != counted)
+                         .values(referral_count=counted))
+    logger.info("Referral counters recounted.")
+    return 0
+
+
+def import_file(args):
+    init_db()
+    if args.path == "-":
+        stream = io.TextIOWrapper(sys.stdin.buffer, encoding="utf-8-sig", errors="replace", newline="")
+    else:
+        stream = open(args.path, encoding="utf-8-sig", errors="replace", newline="")
+    importer = bulk_import.import_users if args.command == "import-users" else bulk_import.import_whitelist
+    try:
+        with stream:
+            report = importer(stream, chunk_size=args.chunk_size)
+    except bulk_import.ImportFormatError as e:
+        print(f"{args.path}: {e}")
+        return 2
+    for line, reason in report.errors:
+        print(f"line {line}: {reason}")
+    if report.invalid > len(report.errors):
+        print(f"... and {report.invalid - len(report.errors)} more invalid row(s)")
+    print(f"{report.rows} row(s): {report.inserted} inserted, {report.skipped} skipped (already present "
+          f"or repeated), {report.invalid} invalid.")
+    return 1 if report.invalid else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Maintenance commands for the bot database")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    backfill = subparsers.add_parser("backfill-access", help="Recompute users.access_until and users.is_whitelisted")
+    backfill.add_argument("--batch-size", type=int, default=10000)
+    backfill.set_defaults(func=backfill_access)
+
+    check = subparsers.add_parser("check-access", help="Report users whose denormalized access columns drifted")
+    check.add_argument("--limit", type=int, default=1000)
+    check.add_argument("--fix", action="store_true", help="Recompute the drifted rows")
+    check.set_defaults(func=check_access)
+
+    plans = subparsers.add_parser("check-query-plans", help="EXPLAIN the hot queries and fail on full table scans")
+    plans.add_argument("--url", action="append", help="Database URL to check (migrated to head first); "
+                                                      "defaults to a scratch SQLite database")
+    plans.set_defaults(func=check_query_plans)
+
+    rollup = subparsers.add_parser("rollup-subscriptions",
+                                   help="Recompute subscription_daily_stats from subscriptions (catch-up job)")
+    rollup.add_argument("--days", type=int, default=7, help="how many days back from --until (default 7)")
+    rollup.add_argument("--since", type=datetime.date.fromisoformat, help="first day, YYYY-MM-DD")
+    rollup.add_argument("--until", type=datetime.date.fromisoformat, help="day after the last one (default tomorrow)")
+    rollup.set_defaults(func=rollup_subscriptions)
+
+    recount = subparsers.add_parser("recount-referrals", help="Recompute users.referral_count from referrals")
+    recount.add_argument("--batch-size", type=int, default=10000)
+    recount.set_defaults(func=recount_referrals)
+
+    # The bot's access cache picks the new rows up within ACCESS_CACHE_TTL
+    for name, columns in (("import-whitelist", bulk_import.WHITELIST_COLUMNS),
+                          ("import-users", bulk_import.USER_COLUMNS)):
+        importer = subparsers.add_parser(name, help=f"Bulk insert {name.split('-')[1]} from a CSV/TSV file, "
+                                                    f"skipping rows already present")
+        importer.add_argument("path", help=f"file with columns {', '.join(columns)} (header optional), - for stdin")
+        importer.add_argument("--chunk-size", type=int, default=bulk_import.IMPORT_CHUNK_SIZE)
+        importer.set_defaults(func=import_file)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
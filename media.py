@@ -0,0 +1,102 @@
+import datetime
+import hashlib
+import logging
+import os
+import tempfile
+
+from aiogram import Bot
+from aiogram.types import FSInputFile
+from sqlalchemy import update
+
+from config import MEDIA_DIR, MEDIA_UPLOAD_CHAT_ID
+from database import get_async_db
+from models import MediaAsset
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+MAX_CAPTION_LENGTH = 1024
+
+SENDERS = {
+    "photo": "send_photo",
+    "video": "send_video",
+    "animation": "send_animation",
+    "document": "send_document",
+}
+
+
+def media_type_for(mimetype: str | None, file_name: str | None) -> str:
+    mimetype = (mimetype or "").lower()
+    if mimetype == "image/gif" or (file_name or "").lower().endswith(".gif"):
+        return "animation"
+    if mimetype in ("image/jpeg", "image/png", "image/webp"):
+        return "photo"
+    if mimetype.startswith("video/"):
+        return "video"
+    return "document"
+
+
+def media_path(content_hash: str) -> str:
+    return os.path.join(MEDIA_DIR, content_hash)
+
+
+def store_upload(db, stream, file_name: str | None, mimetype: str | None) -> MediaAsset:
+    # Hash while streaming to disk so large files never sit in memory
+    os.makedirs(MEDIA_DIR, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    with tempfile.NamedTemporaryFile(dir=MEDIA_DIR, delete=False) as tmp:
+        while True:
+            chunk = stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            size += len(chunk)
+            tmp.write(chunk)
+    content_hash = digest.hexdigest()
+
+    asset = db.query(MediaAsset).filter(MediaAsset.content_hash == content_hash).first()
+    if asset is not None and os.path.exists(media_path(content_hash)):
+        os.unlink(tmp.name)
+        return asset
+    os.replace(tmp.name, media_path(content_hash))
+    if asset is None:
+        asset = MediaAsset(
+            content_hash=content_hash,
+            media_type=media_type_for(mimetype, file_name),
+            file_name=file_name,
+            file_size=size,
+        )
+        db.add(asset)
+        db.commit()
+    return asset
+
+
+def extract_file_id(message, media_type: str) -> str:
+    if media_type == "photo":
+        return message.photo[-1].file_id
+    return getattr(message, media_type).file_id
+
+
+async def ensure_file_id(bot: Bot, media_id: int) -> tuple[str, str]:
+    async with get_async_db() as db:
+        asset = await db.get(MediaAsset, media_id)
+        if asset.file_id:
+            return asset.media_type, asset.file_id
+        if not MEDIA_UPLOAD_CHAT_ID:
+            raise RuntimeError("MEDIA_UPLOAD_CHAT_ID is not set; cannot upload broadcast media")
+
+        sender = getattr(bot, SENDERS[asset.media_type])
+        upload = FSInputFile(media_path(asset.content_hash), filename=asset.file_name)
+        message = await sender(MEDIA_UPLOAD_CHAT_ID, upload)
+        file_id = extract_file_id(message, asset.media_type)
+        await db.execute(update(MediaAsset).where(MediaAsset.id == media_id)
+                         .values(file_id=file_id, uploaded_at=datetime.datetime.utcnow()))
+        await db.commit()
+        logger.info(f"Uploaded media {asset.content_hash[:12]} once, cached file_id for reuse.")
+        return asset.media_type, file_id
+
+
+async def send_media(bot: Bot, chat_id: int, media_type: str, file_id: str, caption: str | None):
+    sender = getattr(bot, SENDERS[media_type])
+    return await sender(chat_id, file_id, caption=caption or None)
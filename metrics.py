@@ -0,0 +1,210 @@
+import contextvars
+import threading
+import time
+from bisect import bisect_left
+
+from sqlalchemy import event
+
+from asgi import get_header, send_response
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels: tuple = (), amount: float = 1.0) -> None:
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0.0) + amount
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            values = [[list(labels), value] for labels, value in self.values.items()]
+        return {"type": self.type, "help": self.help, "labelnames": list(self.labelnames), "values": values}
+
+
+# Bucket counts are kept per bucket (not cumulative) plus the sum, so an
+# observation is one bisect and two additions under an uncontended lock
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self.values: dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels: tuple, value: float) -> None:
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            entry[index] += 1
+            entry[-1] += value
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            values = [[list(labels), list(entry)] for labels, entry in self.values.items()]
+        return {"type": self.type, "help": self.help, "labelnames": list(self.labelnames),
+                "buckets": list(self.buckets), "values": values}
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels(pairs) -> str:
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}" if pairs else ""
+
+
+def _format_bound(bound) -> str:
+    return "+Inf" if bound == float("inf") else repr(float(bound))
+
+
+def render(sources: list[tuple[dict, dict]]) -> str:
+    # sources: (extra labels, snapshot) pairs, e.g. this process and each shard worker
+    merged: dict[str, tuple[dict, list]] = {}
+    for extra, snapshot in sources:
+        for name, metric in snapshot.items():
+            merged.setdefault(name, (metric, []))[1].append((extra, metric))
+    lines = []
+    for name, (first, metrics) in sorted(merged.items()):
+        lines.append(f"# HELP {name} {first['help']}")
+        lines.append(f"# TYPE {name} {first['type']}")
+        for extra, metric in metrics:
+            for labels, value in metric["values"]:
+                pairs = list(extra.items()) + list(zip(metric["labelnames"], labels))
+                if metric["type"] != "histogram":
+                    lines.append(f"{name}{_labels(pairs)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(metric["buckets"] + [float("inf")], value[:-1]):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_labels(pairs + [('le', _format_bound(bound))])} {cumulative}")
+                lines.append(f"{name}_sum{_labels(pairs)} {value[-1]}")
+                lines.append(f"{name}_count{_labels(pairs)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: dict[str, Counter | Histogram] = {}
+        # Callables returning more (extra labels, snapshot) pairs, e.g. from shard workers
+        self.collectors = []
+
+    def counter(self, name: str, help: str, labelnames: tuple[str, ...] = ()) -> Counter:
+        return self.metrics.setdefault(name, Counter(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: tuple[str, ...] = (),
+                  buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self.metrics.setdefault(name, Histogram(name, help, labelnames, buckets))
+
+    def snapshot(self) -> dict:
+        return {name: metric.snapshot() for name, metric in self.metrics.items()}
+
+    def render(self) -> str:
+        sources = [({}, self.snapshot())]
+        for collector in self.collectors:
+            sources.extend(collector())
+        return render(sources)
+
+
+registry = Registry()
+
+handler_duration = registry.histogram(
+    "bot_handler_duration_seconds", "Time to handle one update, by handler", ("handler",))
+handler_updates = registry.counter(
+    "bot_handler_updates_total", "Updates handled, by handler and outcome", ("handler", "outcome"))
+handler_db_statements = registry.histogram(
+    "bot_handler_db_statements", "SQL statements executed while handling one update", ("handler",), STATEMENT_BUCKETS)
+handler_db_seconds = registry.histogram(
+    "bot_handler_db_seconds", "Time spent in SQL while handling one update", ("handler",))
+
+request_duration = registry.histogram(
+    "admin_request_duration_seconds", "Admin panel request latency, by route", ("route", "method"))
+requests_total = registry.counter(
+    "admin_requests_total", "Admin panel requests, by route and status", ("route", "method", "status"))
+request_db_statements = registry.histogram(
+    "admin_request_db_statements", "SQL statements executed per admin request", ("route",), STATEMENT_BUCKETS)
+request_db_seconds = registry.histogram(
+    "admin_request_db_seconds", "Time spent in SQL per admin request", ("route",))
+
+
+class DBTally:
+    __slots__ = ("statements", "seconds", "label", "trace")
+
+    def __init__(self):
+        self.statements = 0
+        self.seconds = 0.0
+        self.label = None
+        # Statements by shape, filled in by sqlprofile when SQL_PROFILE is on
+        self.trace = None
+
+
+# The update or request being handled in this task/thread; statements run
+# outside of one (background runners) are not attributed to anything
+db_tally: contextvars.ContextVar[DBTally | None] = contextvars.ContextVar("db_tally", default=None)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if db_tally.get() is not None:
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    tally = db_tally.get()
+    if tally is not None:
+        started = conn.info.get("query_started")
+        if started:
+            tally.seconds += time.perf_counter() - started.pop()
+        tally.statements += 1
+
+
+def _handle_error(exception_context):
+    # A failed statement never reaches after_cursor_execute
+    connection = exception_context.connection
+    if connection is not None and connection.info.get("query_started"):
+        connection.info["query_started"].pop()
+
+
+def instrument_engine(engine) -> None:
+    if not event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+        event.listen(engine, "handle_error", _handle_error)
+
+
+def observe_request(route: str, method: str, status: int, elapsed: float, tally: DBTally) -> None:
+    request_duration.observe((route, method), elapsed)
+    requests_total.inc((route, method, str(status)))
+    request_db_statements.observe((route,), tally.statements)
+    request_db_seconds.observe((route,), tally.seconds)
+
+
+class MetricsApp:
+    def __init__(self, registry: Registry = registry, token: str = ""):
+        self.registry = registry
+        self.token = token
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return
+        if scope["method"] not in ("GET", "HEAD"):
+            await send_response(send, 405)
+            return
+        if self.token and get_header(scope, b"authorization") != f"Bearer {self.token}".encode():
+            await send_response(send, 401)
+            return
+        await send_response(send, 200, self.registry.render().encode(), CONTENT_TYPE)
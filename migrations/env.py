@@ -0,0 +1,70 @@
+from logging.config import fileConfig
+
+from sqlalchemy import create_engine, pool
+
+from alembic import context
+
+from config import DATABASE_URL
+from models import Base
+
+config = context.config
+
+# init_db() runs migrations in-process on an existing connection; don't let
+# the ini file reconfigure the application's logging in that case
+connection = config.attributes.get("connection")
+if connection is None and config.config_file_name is not None:
+    fileConfig(config.config_file_name)
+
+target_metadata = Base.metadata
+
+# Dialect-specific expression indexes (0008) are written by hand and kept out
+# of models.py, so autogenerate must not propose dropping them
+MANUAL_INDEX_SUFFIXES = ("_nocase", "_lower")
+
+
+def include_object(object, name, type_, reflected, compare_to) -> bool:
+    if type_ == "index" and reflected and compare_to is None and name.endswith(MANUAL_INDEX_SUFFIXES):
+        return False
+    return True
+
+
+def run_migrations_offline() -> None:
+    context.configure(
+        url=DATABASE_URL,
+        target_metadata=target_metadata,
+        literal_binds=True,
+        dialect_opts={"paramstyle": "named"},
+        render_as_batch=DATABASE_URL.startswith("sqlite"),
+        include_object=include_object,
+    )
+
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_with(connection) -> None:
+    context.configure(
+        connection=connection,
+        target_metadata=target_metadata,
+        render_as_batch=connection.dialect.name == "sqlite",
+        include_object=include_object,
+    )
+
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_online() -> None:
+    if connection is not None:
+        run_migrations_with(connection)
+        return
+
+    connectable = create_engine(DATABASE_URL, poolclass=pool.NullPool)
+    with connectable.connect() as conn:
+        run_migrations_with(conn)
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
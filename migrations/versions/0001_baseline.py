@@ -0,0 +1,112 @@
+"""baseline schema
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-17 12:00:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0001'
+down_revision: Union[str, Sequence[str], None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        'users',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('telegram_id', sa.BigInteger(), nullable=False),
+        sa.Column('telegram_username', sa.String(), nullable=True),
+        sa.Column('email', sa.String(), nullable=False),
+        sa.Column('registration_date', sa.DateTime(timezone=True), server_default=sa.func.now(), nullable=True),
+        sa.Column('referral_link_override', sa.String(), nullable=True),
+        sa.Column('referral_status_override', sa.Boolean(), nullable=True),
+        sa.Column('is_active', sa.Boolean(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index('ix_users_id', 'users', ['id'], unique=False)
+    op.create_index('ix_users_telegram_id', 'users', ['telegram_id'], unique=True)
+    op.create_index('ix_users_email', 'users', ['email'], unique=True)
+
+    op.create_table(
+        'whitelist',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('telegram_id', sa.BigInteger(), nullable=False),
+        sa.Column('added_date', sa.DateTime(timezone=True), server_default=sa.func.now(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index('ix_whitelist_id', 'whitelist', ['id'], unique=False)
+    op.create_index('ix_whitelist_telegram_id', 'whitelist', ['telegram_id'], unique=True)
+
+    op.create_table(
+        'promo_codes',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('code', sa.String(), nullable=False),
+        sa.Column('discount_percent', sa.Integer(), nullable=False),
+        sa.Column('is_active', sa.Boolean(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.Column('used_count', sa.Integer(), nullable=True),
+        sa.Column('max_uses', sa.Integer(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('code'),
+    )
+
+    op.create_table(
+        'admins',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('username', sa.String(), nullable=True),
+        sa.Column('password_hash', sa.String(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('username'),
+    )
+
+    op.create_table(
+        'subscriptions',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('start_date', sa.DateTime(timezone=True), server_default=sa.func.now(), nullable=True),
+        sa.Column('end_date', sa.DateTime(timezone=True), nullable=False),
+        sa.Column('payment_amount', sa.Integer(), nullable=True),
+        sa.Column('payment_id', sa.String(), nullable=True),
+        sa.Column('auto_renewal', sa.Boolean(), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id']),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('payment_id'),
+    )
+    op.create_index('ix_subscriptions_id', 'subscriptions', ['id'], unique=False)
+
+    op.create_table(
+        'referrals',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=True),
+        sa.Column('referred_user_id', sa.Integer(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['referred_user_id'], ['users.id']),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id']),
+        sa.PrimaryKeyConstraint('id'),
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('referrals')
+    op.drop_index('ix_subscriptions_id', table_name='subscriptions')
+    op.drop_table('subscriptions')
+    op.drop_table('admins')
+    op.drop_table('promo_codes')
+    op.drop_index('ix_whitelist_telegram_id', table_name='whitelist')
+    op.drop_index('ix_whitelist_id', table_name='whitelist')
+    op.drop_table('whitelist')
+    op.drop_index('ix_users_email', table_name='users')
+    op.drop_index('ix_users_telegram_id', table_name='users')
+    op.drop_index('ix_users_id', table_name='users')
+    op.drop_table('users')
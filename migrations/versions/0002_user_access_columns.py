@@ -0,0 +1,54 @@
+"""users.access_until and users.is_whitelisted
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-17 12:10:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0002'
+down_revision: Union[str, Sequence[str], None] = '0001'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    inspector = sa.inspect(op.get_bind())
+    # Databases created by an older create_all() predate subscriptions.auto_renewal
+    if 'auto_renewal' not in {column['name'] for column in inspector.get_columns('subscriptions')}:
+        with op.batch_alter_table('subscriptions') as batch_op:
+            batch_op.add_column(sa.Column('auto_renewal', sa.Boolean(), nullable=True))
+
+    # Databases that already ran `manage.py backfill-access` have the columns
+    columns = {column['name'] for column in inspector.get_columns('users')}
+    with op.batch_alter_table('users') as batch_op:
+        if 'access_until' not in columns:
+            batch_op.add_column(sa.Column('access_until', sa.DateTime(timezone=True), nullable=True))
+        if 'is_whitelisted' not in columns:
+            batch_op.add_column(sa.Column('is_whitelisted', sa.Boolean(), server_default=sa.false(), nullable=False))
+
+    users = sa.table('users', sa.column('id'), sa.column('telegram_id'), sa.column('access_until'), sa.column('is_whitelisted'))
+    subscriptions = sa.table('subscriptions', sa.column('user_id'), sa.column('end_date'))
+    whitelist = sa.table('whitelist', sa.column('telegram_id'))
+    op.execute(
+        users.update().values(
+            access_until=sa.select(sa.func.max(subscriptions.c.end_date))
+            .where(subscriptions.c.user_id == users.c.id)
+            .scalar_subquery(),
+            is_whitelisted=sa.exists().where(whitelist.c.telegram_id == users.c.telegram_id),
+        )
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.drop_column('is_whitelisted')
+        batch_op.drop_column('access_until')
@@ -0,0 +1,35 @@
+"""indexes for the access check and subscription reports
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-17 12:20:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0003'
+down_revision: Union[str, Sequence[str], None] = '0002'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_index('ix_subscriptions_user_id_end_date', 'subscriptions', ['user_id', 'end_date'], unique=False)
+    op.create_index('ix_subscriptions_start_date', 'subscriptions', ['start_date'], unique=False)
+    op.create_index('ix_subscriptions_end_date', 'subscriptions', ['end_date'], unique=False)
+    op.create_index('ix_referrals_user_id', 'referrals', ['user_id'], unique=False)
+    op.create_index('ix_referrals_referred_user_id', 'referrals', ['referred_user_id'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_referrals_referred_user_id', table_name='referrals')
+    op.drop_index('ix_referrals_user_id', table_name='referrals')
+    op.drop_index('ix_subscriptions_end_date', table_name='subscriptions')
+    op.drop_index('ix_subscriptions_start_date', table_name='subscriptions')
+    op.drop_index('ix_subscriptions_user_id_end_date', table_name='subscriptions')
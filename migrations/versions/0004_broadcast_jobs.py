@@ -0,0 +1,65 @@
+"""broadcast jobs and per-recipient outcomes
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-17 13:00:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0004'
+down_revision: Union[str, Sequence[str], None] = '0003'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        'broadcast_jobs',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('message_text', sa.Text(), nullable=False),
+        sa.Column('target', sa.String(), nullable=False),
+        sa.Column('selected_user_id', sa.Integer(), nullable=True),
+        sa.Column('status', sa.String(), nullable=False),
+        sa.Column('cursor_user_id', sa.Integer(), nullable=False),
+        sa.Column('enumeration_done', sa.Boolean(), nullable=False),
+        sa.Column('total_count', sa.Integer(), nullable=False),
+        sa.Column('sent_count', sa.Integer(), nullable=False),
+        sa.Column('failed_count', sa.Integer(), nullable=False),
+        sa.Column('error', sa.String(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.Column('started_at', sa.DateTime(), nullable=True),
+        sa.Column('finished_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index('ix_broadcast_jobs_status', 'broadcast_jobs', ['status'], unique=False)
+
+    op.create_table(
+        'broadcast_recipients',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('job_id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('telegram_id', sa.BigInteger(), nullable=False),
+        sa.Column('status', sa.String(), nullable=False),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('error', sa.String(), nullable=True),
+        sa.Column('sent_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['job_id'], ['broadcast_jobs.id']),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('job_id', 'user_id', name='uq_broadcast_recipients_job_id_user_id'),
+    )
+    op.create_index('ix_broadcast_recipients_job_id_status', 'broadcast_recipients', ['job_id', 'status'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_broadcast_recipients_job_id_status', table_name='broadcast_recipients')
+    op.drop_table('broadcast_recipients')
+    op.drop_index('ix_broadcast_jobs_status', table_name='broadcast_jobs')
+    op.drop_table('broadcast_jobs')
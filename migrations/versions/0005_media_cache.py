@@ -0,0 +1,46 @@
+"""media cache for broadcast attachments
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-17 13:30:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0005'
+down_revision: Union[str, Sequence[str], None] = '0004'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        'media_cache',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('content_hash', sa.String(length=64), nullable=False),
+        sa.Column('media_type', sa.String(), nullable=False),
+        sa.Column('file_name', sa.String(), nullable=True),
+        sa.Column('file_size', sa.Integer(), nullable=True),
+        sa.Column('file_id', sa.String(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.Column('uploaded_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('content_hash'),
+    )
+    with op.batch_alter_table('broadcast_jobs') as batch_op:
+        batch_op.add_column(sa.Column('media_id', sa.Integer(), nullable=True))
+        batch_op.create_foreign_key('fk_broadcast_jobs_media_id_media_cache', 'media_cache', ['media_id'], ['id'])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.batch_alter_table('broadcast_jobs') as batch_op:
+        batch_op.drop_constraint('fk_broadcast_jobs_media_id_media_cache', type_='foreignkey')
+        batch_op.drop_column('media_id')
+    op.drop_table('media_cache')
@@ -0,0 +1,38 @@
+"""case-insensitive prefix indexes for user search
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-17 22:10:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0008'
+down_revision: Union[str, Sequence[str], None] = '0007'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+COLUMNS = ('telegram_username', 'email')
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Expression indexes differ per dialect, so they live only here and not in models.py
+    if op.get_bind().dialect.name == 'postgresql':
+        for column in COLUMNS:
+            op.create_index(f'ix_users_{column}_lower', 'users', [sa.text(f'lower({column}) text_pattern_ops')])
+    else:
+        for column in COLUMNS:
+            op.create_index(f'ix_users_{column}_nocase', 'users', [sa.text(f'{column} COLLATE NOCASE')])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    suffix = 'lower' if op.get_bind().dialect.name == 'postgresql' else 'nocase'
+    for column in COLUMNS:
+        op.drop_index(f'ix_users_{column}_{suffix}', table_name='users')
@@ -0,0 +1,62 @@
+"""daily subscription rollup
+
+Revision ID: 0009
+Revises: 0008
+Create Date: 2026-10-17 23:00:00
+
+"""
+import datetime
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0009'
+down_revision: Union[str, Sequence[str], None] = '0008'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    stats = op.create_table(
+        'subscription_daily_stats',
+        sa.Column('day', sa.Date(), nullable=False),
+        sa.Column('new_payments', sa.Integer(), nullable=False),
+        sa.Column('payment_total', sa.Integer(), nullable=False),
+        sa.Column('expirations', sa.Integer(), nullable=False),
+        sa.Column('auto_renewal_disabled', sa.Integer(), nullable=False),
+        sa.Column('promo_uses', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('day'),
+    )
+
+    # Backfill the subscription-derived columns; the event counters start at zero
+    subscriptions = sa.table('subscriptions', sa.column('start_date'), sa.column('end_date'), sa.column('payment_amount'))
+    bind = op.get_bind()
+    rows = {}
+    paid = bind.execute(
+        sa.select(sa.func.date(subscriptions.c.start_date), sa.func.count(),
+                  sa.func.coalesce(sa.func.sum(subscriptions.c.payment_amount), 0))
+        .where(subscriptions.c.start_date.isnot(None))
+        .group_by(sa.func.date(subscriptions.c.start_date)))
+    for day, count, total in paid:
+        rows.setdefault(str(day)[:10], [0, 0, 0])[:2] = [count, total]
+    ending = bind.execute(
+        sa.select(sa.func.date(subscriptions.c.end_date), sa.func.count())
+        .group_by(sa.func.date(subscriptions.c.end_date)))
+    for day, count in ending:
+        rows.setdefault(str(day)[:10], [0, 0, 0])[2] = count
+    if rows:
+        op.bulk_insert(stats, [
+            {'day': datetime.date.fromisoformat(day),
+             'new_payments': new_payments, 'payment_total': payment_total, 'expirations': expirations,
+             'auto_renewal_disabled': 0, 'promo_uses': 0}
+            for day, (new_payments, payment_total, expirations) in rows.items()
+        ])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('subscription_daily_stats')
@@ -0,0 +1,41 @@
+"""expiry scheduler: access_until index and sent notices
+
+Revision ID: 0010
+Revises: 0009
+Create Date: 2026-10-17 23:40:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0010'
+down_revision: Union[str, Sequence[str], None] = '0009'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_index('ix_users_access_until', 'users', ['access_until'], unique=False)
+    op.create_table(
+        'expiry_notices',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('access_until', sa.DateTime(timezone=True), nullable=False),
+        sa.Column('kind', sa.String(), nullable=False),
+        sa.Column('sent_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('user_id', 'access_until', 'kind', name='uq_expiry_notices_user_id_access_until_kind'),
+    )
+    op.create_index('ix_expiry_notices_access_until', 'expiry_notices', ['access_until'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_expiry_notices_access_until', table_name='expiry_notices')
+    op.drop_table('expiry_notices')
+    op.drop_index('ix_users_access_until', table_name='users')
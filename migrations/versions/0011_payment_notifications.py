@@ -0,0 +1,41 @@
+"""payment notification queue
+
+Revision ID: 0011
+Revises: 0010
+Create Date: 2026-10-18 00:30:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0011'
+down_revision: Union[str, Sequence[str], None] = '0010'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        'payment_notifications',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('payment_id', sa.String(), nullable=False),
+        sa.Column('status', sa.String(), nullable=False),
+        sa.Column('payload', sa.Text(), nullable=False),
+        sa.Column('received_at', sa.DateTime(), nullable=False),
+        sa.Column('processed_at', sa.DateTime(), nullable=True),
+        sa.Column('error', sa.String(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('payment_id', 'status', name='uq_payment_notifications_payment_id_status'),
+    )
+    op.create_index('ix_payment_notifications_processed_at', 'payment_notifications', ['processed_at'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_payment_notifications_processed_at', table_name='payment_notifications')
+    op.drop_table('payment_notifications')
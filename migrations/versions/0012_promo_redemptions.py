@@ -0,0 +1,40 @@
+"""per-user promo code redemptions
+
+Revision ID: 0012
+Revises: 0011
+Create Date: 2026-10-18 01:30:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0012'
+down_revision: Union[str, Sequence[str], None] = '0011'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        'promo_redemptions',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('promo_id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('redeemed_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['promo_id'], ['promo_codes.id']),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id']),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('promo_id', 'user_id', name='uq_promo_redemptions_promo_id_user_id'),
+    )
+    op.create_index('ix_promo_redemptions_user_id', 'promo_redemptions', ['user_id'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_promo_redemptions_user_id', table_name='promo_redemptions')
+    op.drop_table('promo_redemptions')
@@ -0,0 +1,45 @@
+"""referral attribution: override lookup index and per-referrer counters
+
+Revision ID: 0013
+Revises: 0012
+Create Date: 2026-10-18 02:30:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0013'
+down_revision: Union[str, Sequence[str], None] = '0012'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('users', sa.Column('referral_count', sa.Integer(), server_default='0', nullable=False))
+    op.create_index('ix_users_referral_count', 'users', ['referral_count'], unique=False)
+    op.create_index('ix_users_referral_link_override', 'users', ['referral_link_override'], unique=False)
+    # A user is referred at most once; keep the earliest if older rows disagree
+    op.execute(
+        "DELETE FROM referrals WHERE id NOT IN "
+        "(SELECT MIN(id) FROM referrals GROUP BY referred_user_id) AND referred_user_id IS NOT NULL"
+    )
+    op.drop_index('ix_referrals_referred_user_id', table_name='referrals')
+    op.create_index('ix_referrals_referred_user_id', 'referrals', ['referred_user_id'], unique=True)
+    op.execute(
+        "UPDATE users SET referral_count = "
+        "(SELECT COUNT(*) FROM referrals WHERE referrals.user_id = users.id)"
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_referrals_referred_user_id', table_name='referrals')
+    op.create_index('ix_referrals_referred_user_id', 'referrals', ['referred_user_id'], unique=False)
+    op.drop_index('ix_users_referral_link_override', table_name='users')
+    op.drop_index('ix_users_referral_count', table_name='users')
+    op.drop_column('users', 'referral_count')
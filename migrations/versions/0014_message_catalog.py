@@ -0,0 +1,47 @@
+"""admin-editable message catalog
+
+Revision ID: 0014
+Revises: 0013
+Create Date: 2026-10-18 03:30:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0014'
+down_revision: Union[str, Sequence[str], None] = '0013'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        'catalog_messages',
+        sa.Column('key', sa.String(), nullable=False),
+        sa.Column('text', sa.Text(), nullable=False),
+        sa.Column('parse_mode', sa.String(), nullable=True),
+        sa.Column('disable_web_page_preview', sa.Boolean(), server_default=sa.false(), nullable=False),
+        sa.Column('keyboard', sa.Text(), nullable=True),
+        sa.Column('updated_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('key'),
+    )
+    op.create_table(
+        'catalog_state',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('version', sa.Integer(), server_default='1', nullable=False),
+        sa.Column('price', sa.Integer(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    # The single row the admin panel bumps on every edit
+    op.execute("INSERT INTO catalog_state (id, version) VALUES (1, 1)")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('catalog_state')
+    op.drop_table('catalog_messages')
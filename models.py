@@ -1,32 +1,47 @@
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, DateTime, ForeignKey, BigInteger, Float
-from sqlalchemy.orm import sessionmaker, relationship, declarative_base
+from sqlalchemy import create_engine, event, inspect, select, update, exists, or_, false, Index, UniqueConstraint, Column, Integer, String, Text, Boolean, Date, DateTime, ForeignKey, BigInteger, Float
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import sessionmaker, relationship, declarative_base, Session
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.sql import func
-from contextlib import contextmanager
+from contextlib import contextmanager, asynccontextmanager
 import datetime
+import os
 from config import DATABASE_URL
 
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINE_REVISION = "0001"
+
 Base = declarative_base()
 
 class User(Base):
     __tablename__ = 'users'
+    __table_args__ = (
+        Index('ix_users_registration_date_id', 'registration_date', 'id'),
+    )
     id = Column(Integer, primary_key=True, index=True)
     telegram_id = Column(BigInteger, unique=True, index=True, nullable=False)
     telegram_username = Column(String, nullable=True)
     email = Column(String, unique=True, index=True, nullable=False)
     registration_date = Column(DateTime(timezone=True), server_default=func.now())
-    referral_link_override = Column(String, nullable=True)
+    referral_link_override = Column(String, nullable=True, index=True)
     referral_status_override = Column(Boolean, default=None, nullable=True)
     is_active = Column(Boolean, default=True)
+    access_until = Column(DateTime(timezone=True), nullable=True, index=True)
+    is_whitelisted = Column(Boolean, default=False, server_default=false(), nullable=False)
+    referral_count = Column(Integer, default=0, server_default='0', nullable=False, index=True)
     subscriptions = relationship("Subscription", back_populates="user")
     referrals_made = relationship("Referral", back_populates="referrer", foreign_keys="[Referral.user_id]")
     referrals_received = relationship("Referral", back_populates="referred_user", foreign_keys="[Referral.referred_user_id]")
 
 class Subscription(Base):
     __tablename__ = 'subscriptions'
+    __table_args__ = (
+        Index('ix_subscriptions_user_id_end_date', 'user_id', 'end_date'),
+    )
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
-    start_date = Column(DateTime(timezone=True), server_default=func.now())
-    end_date = Column(DateTime(timezone=True), nullable=False)
+    start_date = Column(DateTime(timezone=True), server_default=func.now(), index=True)
+    end_date = Column(DateTime(timezone=True), nullable=False, index=True)
     payment_amount = Column(Integer, nullable=True)
     payment_id = Column(String, nullable=True, unique=True)
     auto_renewal = Column(Boolean, default=True)
@@ -48,11 +63,21 @@ class PromoCode(Base):
     used_count = Column(Integer, default=0)
     max_uses = Column(Integer, nullable=True)
 
+class PromoRedemption(Base):
+    __tablename__ = 'promo_redemptions'
+    __table_args__ = (
+        UniqueConstraint('promo_id', 'user_id', name='uq_promo_redemptions_promo_id_user_id'),
+    )
+    id = Column(Integer, primary_key=True)
+    promo_id = Column(Integer, ForeignKey('promo_codes.id'), nullable=False)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False, index=True)
+    redeemed_at = Column(DateTime, default=datetime.datetime.utcnow)
+
 class Referral(Base):
     __tablename__ = 'referrals'
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey('users.id'))
-    referred_user_id = Column(Integer, ForeignKey('users.id'))
+    user_id = Column(Integer, ForeignKey('users.id'), index=True)
+    referred_user_id = Column(Integer, ForeignKey('users.id'), index=True, unique=True)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
     referrer = relationship("User", back_populates="referrals_made", foreign_keys=[user_id])
     referred_user = relationship("User", back_populates="referrals_received", foreign_keys=[referred_user_id])
@@ -64,11 +89,288 @@ class Admin(Base):
     password_hash = Column(String)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
 
+class MediaAsset(Base):
+    __tablename__ = 'media_cache'
+    id = Column(Integer, primary_key=True)
+    content_hash = Column(String(64), unique=True, nullable=False)
+    media_type = Column(String, nullable=False)
+    file_name = Column(String, nullable=True)
+    file_size = Column(Integer, nullable=True)
+    file_id = Column(String, nullable=True)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    uploaded_at = Column(DateTime, nullable=True)
+
+class BroadcastJob(Base):
+    __tablename__ = 'broadcast_jobs'
+    id = Column(Integer, primary_key=True)
+    message_text = Column(Text, nullable=False)
+    target = Column(String, nullable=False, default='all')
+    selected_user_id = Column(Integer, nullable=True)
+    media_id = Column(Integer, ForeignKey('media_cache.id'), nullable=True)
+    status = Column(String, nullable=False, default='pending', index=True)
+    cursor_user_id = Column(Integer, nullable=False, default=0)
+    enumeration_done = Column(Boolean, nullable=False, default=False)
+    total_count = Column(Integer, nullable=False, default=0)
+    sent_count = Column(Integer, nullable=False, default=0)
+    failed_count = Column(Integer, nullable=False, default=0)
+    error = Column(String, nullable=True)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    recipients = relationship("BroadcastRecipient", back_populates="job")
+    media = relationship("MediaAsset")
+
+class BroadcastRecipient(Base):
+    __tablename__ = 'broadcast_recipients'
+    __table_args__ = (
+        UniqueConstraint('job_id', 'user_id', name='uq_broadcast_recipients_job_id_user_id'),
+        Index('ix_broadcast_recipients_job_id_status', 'job_id', 'status'),
+    )
+    id = Column(Integer, primary_key=True)
+    job_id = Column(Integer, ForeignKey('broadcast_jobs.id'), nullable=False)
+    user_id = Column(Integer, nullable=False)
+    telegram_id = Column(BigInteger, nullable=False)
+    status = Column(String, nullable=False, default='pending')
+    attempts = Column(Integer, nullable=False, default=0)
+    error = Column(String, nullable=True)
+    sent_at = Column(DateTime, nullable=True)
+    job = relationship("BroadcastJob", back_populates="recipients")
+
+class FSMRecord(Base):
+    __tablename__ = 'fsm_states'
+    key = Column(String, primary_key=True)
+    state = Column(String, nullable=True)
+    data = Column(Text, nullable=False, default='{}')
+    updated_at = Column(DateTime, nullable=False, index=True)
+
+class ExpiryNotice(Base):
+    __tablename__ = 'expiry_notices'
+    __table_args__ = (
+        UniqueConstraint('user_id', 'access_until', 'kind', name='uq_expiry_notices_user_id_access_until_kind'),
+    )
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, nullable=False)
+    access_until = Column(DateTime(timezone=True), nullable=False, index=True)
+    kind = Column(String, nullable=False)
+    sent_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+class PaymentNotification(Base):
+    __tablename__ = 'payment_notifications'
+    __table_args__ = (
+        UniqueConstraint('payment_id', 'status', name='uq_payment_notifications_payment_id_status'),
+    )
+    id = Column(Integer, primary_key=True)
+    payment_id = Column(String, nullable=False)
+    status = Column(String, nullable=False)
+    payload = Column(Text, nullable=False)
+    received_at = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+    processed_at = Column(DateTime, nullable=True, index=True)
+    error = Column(String, nullable=True)
+
+class SubscriptionDailyStats(Base):
+    __tablename__ = 'subscription_daily_stats'
+    day = Column(Date, primary_key=True)
+    new_payments = Column(Integer, nullable=False, default=0)
+    payment_total = Column(Integer, nullable=False, default=0)
+    expirations = Column(Integer, nullable=False, default=0)
+    auto_renewal_disabled = Column(Integer, nullable=False, default=0)
+    promo_uses = Column(Integer, nullable=False, default=0)
+
+class CatalogMessage(Base):
+    __tablename__ = 'catalog_messages'
+    key = Column(String, primary_key=True)
+    text = Column(Text, nullable=False)
+    parse_mode = Column(String, nullable=True)
+    disable_web_page_preview = Column(Boolean, nullable=False, default=False, server_default=false())
+    keyboard = Column(Text, nullable=True)
+    updated_at = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+class CatalogState(Base):
+    __tablename__ = 'catalog_state'
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=1, server_default='1')
+    price = Column(Integer, nullable=True)
+
+def dialect_insert(dialect_name, table):
+    # INSERT ... ON CONFLICT is spelled the same on both supported backends
+    return {"postgresql": postgresql.insert, "sqlite": sqlite.insert}[dialect_name](table)
+
+def access_until_expr():
+    return (select(func.max(Subscription.__table__.c.end_date))
+            .where(Subscription.__table__.c.user_id == User.__table__.c.id)
+            .scalar_subquery())
+
+def is_whitelisted_expr():
+    return exists().where(Whitelist.__table__.c.telegram_id == User.__table__.c.telegram_id)
+
+def refresh_user_access(connection, user_ids=None, telegram_ids=None):
+    users = User.__table__
+    stmt = update(users).values(access_until=access_until_expr(), is_whitelisted=is_whitelisted_expr())
+    if user_ids is not None or telegram_ids is not None:
+        conditions = []
+        if user_ids:
+            conditions.append(users.c.id.in_(list(user_ids)))
+        if telegram_ids:
+            conditions.append(users.c.telegram_id.in_(list(telegram_ids)))
+        if not conditions:
+            return
+        stmt = stmt.where(or_(*conditions))
+    connection.execute(stmt)
+
+def _history_values(obj, attr):
+    history = inspect(obj).attrs[attr].history
+    return [value for value in (*history.added, *history.unchanged, *history.deleted) if value is not None]
+
+@event.listens_for(Session, "after_flush")
+def _collect_access_changes(session, flush_context):
+    user_ids = session.info.setdefault("access_user_ids", set())
+    telegram_ids = session.info.setdefault("access_telegram_ids", set())
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(obj, Subscription):
+            user_ids.update(_history_values(obj, "user_id"))
+        elif isinstance(obj, Whitelist):
+            telegram_ids.update(_history_values(obj, "telegram_id"))
+        elif isinstance(obj, User) and obj in session.new:
+            telegram_ids.add(obj.telegram_id)
+
+@event.listens_for(Session, "after_flush_postexec")
+def _refresh_access_columns(session, flush_context):
+    user_ids = session.info.pop("access_user_ids", set())
+    telegram_ids = session.info.pop("access_telegram_ids", set())
+    if not user_ids and not telegram_ids:
+        return
+    # Same connection and transaction as the flush, so the denormalized columns commit or roll back with it
+    refresh_user_access(session.connection(), user_ids=user_ids, telegram_ids=telegram_ids)
+    for obj in list(session.identity_map.values()):
+        if isinstance(obj, User) and (obj.id in user_ids or obj.telegram_id in telegram_ids):
+            session.expire(obj, ["access_until", "is_whitelisted"])
+
+def utc_today():
+    return datetime.datetime.now(datetime.timezone.utc).date()
+
+def as_day(value):
+    if isinstance(value, str):
+        return datetime.date.fromisoformat(value[:10])
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    return value
+
+def daily_subscription_rows(connection, start, end):
+    # Per-day payments and expirations in [start, end), straight from subscriptions
+    subs = Subscription.__table__
+    lower = datetime.datetime.combine(start, datetime.time())
+    upper = datetime.datetime.combine(end, datetime.time())
+    rows = {}
+    paid = connection.execute(
+        select(func.date(subs.c.start_date), func.count(), func.coalesce(func.sum(subs.c.payment_amount), 0))
+        .where(subs.c.start_date >= lower, subs.c.start_date < upper)
+        .group_by(func.date(subs.c.start_date)))
+    for day, count, total in paid:
+        rows.setdefault(as_day(day), {"new_payments": 0, "payment_total": 0, "expirations": 0}).update(
+            new_payments=count, payment_total=total)
+    ending = connection.execute(
+        select(func.date(subs.c.end_date), func.count())
+        .where(subs.c.end_date >= lower, subs.c.end_date < upper)
+        .group_by(func.date(subs.c.end_date)))
+    for day, count in ending:
+        rows.setdefault(as_day(day), {"new_payments": 0, "payment_total": 0, "expirations": 0})["expirations"] = count
+    return rows
+
+def refresh_daily_stats(connection, start, end):
+    # Recomputes the columns derived from subscriptions for every day in
+    # [start, end); auto-renewal and promo counters are events and are kept
+    rows = daily_subscription_rows(connection, start, end)
+    stats = SubscriptionDailyStats.__table__
+    day = start
+    while day < end:
+        values = rows.get(day, {"new_payments": 0, "payment_total": 0, "expirations": 0})
+        insert = dialect_insert(connection.dialect.name, stats)
+        connection.execute(insert.values(day=day, auto_renewal_disabled=0, promo_uses=0, **values)
+                           .on_conflict_do_update(index_elements=[stats.c.day], set_=values))
+        day += datetime.timedelta(days=1)
+
+def record_daily_events(connection, day, auto_renewal_disabled=0, promo_uses=0):
+    stats = SubscriptionDailyStats.__table__
+    insert = dialect_insert(connection.dialect.name, stats)
+    connection.execute(insert.values(day=day, new_payments=0, payment_total=0, expirations=0,
+                                     auto_renewal_disabled=auto_renewal_disabled, promo_uses=promo_uses)
+                       .on_conflict_do_update(index_elements=[stats.c.day], set_={
+                           "auto_renewal_disabled": stats.c.auto_renewal_disabled + auto_renewal_disabled,
+                           "promo_uses": stats.c.promo_uses + promo_uses,
+                       }))
+
+# Makes the ORM load the previous value on assignment, even when a commit
+# expired the object, so the flush hook below can see the actual change
+@event.listens_for(Subscription.auto_renewal, "set", active_history=True)
+@event.listens_for(PromoCode.used_count, "set", active_history=True)
+def _keep_previous_value(target, value, oldvalue, initiator):
+    return value
+
+@event.listens_for(Session, "after_flush")
+def _collect_rollup_changes(session, flush_context):
+    days = session.info.setdefault("rollup_days", set())
+    events = session.info.setdefault("rollup_events", {"auto_renewal_disabled": 0, "promo_uses": 0})
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(obj, Subscription):
+            state = inspect(obj)
+            if obj not in session.dirty or any(state.attrs[attr].history.has_changes()
+                                               for attr in ("start_date", "end_date", "payment_amount")):
+                days.update(as_day(value) for value in (*_history_values(obj, "start_date"), *_history_values(obj, "end_date")))
+            if obj in session.new and obj.start_date is None:
+                days.add(utc_today())
+            history = state.attrs["auto_renewal"].history
+            if obj in session.dirty and True in history.deleted and False in history.added:
+                events["auto_renewal_disabled"] += 1
+        elif isinstance(obj, PromoCode) and obj in session.dirty:
+            history = inspect(obj).attrs["used_count"].history
+            if history.added and history.deleted and all(isinstance(v, int) for v in (history.added[0], history.deleted[0])):
+                events["promo_uses"] += history.added[0] - history.deleted[0]
+
+@event.listens_for(Session, "after_flush_postexec")
+def _refresh_rollups(session, flush_context):
+    days = session.info.pop("rollup_days", set())
+    events = session.info.pop("rollup_events", {})
+    if not days and not any(events.values()):
+        return
+    connection = session.connection()
+    for day in sorted(days):
+        refresh_daily_stats(connection, day, day + datetime.timedelta(days=1))
+    if any(events.values()):
+        record_daily_events(connection, utc_today(), **events)
+
 engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False} if "sqlite" in DATABASE_URL else {})
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+def get_async_database_url(url: str) -> str:
+    if url.startswith("sqlite:"):
+        return url.replace("sqlite:", "sqlite+aiosqlite:", 1)
+    if url.startswith("postgresql://") or url.startswith("postgres://"):
+        return "postgresql+asyncpg://" + url.split("://", 1)[1]
+    if url.startswith("postgresql+psycopg2://"):
+        return url.replace("postgresql+psycopg2://", "postgresql+asyncpg://", 1)
+    return url
+
+async_engine = create_async_engine(get_async_database_url(DATABASE_URL))
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+def get_alembic_config():
+    from alembic.config import Config
+
+    alembic_cfg = Config(os.path.join(BASE_DIR, "alembic.ini"))
+    alembic_cfg.set_main_option("script_location", os.path.join(BASE_DIR, "migrations"))
+    return alembic_cfg
+
 def init_db():
-    Base.metadata.create_all(bind=engine)
+    from alembic import command
+
+    alembic_cfg = get_alembic_config()
+    with engine.begin() as connection:
+        alembic_cfg.attributes["connection"] = connection
+        tables = inspect(connection).get_table_names()
+        if "users" in tables and "alembic_version" not in tables:
+            # Database created by the old create_all() path: adopt it at the baseline
+            command.stamp(alembic_cfg, BASELINE_REVISION)
+        command.upgrade(alembic_cfg, "head")
 
 @contextmanager
 def get_db():
@@ -76,4 +378,9 @@ def get_db():
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+@asynccontextmanager
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
@@ -0,0 +1,257 @@
+import asyncio
+import datetime
+import hashlib
+import hmac
+import json
+import logging
+
+from sqlalchemy import select, update
+
+import queries
+from access_cache import access_cache, as_utc
+from asgi import get_header, read_body, send_json, send_response
+from catalog import message_catalog
+from config import (
+    SUBSCRIPTION_DAYS,
+    PAYMENT_INGEST_BATCH,
+    PAYMENT_INGEST_TIMEOUT,
+    PAYMENT_CONSUMER_BATCH,
+    PAYMENT_CONSUMER_INTERVAL
+)
+from database import get_async_db
+from models import PaymentNotification, Subscription, User, async_engine, dialect_insert
+
+logger = logging.getLogger(__name__)
+
+SUCCEEDED = "succeeded"
+REFUNDED = "refunded"
+
+
+def sign(secret: str, body: bytes) -> str:
+    return hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+
+def parse_notification(body: bytes) -> dict | None:
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        return None
+    if not isinstance(payload, dict):
+        return None
+    payment_id, status = payload.get("payment_id"), payload.get("status")
+    if not isinstance(payment_id, str) or not payment_id or not isinstance(status, str) or not status:
+        return None
+    return payload
+
+
+# POST <path> takes a provider callback: a JSON object with at least
+# payment_id and status, signed as hex HMAC-SHA256 of the raw body with the
+# merchant secret in X-Signature; with no secret every callback is refused.
+# The handler only appends the callback to payment_notifications and
+# answers; nothing here touches subscriptions.
+# Concurrent callbacks share one INSERT and commit, and each is acknowledged
+# once that commit has made it durable. A replayed callback (same payment_id
+# and status) is a no-op insert but still gets 200, so the provider stops retrying
+class PaymentNotificationApp:
+    def __init__(self, path: str, secret: str, batch_size: int = PAYMENT_INGEST_BATCH,
+                 timeout: float = PAYMENT_INGEST_TIMEOUT):
+        self.path = path.rstrip("/")
+        self.secret = secret
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.received = 0
+        self.rejected = 0
+        self.stored = 0
+        self.batches = 0
+        self._pending: list[tuple[dict, asyncio.Future]] = []
+        self._wake = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def _authorized(self, scope, body: bytes) -> bool:
+        signature = (get_header(scope, b"x-signature") or b"").decode("latin-1")
+        return bool(self.secret) and hmac.compare_digest(signature, sign(self.secret, body))
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return
+        path, method = scope["path"].rstrip("/"), scope["method"]
+        if path != self.path:
+            await send_response(send, 404)
+            return
+        if method != "POST":
+            await send_response(send, 405)
+            return
+
+        body = await read_body(receive)
+        if body is None:
+            await send_response(send, 413)
+            return
+        if not self._authorized(scope, body):
+            self.rejected += 1
+            logger.warning("Rejected payment notification with a bad signature")
+            await send_response(send, 401)
+            return
+        payload = parse_notification(body)
+        if payload is None:
+            self.rejected += 1
+            await send_response(send, 400)
+            return
+
+        self.received += 1
+        row = {"payment_id": payload["payment_id"], "status": payload["status"],
+               "payload": body.decode(), "received_at": datetime.datetime.utcnow()}
+        try:
+            await asyncio.wait_for(asyncio.shield(self._store(row)), timeout=self.timeout)
+        except Exception as e:
+            # The provider retries anything but a 2xx, so nothing is lost
+            logger.error(f"Failed to store payment notification {payload['payment_id']}: {e}")
+            await send_response(send, 503)
+            return
+        await send_json(send, 200, {"ok": True})
+
+    def _store(self, row: dict) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((row, future))
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        self._wake.set()
+        return future
+
+    async def _run(self) -> None:
+        while True:
+            await self._wake.wait()
+            self._wake.clear()
+            while self._pending:
+                batch, self._pending = self._pending[:self.batch_size], self._pending[self.batch_size:]
+                try:
+                    async with get_async_db() as db:
+                        insert = dialect_insert(async_engine.dialect.name, PaymentNotification)
+                        await db.execute(insert.on_conflict_do_nothing(
+                            index_elements=[PaymentNotification.payment_id, PaymentNotification.status]
+                        ), [row for row, _ in batch])
+                        await db.commit()
+                except Exception as e:
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                self.stored += len(batch)
+                self.batches += 1
+                for _, future in batch:
+                    if not future.done():
+                        future.set_result(None)
+
+    def stats(self) -> dict:
+        return {"received": self.received, "rejected": self.rejected, "stored": self.stored,
+                "batches": self.batches, "pending": len(self._pending)}
+
+
+# Applies stored notifications in arrival order, a batch per transaction, so
+# a retry storm is just more rows in payment_notifications and subscriptions
+# only ever see this one writer. The outcome of a payment depends on every
+# status ever received for it, not just the ones in the batch: a refund wins
+# over a success whichever arrived first, and a success whose payment_id is
+# already in subscriptions is a duplicate
+class PaymentNotificationConsumer:
+    def __init__(self, batch_size: int = PAYMENT_CONSUMER_BATCH, interval: float = PAYMENT_CONSUMER_INTERVAL,
+                 price: int | None = None, days: int = SUBSCRIPTION_DAYS):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.price = price
+        self.period = datetime.timedelta(days=days)
+        self.applied = 0
+        self.duplicates = 0
+        self.refunded = 0
+        self.failed = 0
+
+    async def run(self) -> None:
+        logger.info("Payment notification consumer started.")
+        while True:
+            try:
+                if await self.consume():
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Payment notification batch failed")
+            await asyncio.sleep(self.interval)
+
+    async def consume(self) -> int:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        async with get_async_db() as db:
+            batch = (await db.execute(queries.unprocessed_payment_notifications(self.batch_size))).all()
+            if not batch:
+                return 0
+
+            payment_ids = list(dict.fromkeys(row.payment_id for row in batch))
+            statuses: dict[str, dict[str, dict]] = {}
+            for payment_id, status, payload in (await db.execute(
+                select(PaymentNotification.payment_id, PaymentNotification.status, PaymentNotification.payload)
+                .where(PaymentNotification.payment_id.in_(payment_ids))
+            )):
+                statuses.setdefault(payment_id, {})[status] = json.loads(payload)
+            existing = {subscription.payment_id: (subscription, telegram_id) for subscription, telegram_id in (
+                await db.execute(select(Subscription, User.telegram_id).join(User, User.id == Subscription.user_id)
+                                 .where(Subscription.payment_id.in_(payment_ids)))
+            )}
+            telegram_ids = [payloads[SUCCEEDED].get("telegram_id") for payloads in statuses.values()
+                            if SUCCEEDED in payloads]
+            users = {user.telegram_id: user for user in (await db.execute(
+                select(User.id, User.telegram_id, User.access_until)
+                .where(User.telegram_id.in_([t for t in telegram_ids if isinstance(t, int)]))
+            ))}
+
+            errors, changed, access_end = {}, set(), {}
+            for payment_id in payment_ids:
+                payloads = statuses.get(payment_id, {})
+                subscription, telegram_id = existing.get(payment_id, (None, None))
+                if REFUNDED in payloads:
+                    if subscription is not None:
+                        # Revoke what is left of the period; one that has not started yet collapses to nothing
+                        end = max(now, as_utc(subscription.start_date))
+                        if as_utc(subscription.end_date) > end:
+                            subscription.end_date = end
+                            subscription.auto_renewal = False
+                            changed.add(telegram_id)
+                            self.refunded += 1
+                elif SUCCEEDED in payloads:
+                    if subscription is not None:
+                        self.duplicates += 1
+                        continue
+                    payload = payloads[SUCCEEDED]
+                    user = users.get(payload.get("telegram_id"))
+                    if user is None:
+                        errors[payment_id] = "unknown telegram_id"
+                        continue
+                    # Extends from the current end, including payments earlier in this batch
+                    start = max(now, access_end.get(user.id) or as_utc(user.access_until) or now)
+                    access_end[user.id] = start + self.period
+                    amount = payload.get("amount")
+                    if not isinstance(amount, int):
+                        amount = self.price or message_catalog.price
+                    db.add(Subscription(user_id=user.id, start_date=start, end_date=start + self.period,
+                                        payment_amount=amount, payment_id=payment_id, auto_renewal=True))
+                    changed.add(user.telegram_id)
+                    self.applied += 1
+
+            await db.flush()
+            batch_ids = [row.id for row in batch]
+            await db.execute(update(PaymentNotification).where(PaymentNotification.id.in_(batch_ids))
+                             .values(processed_at=datetime.datetime.utcnow()))
+            for payment_id, error in errors.items():
+                await db.execute(update(PaymentNotification)
+                                 .where(PaymentNotification.id.in_(batch_ids), PaymentNotification.payment_id == payment_id)
+                                 .values(error=error))
+            await db.commit()
+
+        self.failed += len(errors)
+        for telegram_id in changed:
+            access_cache.invalidate(telegram_id)
+        for payment_id, error in errors.items():
+            logger.error(f"Payment notification {payment_id} not applied: {error}")
+        logger.info(f"Applied {len(batch)} payment notifications ({len(changed)} users changed)")
+        return len(batch)
+
+    def stats(self) -> dict:
+        return {"applied": self.applied, "duplicates": self.duplicates,
+                "refunded": self.refunded, "failed": self.failed}
@@ -0,0 +1,91 @@
+import asyncio
+import logging
+import random
+import uuid
+
+logger = logging.getLogger(__name__)
+
+
+class PaymentDeclined(Exception):
+    pass
+
+
+# What the renewal runner needs from a payment provider. `idempotency_key`
+# identifies one renewal: charging the same key again must return the first
+# charge's payment id instead of taking the money twice. Raise PaymentDeclined
+# for a final refusal; any other exception counts as transient and the charge
+# is retried on the next pass
+class PaymentProvider:
+    async def charge(self, idempotency_key: str, user_id: int, amount: int, description: str) -> str:
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        pass
+
+
+# In-process stand-in for local runs and benchmarks: keeps its charges in
+# memory, keyed like a real provider's idempotency keys
+class FakeProvider(PaymentProvider):
+    def __init__(self, latency: float = 0.0, decline_rate: float = 0.0, error_rate: float = 0.0,
+                 lost_rate: float = 0.0):
+        self.latency = latency
+        self.decline_rate = decline_rate
+        self.error_rate = error_rate
+        # Share of successful charges whose response never arrives, as on a timeout after the provider took the money
+        self.lost_rate = lost_rate
+        self.charges: dict[str, tuple[str, int, int]] = {}
+        self.refused: set[str] = set()
+        self.calls = 0
+        self.replayed = 0
+        self.declined = 0
+        self.errors = 0
+        self._pending: dict[str, asyncio.Future] = {}
+
+    async def charge(self, idempotency_key: str, user_id: int, amount: int, description: str) -> str:
+        self.calls += 1
+        if idempotency_key in self.charges:
+            self.replayed += 1
+            return self.charges[idempotency_key][0]
+        if idempotency_key in self.refused:
+            self.replayed += 1
+            raise PaymentDeclined("insufficient funds")
+        if idempotency_key in self._pending:
+            # Concurrent retry of an in-flight charge waits for its outcome
+            self.replayed += 1
+            return await asyncio.shield(self._pending[idempotency_key])
+        future = asyncio.get_running_loop().create_future()
+        self._pending[idempotency_key] = future
+        try:
+            if self.latency:
+                await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+            if random.random() < self.error_rate:
+                self.errors += 1
+                raise ConnectionError("fake provider timeout")
+            if random.random() < self.decline_rate:
+                self.declined += 1
+                self.refused.add(idempotency_key)
+                raise PaymentDeclined("insufficient funds")
+            payment_id = uuid.uuid4().hex
+            self.charges[idempotency_key] = (payment_id, user_id, amount)
+            if random.random() < self.lost_rate:
+                self.errors += 1
+                raise ConnectionError("fake provider response lost")
+            future.set_result(payment_id)
+            return payment_id
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()
+            raise
+        finally:
+            del self._pending[idempotency_key]
+
+
+PROVIDERS = {"fake": FakeProvider}
+
+
+def get_provider(name: str) -> PaymentProvider | None:
+    if not name:
+        return None
+    if name not in PROVIDERS:
+        raise ValueError(f"Unknown payment provider {name!r}, expected one of {', '.join(PROVIDERS)}")
+    return PROVIDERS[name]()
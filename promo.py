@@ -0,0 +1,199 @@
+import asyncio
+import logging
+import threading
+import time
+from dataclasses import dataclass
+
+from sqlalchemy import delete, func, select, update
+
+import queries
+from config import PROMO_CACHE_TTL
+from database import get_async_db
+from models import PromoCode, PromoRedemption, async_engine, dialect_insert, record_daily_events, utc_today
+
+logger = logging.getLogger(__name__)
+
+REDEEMED = "redeemed"
+ALREADY_REDEEMED = "already_redeemed"
+EXHAUSTED = "exhausted"
+INACTIVE = "inactive"
+
+
+@dataclass(frozen=True)
+class PromoEntry:
+    id: int
+    code: str
+    discount_percent: int
+    max_uses: int | None
+
+
+# Active codes by code, including misses, so a blast of one code (or of a
+# mistyped one) is answered from memory. used_count is not cached: it is only
+# ever changed by PromoRedeemer's conditional UPDATE. A code seen sold out is
+# remembered as such until the admin panel invalidates it
+class PromoCache:
+    def __init__(self, ttl: float = PROMO_CACHE_TTL):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: dict[str, tuple[PromoEntry | None, float]] = {}
+        self._exhausted: set[str] = set()
+        self._lock = threading.Lock()
+        self.listeners = []
+
+    def get(self, code: str) -> tuple[bool, PromoEntry | None]:
+        with self._lock:
+            cached = self._entries.get(code)
+            if cached is None or cached[1] <= time.time():
+                self.misses += 1
+                return False, None
+            self.hits += 1
+            return True, cached[0]
+
+    def put(self, code: str, entry: PromoEntry | None) -> None:
+        with self._lock:
+            self._entries[code] = (entry, time.time() + self.ttl)
+
+    def mark_exhausted(self, code: str) -> None:
+        with self._lock:
+            self._exhausted.add(code)
+
+    def is_exhausted(self, code: str) -> bool:
+        return code in self._exhausted
+
+    def invalidate(self, code: str | None) -> None:
+        with self._lock:
+            if code is None:
+                self._entries.clear()
+                self._exhausted.clear()
+            else:
+                self._entries.pop(code, None)
+                self._exhausted.discard(code)
+        for listener in self.listeners:
+            listener(code)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._entries), "exhausted": len(self._exhausted),
+                    "hits": self.hits, "misses": self.misses}
+
+
+promo_cache = PromoCache()
+
+
+async def active_promo(code: str) -> PromoEntry | None:
+    hit, entry = promo_cache.get(code)
+    if hit:
+        return entry
+    async with get_async_db() as db:
+        promo = await db.scalar(queries.active_promo_code(code))
+    entry = PromoEntry(promo.id, promo.code, promo.discount_percent, promo.max_uses) if promo else None
+    promo_cache.put(code, entry)
+    return entry
+
+
+# Redemptions of one code are coalesced: whatever arrives while a batch is in
+# flight goes into the next one, so a hot code costs one short transaction per
+# batch rather than one row lock per user. Each batch inserts the per-user
+# redemption rows, then claims uses with a compare-and-swap on used_count that
+# never goes past max_uses; users beyond the remaining uses are rolled back.
+# The CAS retries when another process changed the count in between
+class PromoRedeemer:
+    def __init__(self, cache: PromoCache = promo_cache, max_retries: int = 20):
+        self.cache = cache
+        self.max_retries = max_retries
+        self.redeemed = 0
+        self.rejected = 0
+        self.batches = 0
+        self._pending: dict[int, list[tuple[int, asyncio.Future]]] = {}
+        self._tasks: dict[int, asyncio.Task] = {}
+
+    async def redeem(self, promo: PromoEntry, user_id: int) -> str:
+        if self.cache.is_exhausted(promo.code):
+            # A user who redeemed the code before it sold out still has it
+            async with get_async_db() as db:
+                if await db.scalar(queries.promo_redemption(promo.id, user_id)) is not None:
+                    return ALREADY_REDEEMED
+            self.rejected += 1
+            return EXHAUSTED
+        future = asyncio.get_running_loop().create_future()
+        self._pending.setdefault(promo.id, []).append((user_id, future))
+        if promo.id not in self._tasks:
+            self._tasks[promo.id] = asyncio.create_task(self._drain(promo))
+        return await future
+
+    async def _drain(self, promo: PromoEntry) -> None:
+        try:
+            while self._pending.get(promo.id):
+                batch = self._pending.pop(promo.id)
+                try:
+                    outcomes = await self._redeem_batch(promo, [user_id for user_id, _ in batch])
+                except Exception as e:
+                    logger.exception(f"Promo code {promo.code} redemption batch failed")
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                for user_id, future in batch:
+                    if not future.done():
+                        future.set_result(outcomes[user_id])
+        finally:
+            del self._tasks[promo.id]
+
+    async def _redeem_batch(self, promo: PromoEntry, user_ids: list[int]) -> dict[int, str]:
+        users = list(dict.fromkeys(user_ids))
+        async with get_async_db() as db:
+            insert = dialect_insert(async_engine.dialect.name, PromoRedemption)
+            inserted = set((await db.execute(
+                insert.on_conflict_do_nothing(index_elements=[PromoRedemption.promo_id, PromoRedemption.user_id])
+                .returning(PromoRedemption.user_id),
+                [{"promo_id": promo.id, "user_id": user_id} for user_id in users]
+            )).scalars())
+            new = [user_id for user_id in users if user_id in inserted]
+
+            granted = 0
+            for _ in range(self.max_retries):
+                row = (await db.execute(
+                    select(func.coalesce(PromoCode.used_count, 0), PromoCode.max_uses, PromoCode.is_active)
+                    .where(PromoCode.id == promo.id)
+                )).one_or_none()
+                if row is None or not row[2]:
+                    await db.rollback()
+                    self.cache.invalidate(promo.code)
+                    self.rejected += len(users)
+                    return {user_id: INACTIVE for user_id in users}
+                used, max_uses = row[0], row[1]
+                granted = len(new) if max_uses is None else max(0, min(len(new), max_uses - used))
+                if granted == 0:
+                    break
+                result = await db.execute(
+                    update(PromoCode)
+                    .where(PromoCode.id == promo.id, func.coalesce(PromoCode.used_count, 0) == used)
+                    .values(used_count=used + granted)
+                )
+                if result.rowcount:
+                    break
+            else:
+                await db.rollback()
+                raise RuntimeError(f"used_count of promo code {promo.code} kept changing")
+
+            refused = new[granted:]
+            if refused:
+                await db.execute(delete(PromoRedemption).where(PromoRedemption.promo_id == promo.id,
+                                                               PromoRedemption.user_id.in_(refused)))
+                self.cache.mark_exhausted(promo.code)
+            if granted:
+                await db.run_sync(lambda session: record_daily_events(session.connection(), utc_today(),
+                                                                      promo_uses=granted))
+            await db.commit()
+
+        self.batches += 1
+        self.redeemed += granted
+        self.rejected += len(refused)
+        outcomes = {user_id: ALREADY_REDEEMED for user_id in users}
+        outcomes.update({user_id: REDEEMED for user_id in new[:granted]})
+        outcomes.update({user_id: EXHAUSTED for user_id in refused})
+        return outcomes
+
+    def stats(self) -> dict:
+        return {"redeemed": self.redeemed, "rejected": self.rejected, "batches": self.batches}
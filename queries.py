@@ -0,0 +1,214 @@
+import datetime
+
+from sqlalchemy import func, or_, select, tuple_
+from sqlalchemy.orm import aliased
+
+from models import User, Subscription, PromoCode, PromoRedemption, PaymentNotification, CatalogState, Whitelist
+
+MAX_TELEGRAM_ID = 2 ** 63 - 1
+USER_LIST_COLUMNS = (User.id, User.telegram_id, User.telegram_username, User.email,
+                     User.registration_date, User.is_active)
+USER_SORT_COLUMNS = {"id": User.id, "registration_date": User.registration_date}
+USER_SEARCH_COLUMNS = (User.id, User.telegram_id, User.telegram_username, User.email, User.is_whitelisted)
+
+
+def user_by_telegram_id(telegram_id: int):
+    return select(User).where(User.telegram_id == telegram_id).limit(1)
+
+
+def user_by_email(email: str):
+    return select(User).where(User.email == email).limit(1)
+
+
+def catalog_state():
+    return select(CatalogState.version, CatalogState.price).where(CatalogState.id == 1)
+
+
+def referrer_by_code(code: str):
+    # Deep links carry either the admin-set override code or the telegram id
+    columns = (User.id, User.referral_status_override, User.is_active)
+    # Longer digit runs do not fit the BIGINT column and can only be override codes
+    if code.isascii() and code.isdigit() and 0 < int(code) <= MAX_TELEGRAM_ID:
+        return select(*columns).where(or_(User.referral_link_override == code,
+                                          User.telegram_id == int(code))).limit(1)
+    return select(*columns).where(User.referral_link_override == code).limit(1)
+
+
+def referral_count(user_id: int):
+    return select(User.referral_count).where(User.id == user_id)
+
+
+def referral_leaderboard(limit: int):
+    return (select(User.id, User.telegram_id, User.telegram_username, User.email, User.referral_count)
+            .where(User.referral_count > 0)
+            .order_by(User.referral_count.desc())
+            .limit(limit))
+
+
+def latest_auto_renewal(user_id: int):
+    return (select(Subscription.auto_renewal)
+            .where(Subscription.user_id == user_id)
+            .order_by(Subscription.end_date.desc())
+            .limit(1))
+
+
+def active_subscription(user_id: int, now: datetime.datetime):
+    return (select(Subscription)
+            .where(Subscription.user_id == user_id)
+            .where(Subscription.end_date > now)
+            .order_by(Subscription.end_date.desc())
+            .limit(1))
+
+
+def active_promo_code(code: str):
+    return select(PromoCode).where(PromoCode.code == code, PromoCode.is_active == True).limit(1)
+
+
+def promo_redemption(promo_id: int, user_id: int):
+    return select(PromoRedemption.id).where(PromoRedemption.promo_id == promo_id,
+                                            PromoRedemption.user_id == user_id).limit(1)
+
+
+def subscriptions_started_between(start: datetime.date, end: datetime.date):
+    return select(Subscription).where(Subscription.start_date >= start, Subscription.start_date < end)
+
+
+def subscriptions_ending_between(start: datetime.date, end: datetime.date):
+    return select(Subscription).where(Subscription.end_date >= start, Subscription.end_date < end)
+
+
+def users_expiring_between(start: datetime.datetime, end: datetime.datetime):
+    # Whitelisted users keep access past end_date, so they get no expiry notices
+    return (select(User.id, User.telegram_id, User.access_until)
+            .where(User.access_until > start, User.access_until <= end,
+                   User.is_whitelisted == False, User.is_active == True))
+
+
+def subscriptions_due_for_renewal(start: datetime.datetime, end: datetime.datetime,
+                                  after: tuple | None, limit: int):
+    # Only a user's latest subscription renews; once renewed, access_until moves
+    # past it and it drops out of this query
+    query = (select(Subscription.id, Subscription.user_id, Subscription.end_date, User.telegram_id)
+             .join(User, User.id == Subscription.user_id)
+             .where(Subscription.auto_renewal == True,
+                    Subscription.end_date > start, Subscription.end_date <= end,
+                    Subscription.end_date == User.access_until,
+                    User.is_active == True, User.is_whitelisted == False))
+    if after is not None:
+        query = query.where(tuple_(Subscription.end_date, Subscription.id) > tuple_(*after))
+    return query.order_by(Subscription.end_date, Subscription.id).limit(limit)
+
+
+def unprocessed_payment_notifications(limit: int):
+    return (select(PaymentNotification.id, PaymentNotification.payment_id)
+            .where(PaymentNotification.processed_at.is_(None))
+            .order_by(PaymentNotification.id)
+            .limit(limit))
+
+
+def user_filters(active: bool | None = None, has_email: bool | None = None,
+                 registered_from: datetime.date | None = None, registered_to: datetime.date | None = None) -> list:
+    conditions = []
+    if active is not None:
+        conditions.append(User.is_active == active)
+    # Same rule as the bot: an empty or temp_ placeholder address is no email
+    placeholder = or_(User.email == "", User.email.startswith("temp_", autoescape=True))
+    if has_email is True:
+        conditions.append(~placeholder)
+    elif has_email is False:
+        conditions.append(placeholder)
+    if registered_from is not None:
+        conditions.append(User.registration_date >= registered_from)
+    if registered_to is not None:
+        conditions.append(User.registration_date < registered_to + datetime.timedelta(days=1))
+    return conditions
+
+
+def users_page(conditions: list, sort: str, descending: bool, cursor_id: int | None, backwards: bool, limit: int):
+    # Keyset pagination: the cursor is the id of the last (or, going backwards,
+    # first) row shown, and its sort value is read back from the table so the
+    # comparison never round-trips a datetime through the URL
+    column = USER_SORT_COLUMNS[sort]
+    query = select(*USER_LIST_COLUMNS).where(*conditions)
+    if sort != "id":
+        query = query.where(column.isnot(None))
+    reverse = descending != backwards
+    if cursor_id is not None:
+        if sort == "id":
+            key, boundary = User.id, cursor_id
+        else:
+            anchor = aliased(User)
+            key = tuple_(column, User.id)
+            boundary = tuple_(select(getattr(anchor, sort)).where(anchor.id == cursor_id).scalar_subquery(), cursor_id)
+        query = query.where(key < boundary if reverse else key > boundary)
+    order = [column, User.id] if sort != "id" else [User.id]
+    query = query.order_by(*(c.desc() if reverse else c.asc() for c in order))
+    return query.limit(limit)
+
+
+def whitelist_page(cursor_id: int | None, backwards: bool, limit: int, telegram_id: int | None = None):
+    # Newest entries first, keyset-paginated on the primary key like users_page
+    query = select(Whitelist.id, Whitelist.telegram_id, Whitelist.added_date)
+    if telegram_id is not None:
+        query = query.where(Whitelist.telegram_id == telegram_id)
+    if cursor_id is not None:
+        query = query.where(Whitelist.id > cursor_id if backwards else Whitelist.id < cursor_id)
+    return query.order_by(Whitelist.id.asc() if backwards else Whitelist.id.desc()).limit(limit)
+
+
+def escape_like(term: str) -> str:
+    return term.replace("/", "//").replace("%", "/%").replace("_", "/_")
+
+
+def user_prefix_search(column, term: str, limit: int, dialect: str):
+    # Migration 0008 indexes these columns case-insensitively: COLLATE NOCASE
+    # on SQLite (whose LIKE already ignores case), lower() text_pattern_ops on
+    # PostgreSQL. Each form below is the one its index can serve
+    pattern = escape_like(term) + "%"
+    if dialect == "sqlite":
+        condition, order = column.like(pattern, escape="/"), column.collate("NOCASE")
+    else:
+        condition, order = func.lower(column).like(pattern.lower(), escape="/"), func.lower(column)
+    return select(*USER_SEARCH_COLUMNS).where(condition).order_by(order).limit(limit)
+
+
+def user_search(term: str, limit: int, dialect: str) -> list:
+    # One indexed query per match kind, best matches first; the caller merges them
+    term = term.strip()
+    statements = []
+    if term.isascii() and term.isdigit() and 0 < int(term) <= MAX_TELEGRAM_ID:
+        statements.append(select(*USER_SEARCH_COLUMNS).where(User.telegram_id == int(term)).limit(1))
+    if term:
+        statements.append(user_prefix_search(User.telegram_username, term.lstrip("@"), limit, dialect))
+        statements.append(user_prefix_search(User.email, term, limit, dialect))
+    return statements
+
+
+def hot_queries(dialect: str = "sqlite"):
+    # Sample arguments only need the right types; the planner check in
+    # manage.py runs EXPLAIN on each of these
+    now = datetime.datetime.now(datetime.timezone.utc)
+    today = now.date()
+    tomorrow = today + datetime.timedelta(days=1)
+    return {
+        "user_by_telegram_id": user_by_telegram_id(1),
+        "user_by_email": user_by_email("user@example.com"),
+        "latest_auto_renewal": latest_auto_renewal(1),
+        "referrer_by_code": referrer_by_code("partner"),
+        "referrer_by_telegram_id": referrer_by_code("12345"),
+        "referral_leaderboard": referral_leaderboard(50),
+        "active_subscription": active_subscription(1, now),
+        "active_promo_code": active_promo_code("PROMO"),
+        "promo_redemption": promo_redemption(1, 1),
+        "subscriptions_started_between": subscriptions_started_between(today, tomorrow),
+        "subscriptions_ending_between": subscriptions_ending_between(today, tomorrow),
+        "users_expiring_between": users_expiring_between(now, now + datetime.timedelta(days=4)),
+        "subscriptions_due_for_renewal": subscriptions_due_for_renewal(now, now + datetime.timedelta(days=1),
+                                                                       (now, 1), 500),
+        "unprocessed_payment_notifications": unprocessed_payment_notifications(500),
+        "users_page_by_id": users_page([], "id", True, 1000, False, 50),
+        "users_page_by_registration_date": users_page([], "registration_date", True, 1000, False, 50),
+        "whitelist_page": whitelist_page(1000, False, 50),
+        "user_search_by_username": user_prefix_search(User.telegram_username, "user", 10, dialect),
+        "user_search_by_email": user_prefix_search(User.email, "user", 10, dialect),
+    }
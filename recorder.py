@@ -0,0 +1,210 @@
+import asyncio
+import datetime
+import gzip
+import hashlib
+import heapq
+import hmac
+import json
+import logging
+import os
+import re
+import secrets
+import time
+from typing import Iterable, Iterator
+
+from aiogram import BaseMiddleware, types
+
+from config import (
+    UPDATE_RECORD,
+    UPDATE_RECORD_DIR,
+    UPDATE_RECORD_KEY,
+    UPDATE_RECORD_ROTATE_MB,
+    UPDATE_RECORD_ROTATE_MINUTES,
+    UPDATE_RECORD_KEEP_FILES,
+    UPDATE_RECORD_FLUSH_INTERVAL
+)
+
+logger = logging.getLogger(__name__)
+
+FILE_PREFIX = "updates-"
+FILE_SUFFIX = ".jsonl.gz"
+MAX_PENDING = 50_000
+# Remapped ids start above any real Telegram id and stay below 2**53
+ANON_ID_BASE = 10 ** 15
+
+_EMAIL = re.compile(r"[^@\s]+@[^@\s]+\.[^@\s]+")
+_TOKEN = re.compile(r"[A-Za-z0-9_-]{1,32}")
+_LONG_NUMBER = re.compile(r"\d{5,}")
+
+
+# Telegram ids map to stable pseudonymous ids (HMAC of the id under
+# UPDATE_RECORD_KEY), so one user keeps one id across files, restarts and
+# shard workers sharing the key. Texts are kept only where replay needs
+# them: commands, keyboard buttons and short code-like tokens (promo codes);
+# emails become unique fake addresses, anything else a same-length filler
+class Anonymizer:
+    def __init__(self, key: str, keep: Iterable[str] = ()):
+        self.key = key.encode()
+        self.keep = set(keep)
+
+    def _digest(self, value: str) -> bytes:
+        return hmac.new(self.key, value.encode(), hashlib.sha256).digest()
+
+    def user(self, telegram_id: int) -> int:
+        return ANON_ID_BASE + int.from_bytes(self._digest(str(telegram_id))[:6], "big")
+
+    def text(self, text: str) -> str:
+        stripped = text.strip()
+        if stripped in self.keep:
+            return stripped
+        if stripped.startswith("/"):
+            command, _, argument = stripped.partition(" ")
+            # /start <telegram id> is a referral link; other arguments are codes or slugs
+            if argument.isdigit():
+                return f"{command} {self.user(int(argument))}"
+            if argument and _TOKEN.fullmatch(argument):
+                return f"{command} {argument}"
+            return command
+        if _EMAIL.fullmatch(stripped):
+            return f"{self._digest(stripped.lower()).hex()[:16]}@example.com"
+        if _TOKEN.fullmatch(stripped) and not _LONG_NUMBER.search(stripped):
+            return stripped
+        return "~" * min(len(text), 256)
+
+
+# Outer middleware on dp.update (UPDATE_RECORD=true): appends each incoming
+# update as one compact JSON line (arrival time, remapped user, text or
+# callback data) to gzip files under UPDATE_RECORD_DIR, one file per process,
+# rotated by size and age with the oldest removed past UPDATE_RECORD_KEEP_FILES.
+# Lines are buffered and written from a background task off the event loop;
+# benchmarks/replay.py feeds the files back through dp
+class UpdateRecorder(BaseMiddleware):
+    def __init__(self, directory: str = UPDATE_RECORD_DIR, key: str = UPDATE_RECORD_KEY,
+                 rotate_mb: float = UPDATE_RECORD_ROTATE_MB, rotate_minutes: float = UPDATE_RECORD_ROTATE_MINUTES,
+                 keep_files: int = UPDATE_RECORD_KEEP_FILES, flush_interval: float = UPDATE_RECORD_FLUSH_INTERVAL,
+                 keep_texts: Iterable[str] = ()):
+        if not key:
+            logger.warning("UPDATE_RECORD_KEY is not set, user ids are remapped with a per-process key")
+        self.anonymizer = Anonymizer(key or secrets.token_hex(16), keep_texts)
+        self.directory = directory
+        self.rotate_bytes = rotate_mb * 2 ** 20
+        self.rotate_seconds = rotate_minutes * 60
+        self.keep_files = keep_files
+        self.flush_interval = flush_interval
+        self.pending: list[str] = []
+        self.recorded = 0
+        self.dropped = 0
+        self.path: str | None = None
+        self._opened_at = 0.0
+        self._flush_lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+
+    def keep(self, texts: Iterable[str]) -> None:
+        self.anonymizer.keep.update(texts)
+
+    async def __call__(self, handler, event: types.Update, data):
+        self.record(event)
+        return await handler(event, data)
+
+    def record(self, update: types.Update) -> None:
+        if len(self.pending) >= MAX_PENDING:
+            self.dropped += 1
+            return
+        entry = {"ts": round(time.time(), 4), "type": update.event_type}
+        event = update.event
+        user = getattr(event, "from_user", None)
+        if user is not None:
+            entry["user"] = self.anonymizer.user(user.id)
+        if isinstance(event, types.Message):
+            if event.text is not None:
+                entry["text"] = self.anonymizer.text(event.text)
+            else:
+                entry["content"] = event.content_type
+        elif isinstance(event, types.CallbackQuery):
+            entry["data"] = event.data
+        self.pending.append(json.dumps(entry, ensure_ascii=False, separators=(",", ":")))
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Update recording flush failed")
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            if not self.pending:
+                return
+            lines, self.pending = self.pending, []
+            await asyncio.to_thread(self._write, lines)
+            self.recorded += len(lines)
+
+    def _write(self, lines: list[str]) -> None:
+        now = time.time()
+        if (self.path is None or now - self._opened_at >= self.rotate_seconds
+                or os.path.getsize(self.path) >= self.rotate_bytes):
+            self._rotate(now)
+        # Every flush appends one gzip member; readers see a single stream
+        with gzip.open(self.path, "at", encoding="utf-8") as file:
+            file.write("\n".join(lines) + "\n")
+
+    def _rotate(self, now: float) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        stamp = datetime.datetime.fromtimestamp(now).strftime("%Y%m%d-%H%M%S")
+        self.path = os.path.join(self.directory, f"{FILE_PREFIX}{stamp}-{os.getpid()}{FILE_SUFFIX}")
+        self._opened_at = now
+        # The new file only appears on the first write, so keep one less
+        files = recording_files([self.directory])
+        for path in files[:max(0, len(files) - self.keep_files + 1)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        logger.info(f"Recording updates to {self.path}")
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {"pending": len(self.pending), "recorded": self.recorded, "dropped": self.dropped, "file": self.path}
+
+
+def recording_files(paths: Iterable[str]) -> list[str]:
+    # Files sort by their start time; directories are expanded
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, name) for name in os.listdir(path)
+                         if name.startswith(FILE_PREFIX) and name.endswith(FILE_SUFFIX))
+        else:
+            files.append(path)
+    return sorted(files, key=os.path.basename)
+
+
+def _read_file(path: str) -> Iterator[dict]:
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as file:
+        try:
+            for line in file:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+        except EOFError:
+            # A process killed mid-write leaves a truncated last member
+            logger.warning(f"{path} ends in a truncated write")
+
+
+def read_recording(paths: Iterable[str]) -> Iterator[dict]:
+    # Files of concurrent processes overlap in time; merge them by arrival
+    return heapq.merge(*(_read_file(path) for path in recording_files(paths)), key=lambda entry: entry["ts"])
+
+
+update_recorder = UpdateRecorder() if UPDATE_RECORD else None
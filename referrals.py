@@ -0,0 +1,104 @@
+import asyncio
+import datetime
+import logging
+from collections import Counter
+
+from sqlalchemy import bindparam, update
+
+import queries
+from config import DEFAULT_REFERRAL_STATUS, REFERRAL_FLUSH_INTERVAL, REFERRAL_FLUSH_BATCH
+from database import get_async_db
+from models import Referral, User, async_engine, dialect_insert
+
+logger = logging.getLogger(__name__)
+
+
+# A deep link names its referrer by referral_link_override or by telegram id;
+# both are indexed lookups. Inactive referrers and links switched off by the
+# admin attribute nothing
+async def resolve_referrer(code: str) -> int | None:
+    async with get_async_db() as db:
+        row = (await db.execute(queries.referrer_by_code(code))).first()
+    if row is None or not row.is_active:
+        return None
+    status = row.referral_status_override
+    if status is None:
+        status = DEFAULT_REFERRAL_STATUS
+    return row.id if status else None
+
+
+# Referrals are written behind registration, a batch per transaction. Each
+# referred user counts once (referrals.referred_user_id is unique), and only
+# rows that were actually inserted bump users.referral_count, so per-user
+# counts and the leaderboard read the counter instead of aggregating referrals
+class ReferralRecorder:
+    def __init__(self, flush_interval: float = REFERRAL_FLUSH_INTERVAL, flush_batch: int = REFERRAL_FLUSH_BATCH):
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self.pending: dict[int, tuple[int, datetime.datetime]] = {}
+        self.recorded = 0
+        self.duplicates = 0
+        self._flush_lock = asyncio.Lock()
+        self._flush_now = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def record(self, referrer_id: int, referred_user_id: int) -> None:
+        if referrer_id == referred_user_id:
+            return
+        self.pending.setdefault(referred_user_id, (referrer_id, datetime.datetime.utcnow()))
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        if len(self.pending) >= self.flush_batch:
+            self._flush_now.set()
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_now.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_now.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Referral flush failed")
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            if not self.pending:
+                return
+            batch, self.pending = self.pending, {}
+            rows = [{"user_id": referrer_id, "referred_user_id": referred_user_id, "created_at": created_at}
+                    for referred_user_id, (referrer_id, created_at) in batch.items()]
+            try:
+                async with get_async_db() as db:
+                    insert = dialect_insert(async_engine.dialect.name, Referral)
+                    inserted = (await db.execute(
+                        insert.on_conflict_do_nothing(index_elements=[Referral.referred_user_id])
+                        .returning(Referral.user_id), rows)).scalars().all()
+                    counts = Counter(inserted)
+                    if counts:
+                        await db.execute(
+                            update(User.__table__)
+                            .where(User.__table__.c.id == bindparam("referrer_id"))
+                            .values(referral_count=User.__table__.c.referral_count + bindparam("added")),
+                            [{"referrer_id": referrer_id, "added": added} for referrer_id, added in counts.items()]
+                        )
+                    await db.commit()
+            except Exception:
+                for referred_user_id, entry in batch.items():
+                    self.pending.setdefault(referred_user_id, entry)
+                raise
+            self.recorded += len(inserted)
+            self.duplicates += len(batch) - len(inserted)
+            logger.info(f"Recorded {len(inserted)} referrals for {len(counts)} referrers")
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {"pending": len(self.pending), "recorded": self.recorded, "duplicates": self.duplicates}
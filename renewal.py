@@ -0,0 +1,147 @@
+import asyncio
+import datetime
+import logging
+
+from sqlalchemy import update
+
+import queries
+from access_cache import access_cache, as_utc
+from catalog import message_catalog
+from config import (
+    SUBSCRIPTION_DAYS,
+    RENEWAL_INTERVAL,
+    RENEWAL_LEAD,
+    RENEWAL_GRACE,
+    RENEWAL_CHUNK_SIZE,
+    RENEWAL_CONCURRENCY
+)
+from database import get_async_db
+from models import (Subscription, async_engine, dialect_insert, record_daily_events, refresh_daily_stats,
+                    refresh_user_access, utc_today)
+from payments import PaymentDeclined, PaymentProvider
+
+logger = logging.getLogger(__name__)
+
+
+def renewal_payment_id(subscription_id: int) -> str:
+    return f"renewal-{subscription_id}"
+
+
+def refresh_derived(session, user_ids: set[int], days: set[datetime.date]) -> None:
+    # Core inserts skip the ORM flush hooks, so update what they would have
+    connection = session.connection()
+    refresh_user_access(connection, user_ids=user_ids)
+    for day in sorted(days):
+        refresh_daily_stats(connection, day, day + datetime.timedelta(days=1))
+
+
+# Renews subscriptions with auto_renewal that end within `lead` (or ended less
+# than `grace` ago). Each renewal charges the provider with the idempotency key
+# "renewal-<subscription id>" and stores it as the new row's payment_id, so a
+# retry after a crash, or a second runner, reuses the first charge and the
+# insert of a row that already exists is a no-op
+class RenewalRunner:
+    def __init__(self, provider: PaymentProvider, price: int | None = None, days: int = SUBSCRIPTION_DAYS,
+                 interval: float = RENEWAL_INTERVAL, lead: int = RENEWAL_LEAD, grace: int = RENEWAL_GRACE,
+                 chunk_size: int = RENEWAL_CHUNK_SIZE, concurrency: int = RENEWAL_CONCURRENCY):
+        self.provider = provider
+        # None follows the price set in the admin panel
+        self.price = price
+        self.period = datetime.timedelta(days=days)
+        self.interval = interval
+        self.lead = datetime.timedelta(seconds=lead)
+        self.grace = datetime.timedelta(seconds=grace)
+        self.chunk_size = chunk_size
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.renewed = 0
+        self.declined = 0
+        self.failed = 0
+
+    async def run(self) -> None:
+        logger.info("Renewal runner started.")
+        while True:
+            try:
+                await self.renew_due()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Renewal pass failed")
+            await asyncio.sleep(self.interval)
+
+    async def renew_due(self, now: datetime.datetime | None = None) -> dict:
+        now = now or datetime.datetime.now(datetime.timezone.utc)
+        totals = {"renewed": 0, "declined": 0, "failed": 0}
+        after = None
+        while True:
+            async with get_async_db() as db:
+                due = (await db.execute(queries.subscriptions_due_for_renewal(
+                    now - self.grace, now + self.lead, after, self.chunk_size))).all()
+            if not due:
+                break
+            outcome = await self.renew_chunk(due)
+            for key, count in outcome.items():
+                totals[key] += count
+            after = (due[-1].end_date, due[-1].id)
+        if any(totals.values()):
+            logger.info(f"Renewal pass: {totals['renewed']} renewed, {totals['declined']} declined, "
+                        f"{totals['failed']} to retry")
+        return totals
+
+    async def renew_chunk(self, due: list) -> dict:
+        price = self.price or message_catalog.price
+        outcomes = await asyncio.gather(*(self.charge(subscription, price) for subscription in due))
+        paid = [subscription for subscription, status in zip(due, outcomes) if status == "paid"]
+        declined = [subscription.id for subscription, status in zip(due, outcomes) if status == "declined"]
+        renewed = []
+        async with get_async_db() as db:
+            if paid:
+                rows = []
+                for subscription in paid:
+                    start = as_utc(subscription.end_date)
+                    rows.append({"user_id": subscription.user_id, "start_date": start, "end_date": start + self.period,
+                                 "payment_amount": price, "payment_id": renewal_payment_id(subscription.id),
+                                 "auto_renewal": True})
+                insert = dialect_insert(async_engine.dialect.name, Subscription)
+                # Rows another pass already inserted come back empty, so only new renewals count
+                inserted = set((await db.execute(
+                    insert.on_conflict_do_nothing(index_elements=[Subscription.payment_id])
+                    .returning(Subscription.payment_id), rows)).scalars())
+                renewed = [subscription for subscription in paid if renewal_payment_id(subscription.id) in inserted]
+                if renewed:
+                    starts = [as_utc(subscription.end_date) for subscription in renewed]
+                    await db.run_sync(refresh_derived, {subscription.user_id for subscription in renewed},
+                                      {day for start in starts for day in (start.date(), (start + self.period).date())})
+            if declined:
+                # A declined card is not retried; the user renews by hand after the expiry notice
+                disabled = (await db.execute(
+                    update(Subscription).where(Subscription.id.in_(declined), Subscription.auto_renewal.is_(True))
+                    .values(auto_renewal=False).returning(Subscription.id))).scalars().all()
+                if disabled:
+                    # Counted as the ORM hook counts a user turning it off
+                    await db.run_sync(lambda session: record_daily_events(
+                        session.connection(), utc_today(), auto_renewal_disabled=len(disabled)))
+            await db.commit()
+        for subscription in renewed:
+            access_cache.invalidate(subscription.telegram_id)
+        counts = {"renewed": len(renewed), "declined": len(declined), "failed": len(due) - len(paid) - len(declined)}
+        self.renewed += counts["renewed"]
+        self.declined += counts["declined"]
+        self.failed += counts["failed"]
+        return counts
+
+    async def charge(self, subscription, price: int) -> str:
+        payment_id = renewal_payment_id(subscription.id)
+        async with self.semaphore:
+            try:
+                await self.provider.charge(payment_id, subscription.user_id, price,
+                                           f"Продление подписки на {self.period.days} дней")
+                return "paid"
+            except PaymentDeclined as e:
+                logger.info(f"Renewal {payment_id} declined: {e}")
+                return "declined"
+            except Exception as e:
+                logger.warning(f"Renewal {payment_id} failed, will retry: {e}")
+                return "failed"
+
+    def stats(self) -> dict:
+        return {"renewed": self.renewed, "declined": self.declined, "failed": self.failed}
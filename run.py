@@ -1,30 +1,119 @@
 import asyncio
 import logging
-from bot import main as bot_main
+import multiprocessing
+import queue
+from bot import main as bot_main, webhook_app
+from access_cache import access_cache
+from promo import promo_cache
 from admin_panel.app import app
+from asgi import Router, not_found, wsgi
+from config import (BOT_MODE, WEBHOOK_PATH, WEB_BIND, ADMIN_MODE, ADMIN_THREADS, ADMIN_BIND,
+                    PAYMENT_NOTIFICATION_PATH, MERCHANT_SECRET_KEY, METRICS_PATH, METRICS_BIND, METRICS_TOKEN)
 from hypercorn.asyncio import serve
 from hypercorn.config import Config
+from metrics import MetricsApp
+from payment_webhook import PaymentNotificationApp
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+payment_app = PaymentNotificationApp(PAYMENT_NOTIFICATION_PATH, MERCHANT_SECRET_KEY)
+# Each process serves its own registry: the bot's (with shard workers'), or the admin panel's
+metrics_app = MetricsApp(token=METRICS_TOKEN)
 
-async def run_web():
+
+def build_web_app(admin: bool = True):
+    web_app = Router(wsgi(app, ADMIN_THREADS) if admin else not_found)
+    if BOT_MODE == "webhook":
+        web_app.mount(WEBHOOK_PATH, webhook_app)
+    if MERCHANT_SECRET_KEY:
+        web_app.mount(PAYMENT_NOTIFICATION_PATH, payment_app)
+    web_app.mount(METRICS_PATH, metrics_app)
+    return web_app
+
+
+async def run_web(web_app, bind: str = WEB_BIND):
     config = Config()
-    config.bind = ["0.0.0.0:8000"]
+    config.bind = [bind]
     config.use_reloader = False
-    await serve(app, config)
+    await serve(web_app, config)
+
+
+def admin_process_main(bind: str, invalidations, payments: bool = False) -> None:
+    # Access changes made in the admin process still have to reach the bot's cache
+    access_cache.listeners.append(lambda telegram_id: invalidations.put(("access", telegram_id)))
+    promo_cache.listeners.append(lambda code: invalidations.put(("promo", code)))
+    web_app = Router(wsgi(app, ADMIN_THREADS))
+    web_app.mount(METRICS_PATH, metrics_app)
+    if payments and MERCHANT_SECRET_KEY:
+        # Polling leaves the public port to this process, so provider callbacks arrive here
+        web_app.mount(PAYMENT_NOTIFICATION_PATH, payment_app)
+    asyncio.run(run_web(web_app, bind))
+
+
+def next_invalidation(invalidations) -> tuple:
+    try:
+        return invalidations.get(timeout=1)
+    except queue.Empty:
+        return ()
+
+
+async def relay_invalidations(invalidations) -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        message = await loop.run_in_executor(None, next_invalidation, invalidations)
+        if not message:
+            continue
+        kind, key = message
+        if kind == "promo":
+            promo_cache.invalidate(key)
+        elif key is None:
+            access_cache.clear()
+        else:
+            access_cache.invalidate(key)
+
+
+async def supervise_admin(bind: str, payments: bool = False) -> None:
+    context = multiprocessing.get_context("spawn")
+    invalidations = context.Queue()
+    relay = asyncio.create_task(relay_invalidations(invalidations))
+    try:
+        while True:
+            process = context.Process(target=admin_process_main, args=(bind, invalidations, payments),
+                                      name="admin-panel", daemon=True)
+            process.start()
+            logger.info(f"Admin panel process started on {bind} (pid {process.pid})")
+            try:
+                while process.is_alive():
+                    await asyncio.sleep(1)
+            finally:
+                if process.is_alive():
+                    process.terminate()
+            logger.error(f"Admin panel process exited with code {process.exitcode}, restarting")
+            await asyncio.sleep(1)
+    finally:
+        relay.cancel()
 
 
 async def main():
-    bot_task = asyncio.create_task(bot_main())
-    web_task = asyncio.create_task(run_web())
+    tasks = [asyncio.create_task(bot_main(serve_webhook=False))]
+    if ADMIN_MODE == "process":
+        if BOT_MODE == "webhook":
+            tasks.append(asyncio.create_task(run_web(build_web_app(admin=False))))
+            tasks.append(asyncio.create_task(supervise_admin(ADMIN_BIND)))
+        else:
+            tasks.append(asyncio.create_task(supervise_admin(WEB_BIND, payments=True)))
+            # The admin process owns WEB_BIND, so the bot's own metrics get a port of their own
+            metrics_web = Router(not_found)
+            metrics_web.mount(METRICS_PATH, metrics_app)
+            tasks.append(asyncio.create_task(run_web(metrics_web, METRICS_BIND)))
+    else:
+        tasks.append(asyncio.create_task(run_web(build_web_app())))
     logger.info("Starting bot and web server...")
-    await asyncio.gather(bot_task, web_task)
+    await asyncio.gather(*tasks)
 
 if __name__ == "__main__":
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
         logger.info("Shutdown requested by user.")
-
@@ -0,0 +1,299 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import socket
+import time
+from collections import OrderedDict
+
+from aiogram import Bot, types
+
+from access_cache import access_cache
+from promo import promo_cache
+from config import SHARD_REPORT_INTERVAL, WEBHOOK_QUEUE_SIZE, WEBHOOK_CONCURRENCY, METRICS_WORKER_INTERVAL
+from metrics import registry
+from webhook import UpdateQueue, update_user_id
+
+logger = logging.getLogger(__name__)
+
+LINE_LIMIT = 2 ** 20
+RESTART_DELAY = 1.0
+
+
+def encode(message: dict) -> bytes:
+    return json.dumps(message, separators=(",", ":")).encode() + b"\n"
+
+
+# Ingress side of one partition: a worker process fed over a unix socket.
+# Updates stay in `unacked` until the worker reports them handled, so when the
+# worker dies they are replayed, in order, to the process that replaces it
+class Shard:
+    def __init__(self, index: int, maxsize: int):
+        self.index = index
+        self.maxsize = maxsize
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.unacked: OrderedDict[int, bytes] = OrderedDict()
+        self.process = None
+        self.restarts = 0
+        self.processed = 0
+        self.rate = 0.0
+        self.metrics: dict = {}
+        self._reported = (time.monotonic(), 0)
+        self._task: asyncio.Task | None = None
+        self._stopping = False
+
+    def full(self) -> bool:
+        return self.queue.qsize() >= self.maxsize
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._supervise())
+
+    async def stop(self, timeout: float) -> None:
+        deadline = time.monotonic() + timeout
+        while (self.queue.qsize() or self.unacked) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        self._stopping = True
+        self.queue.put_nowait(None)
+        if self._task is not None:
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _supervise(self) -> None:
+        context = multiprocessing.get_context("spawn")
+        while not self._stopping:
+            parent_sock, child_sock = socket.socketpair()
+            process = context.Process(target=worker_main, args=(self.index, child_sock),
+                                      name=f"bot-worker-{self.index}", daemon=True)
+            process.start()
+            child_sock.close()
+            self.process = process
+            reader, writer = await asyncio.open_unix_connection(sock=parent_sock, limit=LINE_LIMIT)
+            logger.info(f"Worker {self.index} started (pid {process.pid}, {len(self.unacked)} updates to replay)")
+
+            for line in self.unacked.values():
+                writer.write(line)
+            tasks = [asyncio.create_task(self._send(writer)), asyncio.create_task(self._receive(reader))]
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            writer.close()
+
+            await asyncio.get_running_loop().run_in_executor(None, process.join, 10)
+            if process.is_alive():
+                process.kill()
+            if self._stopping:
+                break
+            self.restarts += 1
+            logger.error(f"Worker {self.index} exited with code {process.exitcode}; "
+                         f"reassigning partition {self.index} to a new worker")
+            await asyncio.sleep(RESTART_DELAY)
+
+    async def _send(self, writer: asyncio.StreamWriter) -> None:
+        while True:
+            message = await self.queue.get()
+            if message is None:
+                writer.write_eof()
+                # The worker closes its end once everything it received is handled
+                await asyncio.Event().wait()
+            line = encode(message)
+            if message["op"] == "update":
+                self.unacked[message["update"]["update_id"]] = line
+            writer.write(line)
+            await writer.drain()
+
+    async def _receive(self, reader: asyncio.StreamReader) -> None:
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            message = json.loads(line)
+            if message["op"] == "ack":
+                self.unacked.pop(message["update_id"], None)
+                self.processed += 1
+            elif message["op"] == "metrics":
+                self.metrics = message["snapshot"]
+
+    def report(self) -> None:
+        now = time.monotonic()
+        since, processed = self._reported
+        self.rate = (self.processed - processed) / max(now - since, 1e-9)
+        self._reported = (now, self.processed)
+
+    def stats(self) -> dict:
+        return {
+            "worker": self.index,
+            "pid": self.process.pid if self.process is not None else None,
+            "alive": self.process is not None and self.process.is_alive(),
+            "queued": self.queue.qsize(),
+            "in_flight": len(self.unacked),
+            "processed": self.processed,
+            "updates_per_second": round(self.rate, 2),
+            "restarts": self.restarts,
+        }
+
+
+# Drop-in for UpdateQueue in the ingress process: updates are partitioned by
+# user id over `workers` processes, each running bot.dp. Access-cache
+# invalidations from the admin panel are forwarded to the owning worker, promo
+# code invalidations to every worker
+class ShardRouter:
+    def __init__(self, bot: Bot, workers: int, maxsize: int = WEBHOOK_QUEUE_SIZE,
+                 report_interval: float = SHARD_REPORT_INTERVAL):
+        self.bot = bot
+        self.maxsize = maxsize
+        self.report_interval = report_interval
+        self.shards = [Shard(index, max(1, maxsize // workers)) for index in range(max(1, workers))]
+        self.received = 0
+        self.rejected = 0
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._reporter: asyncio.Task | None = None
+
+    @property
+    def running(self) -> bool:
+        return self._loop is not None
+
+    def shard_for(self, user_id: int) -> Shard:
+        return self.shards[user_id % len(self.shards)]
+
+    def submit(self, update: types.Update) -> bool:
+        shard = self.shard_for(update_user_id(update))
+        if not self.running or shard.full():
+            self.rejected += 1
+            return False
+        self._enqueue(shard, update)
+        return True
+
+    async def put(self, update: types.Update) -> None:
+        # Polling has nowhere to bounce an update to, so it waits for room instead
+        shard = self.shard_for(update_user_id(update))
+        while shard.full():
+            await asyncio.sleep(0.05)
+        self._enqueue(shard, update)
+
+    def _enqueue(self, shard: Shard, update: types.Update) -> None:
+        shard.queue.put_nowait({"op": "update", "update": update.model_dump(mode="json", exclude_none=True)})
+        self.received += 1
+
+    def invalidate(self, telegram_id: int | None) -> None:
+        # Called from admin request threads as well as the event loop
+        shards = self.shards if telegram_id is None else [self.shard_for(telegram_id)]
+        for shard in shards:
+            self._loop.call_soon_threadsafe(shard.queue.put_nowait, {"op": "invalidate", "telegram_id": telegram_id})
+
+    def invalidate_promo(self, code: str | None) -> None:
+        for shard in self.shards:
+            self._loop.call_soon_threadsafe(shard.queue.put_nowait, {"op": "invalidate_promo", "code": code})
+
+    async def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        for shard in self.shards:
+            shard.start()
+        access_cache.listeners.append(self.invalidate)
+        promo_cache.listeners.append(self.invalidate_promo)
+        registry.collectors.append(self.worker_metrics)
+        self._reporter = asyncio.create_task(self._report())
+        logger.info(f"Sharded ingress started with {len(self.shards)} workers")
+
+    async def stop(self, timeout: float = 30) -> None:
+        access_cache.listeners.remove(self.invalidate)
+        promo_cache.listeners.remove(self.invalidate_promo)
+        registry.collectors.remove(self.worker_metrics)
+        self._reporter.cancel()
+        await asyncio.gather(*(shard.stop(timeout) for shard in self.shards))
+        self._loop = None
+
+    def worker_metrics(self) -> list[tuple[dict, dict]]:
+        # Handlers run in the workers, which send their registries every METRICS_WORKER_INTERVAL
+        return [({"worker": str(shard.index)}, shard.metrics) for shard in self.shards]
+
+    async def _report(self) -> None:
+        while True:
+            await asyncio.sleep(self.report_interval)
+            for shard in self.shards:
+                shard.report()
+            logger.info("Worker throughput: " + ", ".join(
+                f"#{shard.index} {shard.rate:.1f}/s ({len(shard.unacked)} in flight)" for shard in self.shards))
+
+    def stats(self) -> dict:
+        return {
+            "running": self.running,
+            "depth": sum(shard.queue.qsize() + len(shard.unacked) for shard in self.shards),
+            "maxsize": self.maxsize,
+            "workers": len(self.shards),
+            "received": self.received,
+            "processed": sum(shard.processed for shard in self.shards),
+            "rejected": self.rejected,
+            "shards": [shard.stats() for shard in self.shards],
+        }
+
+
+async def poll_updates(bot: Bot, router: ShardRouter, allowed_updates: list[str]) -> None:
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed_updates)
+        except Exception as e:
+            logger.error(f"Failed to fetch updates: {e}")
+            await asyncio.sleep(5)
+            continue
+        for update in updates:
+            await router.put(update)
+            offset = update.update_id + 1
+
+
+def worker_main(index: int, sock: socket.socket) -> None:
+    try:
+        asyncio.run(run_worker(index, sock))
+    except KeyboardInterrupt:
+        pass
+
+
+async def run_worker(index: int, sock: socket.socket) -> None:
+    import bot as bot_module
+
+    reader, writer = await asyncio.open_unix_connection(sock=sock, limit=LINE_LIMIT)
+
+    def ack(update: types.Update) -> None:
+        writer.write(encode({"op": "ack", "update_id": update.update_id}))
+
+    queue = UpdateQueue(bot_module.dp, bot_module.bot, maxsize=WEBHOOK_QUEUE_SIZE,
+                        concurrency=WEBHOOK_CONCURRENCY, on_done=ack)
+    await queue.start()
+    await bot_module.message_catalog.refresh()
+    catalog_task = asyncio.create_task(bot_module.message_catalog.run())
+
+    async def send_metrics() -> None:
+        while True:
+            await asyncio.sleep(METRICS_WORKER_INTERVAL)
+            writer.write(encode({"op": "metrics", "snapshot": registry.snapshot()}))
+
+    metrics_task = asyncio.create_task(send_metrics())
+    logger.info(f"Worker {index} ready")
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            message = json.loads(line)
+            if message["op"] == "update":
+                update = types.Update.model_validate(message["update"], context={"bot": bot_module.bot})
+                while not queue.submit(update):
+                    await asyncio.sleep(0.01)
+            elif message["op"] == "invalidate":
+                if message["telegram_id"] is None:
+                    access_cache.clear()
+                else:
+                    access_cache.invalidate(message["telegram_id"])
+            elif message["op"] == "invalidate_promo":
+                promo_cache.invalidate(message["code"])
+            await writer.drain()
+    finally:
+        catalog_task.cancel()
+        metrics_task.cancel()
+        await queue.stop()
+        await bot_module.referral_recorder.close()
+        if bot_module.update_recorder is not None:
+            await bot_module.update_recorder.close()
+        await bot_module.storage.close()
+        await bot_module.bot.session.close()
+        writer.close()
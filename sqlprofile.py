@@ -0,0 +1,279 @@
+import datetime
+import json
+import logging
+import os
+import queue
+import re
+import sys
+import threading
+import time
+
+from sqlalchemy import event
+
+from config import (
+    SQL_PROFILE,
+    SQL_PROFILE_PATH,
+    SQL_PROFILE_SLOW_MS,
+    SQL_PROFILE_REPEAT,
+    SQL_PROFILE_STACK_DEPTH,
+    SQL_PROFILE_EXPLAIN
+)
+from metrics import db_tally
+from models import engine
+
+try:
+    import greenlet
+except ImportError:
+    greenlet = None
+
+logger = logging.getLogger(__name__)
+
+PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
+SKIP_FILES = {os.path.abspath(__file__), os.path.join(PROJECT_ROOT, "metrics.py")}
+
+_PARAMS = re.compile(r"\$\d+|%\(\w+\)s")
+_IN_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_VALUES = re.compile(r"(\(\?(?:, \?)*\))(?:, \1)+")
+_NUMBER = re.compile(r"(?<![\w.])\d+(?![\w.])")
+_SPACE = re.compile(r"\s+")
+
+
+def normalize(statement: str) -> str:
+    # One shape per query whatever its parameters, IN-list length or batch size
+    shape = _SPACE.sub(" ", statement).strip()
+    shape = _PARAMS.sub("?", shape)
+    shape = _NUMBER.sub("?", shape)
+    shape = _IN_LIST.sub("(?)", shape)
+    return _VALUES.sub(r"\1", shape)
+
+
+def explain_sql(conn, sql: str, params) -> tuple[list[str], list[str]]:
+    if conn.dialect.name == "sqlite":
+        rows = conn.exec_driver_sql("EXPLAIN QUERY PLAN " + sql, params).all()
+        details = [row[3] for row in rows]
+        # "SCAN <table>" without an index is a full table scan; "SEARCH" uses an index
+        scans = [detail for detail in details
+                 if detail.startswith("SCAN ") and "USING" not in detail and "CONSTANT ROW" not in detail]
+        return details, scans
+    if conn.dialect.name == "postgresql":
+        # Tiny tables make a seq scan the cheapest plan; forbid it so only
+        # queries with no usable index end up with one
+        conn.exec_driver_sql("SET LOCAL enable_seqscan = off")
+        plan = conn.exec_driver_sql("EXPLAIN (FORMAT JSON) " + sql, params).scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        nodes, stack = [], [plan[0]["Plan"]]
+        while stack:
+            node = stack.pop()
+            nodes.append(node)
+            stack.extend(node.get("Plans", []))
+        details = [f"{node['Node Type']} {node.get('Relation Name', '')}".strip() for node in nodes]
+        scans = [detail for detail in details if detail.startswith("Seq Scan")]
+        return details, scans
+    raise ValueError(f"Unsupported dialect for plan checks: {conn.dialect.name}")
+
+
+def to_pyformat(sql: str, params) -> tuple[str, tuple]:
+    # asyncpg's $1 placeholders, rewritten for the sync psycopg2 engine
+    order = []
+
+    def placeholder(match):
+        order.append(int(match.group(0)[1:]) - 1)
+        return "%s"
+    sql = re.sub(r"\$\d+", placeholder, sql.replace("%", "%%"))
+    return sql, tuple(params[index] for index in order)
+
+
+def project_stack(depth: int) -> list[str]:
+    # Frames of this project only, innermost first; the frames of an async
+    # caller sit in the parent greenlet of the one SQLAlchemy runs the query in
+    frames = []
+    frame = sys._getframe(2)
+    current = greenlet.getcurrent() if greenlet else None
+    while len(frames) < depth:
+        while frame is not None and len(frames) < depth:
+            filename = frame.f_code.co_filename
+            if filename.startswith(PROJECT_ROOT) and filename not in SKIP_FILES and "site-packages" not in filename:
+                frames.append(f"{os.path.relpath(filename, PROJECT_ROOT)}:{frame.f_lineno} {frame.f_code.co_name}")
+            frame = frame.f_back
+        current = current.parent if current is not None else None
+        if current is None or current.gr_frame is None:
+            break
+        frame = current.gr_frame
+    return frames
+
+
+class Shape:
+    __slots__ = ("statement", "params", "paramstyle", "count", "seconds", "slowest", "stack", "slow_stack")
+
+    def __init__(self, statement: str, params, paramstyle: str, stack: list[str]):
+        self.statement = statement
+        self.params = params
+        self.paramstyle = paramstyle
+        self.count = 0
+        self.seconds = 0.0
+        self.slowest = 0.0
+        self.stack = stack
+        self.slow_stack = None
+
+
+# Opt-in (SQL_PROFILE=true) companion of the metrics tally: every statement
+# run inside a bot update or admin request is grouped by its normalized text.
+# When the unit ends, shapes repeated SQL_PROFILE_REPEAT or more times (N+1),
+# statements slower than SQL_PROFILE_SLOW_MS and, via EXPLAIN once per shape,
+# full table scans are written to SQL_PROFILE_PATH as one JSON line per unit.
+# EXPLAIN and file writes happen on a background thread, off the handler
+class SQLProfiler:
+    def __init__(self, path: str = SQL_PROFILE_PATH, slow_ms: float = SQL_PROFILE_SLOW_MS,
+                 repeat: int = SQL_PROFILE_REPEAT, stack_depth: int = SQL_PROFILE_STACK_DEPTH,
+                 explain: bool = SQL_PROFILE_EXPLAIN):
+        self.path = path
+        self.slow = slow_ms / 1000
+        self.repeat = repeat
+        self.stack_depth = stack_depth
+        self.explain = explain
+        self.plans: dict[str, list[str]] = {}
+        self.reports = 0
+        self._queue: queue.Queue = queue.Queue()
+        self._thread: threading.Thread | None = None
+
+    def instrument(self, engine) -> None:
+        if not event.contains(engine, "before_cursor_execute", self._before):
+            event.listen(engine, "before_cursor_execute", self._before)
+            event.listen(engine, "after_cursor_execute", self._after)
+            event.listen(engine, "handle_error", self._error)
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        if db_tally.get() is not None:
+            conn.info.setdefault("profile_started", []).append(time.perf_counter())
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        tally = db_tally.get()
+        started = conn.info.get("profile_started")
+        if tally is None or not started:
+            return
+        elapsed = time.perf_counter() - started.pop()
+        if tally.trace is None:
+            tally.trace = {}
+        key = normalize(statement)
+        shape = tally.trace.get(key)
+        if shape is None:
+            shape = tally.trace[key] = Shape(statement, None if executemany else parameters,
+                                             conn.dialect.paramstyle, project_stack(self.stack_depth))
+        shape.count += 1
+        shape.seconds += elapsed
+        if elapsed > shape.slowest:
+            shape.slowest = elapsed
+            if elapsed >= self.slow:
+                shape.slow_stack = project_stack(self.stack_depth)
+
+    def _error(self, exception_context):
+        connection = exception_context.connection
+        if connection is not None and connection.info.get("profile_started"):
+            connection.info["profile_started"].pop()
+
+    def report(self, kind: str, name: str, tally) -> None:
+        if not tally.trace:
+            return
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="sql-profiler", daemon=True)
+            self._thread.start()
+        self._queue.put((datetime.datetime.utcnow().isoformat(), kind, name, tally.statements,
+                         tally.seconds, tally.trace))
+
+    def _run(self) -> None:
+        while True:
+            at, kind, name, statements, seconds, trace = self._queue.get()
+            try:
+                findings = self.findings(trace)
+                if findings:
+                    self.write({"at": at, "pid": os.getpid(), "kind": kind, "name": name, "statements": statements,
+                                "db_ms": round(seconds * 1000, 2), "findings": findings})
+            except Exception:
+                logger.exception("SQL profile report failed")
+
+    def findings(self, trace: dict) -> list[dict]:
+        findings = []
+        for key, shape in trace.items():
+            if shape.count >= self.repeat:
+                findings.append({"type": "repeated", "shape": key, "count": shape.count,
+                                 "ms": round(shape.seconds * 1000, 2), "stack": shape.stack})
+            if shape.slowest >= self.slow:
+                findings.append({"type": "slow", "shape": key, "count": shape.count,
+                                 "ms": round(shape.slowest * 1000, 2), "stack": shape.slow_stack or shape.stack})
+            scans = self.scans(key, shape)
+            if scans:
+                findings.append({"type": "full_scan", "shape": key, "count": shape.count,
+                                 "ms": round(shape.seconds * 1000, 2), "plan": scans, "stack": shape.stack})
+        return findings
+
+    def scans(self, key: str, shape: Shape) -> list[str]:
+        if not self.explain or shape.params is None or key.split(" ", 1)[0].upper() not in ("SELECT", "UPDATE", "DELETE"):
+            return []
+        if key not in self.plans:
+            sql, params = shape.statement, shape.params
+            if shape.paramstyle.startswith("numeric"):
+                sql, params = to_pyformat(sql, params)
+            try:
+                with engine.connect() as conn:
+                    _, self.plans[key] = explain_sql(conn, sql, params)
+                    conn.rollback()
+            except Exception as e:
+                logger.debug(f"Could not EXPLAIN {key[:80]}: {e}")
+                self.plans[key] = []
+        return self.plans[key]
+
+    def write(self, entry: dict) -> None:
+        # One write per line so the bot and admin processes can share the file
+        line = json.dumps(entry, ensure_ascii=False, default=str) + "\n"
+        with open(self.path, "a", encoding="utf-8") as file:
+            file.write(line)
+        self.reports += 1
+
+    def stats(self) -> dict:
+        return {"reports": self.reports, "queued": self._queue.qsize(), "shapes_explained": len(self.plans)}
+
+
+def read_reports(path: str = SQL_PROFILE_PATH, max_bytes: int = 8 * 2 ** 20) -> list[dict]:
+    # The newest max_bytes of the file; older reports are not summarized
+    try:
+        with open(path, "rb") as file:
+            file.seek(0, os.SEEK_END)
+            size = file.tell()
+            file.seek(max(0, size - max_bytes))
+            data = file.read()
+    except FileNotFoundError:
+        return []
+    lines = data.decode("utf-8", errors="replace").splitlines()
+    if size > max_bytes:
+        lines = lines[1:]
+    reports = []
+    for line in lines:
+        try:
+            reports.append(json.loads(line))
+        except ValueError:
+            continue
+    return reports
+
+
+def summarize(reports: list[dict]) -> list[dict]:
+    rows: dict[tuple, dict] = {}
+    for report in reports:
+        for finding in report.get("findings", []):
+            key = (finding["type"], report["kind"], report["name"], finding["shape"])
+            row = rows.get(key)
+            if row is None:
+                row = rows[key] = {"type": finding["type"], "kind": report["kind"], "name": report["name"],
+                                   "shape": finding["shape"], "occurrences": 0, "max_count": 0, "max_ms": 0.0,
+                                   "last_seen": report["at"], "stack": finding.get("stack", []),
+                                   "plan": finding.get("plan", [])}
+            row["occurrences"] += 1
+            row["max_count"] = max(row["max_count"], finding["count"])
+            row["max_ms"] = max(row["max_ms"], finding["ms"])
+            if report["at"] >= row["last_seen"]:
+                row["last_seen"] = report["at"]
+                row["stack"] = finding.get("stack", row["stack"])
+    return sorted(rows.values(), key=lambda row: (row["occurrences"], row["max_ms"]), reverse=True)
+
+
+sql_profiler = SQLProfiler() if SQL_PROFILE else None
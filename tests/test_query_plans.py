@@ -0,0 +1,37 @@
+import os
+
+import pytest
+from alembic import command
+from sqlalchemy import create_engine
+
+import queries
+from manage import explain
+from models import get_alembic_config
+
+# The PostgreSQL case runs only against a database given here; it is migrated to head
+POSTGRES_URL = os.getenv("TEST_POSTGRES_URL")
+
+
+@pytest.fixture(scope="module", params=["sqlite", "postgresql"])
+def migrated_engine(request, tmp_path_factory):
+    if request.param == "sqlite":
+        url = f"sqlite:///{tmp_path_factory.mktemp('plans') / 'plans.db'}"
+    elif POSTGRES_URL:
+        url = POSTGRES_URL
+    else:
+        pytest.skip("TEST_POSTGRES_URL is not set")
+    engine = create_engine(url)
+    with engine.begin() as conn:
+        alembic_cfg = get_alembic_config()
+        alembic_cfg.attributes["connection"] = conn
+        command.upgrade(alembic_cfg, "head")
+    yield engine
+    engine.dispose()
+
+
+@pytest.mark.parametrize("name", sorted(queries.hot_queries()))
+def test_hot_query_uses_an_index(migrated_engine, name):
+    statement = queries.hot_queries(migrated_engine.dialect.name)[name]
+    with migrated_engine.begin() as conn:
+        details, scans = explain(conn, statement)
+    assert not scans, f"{name} falls back to a full table scan: {'; '.join(details)}"
@@ -0,0 +1,158 @@
+import asyncio
+import hmac
+import logging
+import time
+
+from aiogram import Bot, Dispatcher, types
+
+from asgi import get_header, read_body, send_json, send_response
+
+logger = logging.getLogger(__name__)
+
+
+def update_user_id(update: types.Update) -> int:
+    try:
+        event = update.event
+    except Exception:
+        return 0
+    user = getattr(event, "from_user", None)
+    if user is not None:
+        return user.id
+    chat = getattr(event, "chat", None)
+    return chat.id if chat is not None else 0
+
+
+# Updates are spread over `concurrency` lanes by user id, so one user's
+# updates are handled in order while different users run concurrently
+class UpdateQueue:
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, maxsize: int, concurrency: int, on_done=None):
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self.maxsize = maxsize
+        self.concurrency = max(1, concurrency)
+        self.on_done = on_done
+        self.lanes: list[asyncio.Queue] = []
+        self.workers: list[asyncio.Task] = []
+        self.received = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.total_lag = 0.0
+
+    @property
+    def running(self) -> bool:
+        return bool(self.workers)
+
+    def depth(self) -> int:
+        return sum(lane.qsize() for lane in self.lanes)
+
+    def submit(self, update: types.Update) -> bool:
+        if not self.lanes:
+            self.rejected += 1
+            return False
+        lane = self.lanes[update_user_id(update) % len(self.lanes)]
+        try:
+            lane.put_nowait((time.monotonic(), update))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return False
+        self.received += 1
+        return True
+
+    async def start(self) -> None:
+        lane_size = max(1, self.maxsize // self.concurrency)
+        self.lanes = [asyncio.Queue(maxsize=lane_size) for _ in range(self.concurrency)]
+        self.workers = [asyncio.create_task(self._work(lane)) for lane in self.lanes]
+        logger.info(f"Update queue started: {self.concurrency} lanes, {lane_size} updates each")
+
+    async def stop(self) -> None:
+        for lane in self.lanes:
+            await lane.join()
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        self.lanes = []
+
+    async def _work(self, lane: asyncio.Queue) -> None:
+        while True:
+            enqueued_at, update = await lane.get()
+            lag = time.monotonic() - enqueued_at
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            self.total_lag += lag
+            try:
+                await self.dispatcher.feed_update(self.bot, update)
+                self.processed += 1
+            except Exception:
+                self.failed += 1
+                logger.exception(f"Failed to process update {update.update_id}")
+            finally:
+                lane.task_done()
+                if self.on_done is not None:
+                    self.on_done(update)
+
+    def stats(self) -> dict:
+        handled = self.processed + self.failed
+        return {
+            "running": self.running,
+            "depth": self.depth(),
+            "maxsize": self.maxsize,
+            "concurrency": self.concurrency,
+            "received": self.received,
+            "processed": self.processed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "lag_last_seconds": round(self.last_lag, 6),
+            "lag_max_seconds": round(self.max_lag, 6),
+            "lag_avg_seconds": round(self.total_lag / handled, 6) if handled else 0.0,
+        }
+
+
+# POST <path> accepts an update, GET <path>/stats reports the queue; both need
+# the X-Telegram-Bot-Api-Secret-Token header when a secret is configured
+class WebhookApp:
+    def __init__(self, queue: UpdateQueue, path: str, secret: str = ""):
+        self.queue = queue
+        self.path = path.rstrip("/")
+        self.secret = secret.encode()
+
+    def _authorized(self, scope) -> bool:
+        if not self.secret:
+            return True
+        token = get_header(scope, b"x-telegram-bot-api-secret-token") or b""
+        return hmac.compare_digest(token, self.secret)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return
+        if not self._authorized(scope):
+            await send_response(send, 401)
+            return
+
+        path, method = scope["path"].rstrip("/"), scope["method"]
+        if path == self.path + "/stats" and method == "GET":
+            await send_json(send, 200, self.queue.stats())
+            return
+        if path != self.path:
+            await send_response(send, 404)
+            return
+        if method != "POST":
+            await send_response(send, 405)
+            return
+
+        body = await read_body(receive)
+        if body is None:
+            await send_response(send, 413)
+            return
+        try:
+            update = types.Update.model_validate_json(body, context={"bot": self.queue.bot})
+        except ValueError:
+            logger.warning("Rejected malformed webhook update")
+            await send_response(send, 400)
+            return
+
+        # 503 makes Telegram redeliver later instead of us buffering without bound
+        await send_response(send, 200 if self.queue.submit(update) else 503)